@@ -0,0 +1,290 @@
+import logging
+import os
+import re
+import sqlite3
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Any, Optional
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Columns written to the archive, in the same order as the events table
+ARCHIVE_COLUMNS = ['id', 'event_name', 'user_id', 'session_id', 'properties', 'timestamp', 'created_at', 'sample_weight']
+ARCHIVE_FILE_PATTERN = re.compile(r'^events-(\d+)-(\d+)\.parquet$')
+
+
+def _import_pyarrow():
+    """Import pyarrow lazily so the hot ingestion path does not depend on it"""
+    try:
+        import pyarrow
+        import pyarrow.dataset
+        import pyarrow.parquet
+    except ImportError as e:
+        raise RuntimeError("Archiving analytics events requires pyarrow (pip install pyarrow)") from e
+    return pyarrow
+
+
+def archive_schema(pa):
+    """Schema of archive files; files written before a column existed read it as null"""
+    return pa.schema([
+        ('id', pa.int64()),
+        ('event_name', pa.string()),
+        ('user_id', pa.string()),
+        ('session_id', pa.string()),
+        ('properties', pa.string()),
+        ('timestamp', pa.timestamp('us', tz='UTC')),
+        ('created_at', pa.timestamp('us', tz='UTC')),
+        ('sample_weight', pa.float64()),
+    ])
+
+
+def parse_event_timestamp(value: Any) -> Optional[datetime]:
+    """Parse a timestamp as stored by SQLite into an aware UTC datetime"""
+    if value is None:
+        return None
+    if isinstance(value, datetime):
+        parsed = value
+    else:
+        parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc)
+
+
+class EventArchive:
+    """Day-partitioned, zstd-compressed Parquet archive of old analytics events.
+
+    Files are laid out as ``<archive_dir>/day=YYYY-MM-DD/events-<first_id>-<last_id>.parquet``
+    so queries can prune whole days from the partition key and skip row groups
+    from the Parquet statistics on ``timestamp``.
+
+    Only rows recorded in the ``archived_days`` table of the SQLite database are
+    read: a file whose rows were not yet deleted from ``events`` is left over from
+    an interrupted compaction and would count those events twice.
+    """
+
+    def __init__(self, archive_dir: str, db_path: str):
+        self.archive_dir = archive_dir
+        self.db_path = db_path
+
+    def committed_days(self) -> Dict[str, int]:
+        """Return the highest archived event id of every day whose compaction committed"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            return dict(conn.execute('SELECT day, max_id FROM archived_days').fetchall())
+        except sqlite3.OperationalError:
+            # The marker table is created with the rest of the schema by AnalyticsHandler
+            return {}
+        finally:
+            conn.close()
+
+    def has_data(self) -> bool:
+        """Return True if at least one day has been archived"""
+        return bool(self.committed_days())
+
+    def last_file_id(self, day: str) -> Optional[int]:
+        """Return the highest event id in the file names of a day, or None when it has no files"""
+        try:
+            names = os.listdir(os.path.join(self.archive_dir, f'day={day}'))
+        except FileNotFoundError:
+            return None
+        last_ids = [int(match.group(2)) for match in map(ARCHIVE_FILE_PATTERN.match, names) if match]
+        return max(last_ids) if last_ids else None
+
+    def write_day(self, day: str, rows: List[tuple]) -> str:
+        """Write one day of events (rows in ARCHIVE_COLUMNS order) and return the file path"""
+        pa = _import_pyarrow()
+        columns = list(zip(*rows))
+        columns[5] = [parse_event_timestamp(v) for v in columns[5]]
+        columns[6] = [parse_event_timestamp(v) for v in columns[6]]
+        table = pa.table(columns, schema=archive_schema(pa))
+        table = table.sort_by([('timestamp', 'ascending'), ('id', 'ascending')])
+
+        first_id, last_id = min(columns[0]), max(columns[0])
+        partition_dir = os.path.join(self.archive_dir, f'day={day}')
+        os.makedirs(partition_dir, exist_ok=True)
+        # Ids only grow, so an existing file overlapping this id range can only be left over
+        # from a compaction of this day that was interrupted before its delete committed
+        for name in os.listdir(partition_dir):
+            match = ARCHIVE_FILE_PATTERN.match(name)
+            if match and int(match.group(1)) <= last_id and int(match.group(2)) >= first_id:
+                os.remove(os.path.join(partition_dir, name))
+        path = os.path.join(partition_dir, f'events-{first_id}-{last_id}.parquet')
+        tmp_path = f'{path}.tmp'
+        pa.parquet.write_table(table, tmp_path, compression='zstd')
+        os.replace(tmp_path, path)
+        return path
+
+    def scan(self, columns: List[str], since: Optional[datetime] = None, event_names: Optional[List[str]] = None,
+             user_ids: Optional[List[str]] = None):
+        """Read archived events as a pyarrow Table, pushing the filters down to the scanner"""
+        pa = _import_pyarrow()
+        ds = pa.dataset
+        committed = self.committed_days()
+        filter_expr = None
+        if since is not None:
+            since_utc = since.astimezone(timezone.utc)
+            since_day = since_utc.strftime('%Y-%m-%d')
+            committed = {day: max_id for day, max_id in committed.items() if day >= since_day}
+            # Row-group pruning on the timestamp statistics
+            filter_expr = ds.field('timestamp') > since_utc
+        if not committed:
+            return archive_schema(pa).empty_table().select(columns)
+
+        partitioning = ds.partitioning(pa.schema([('day', pa.string())]), flavor='hive')
+        dataset = ds.dataset(self.archive_dir, format='parquet', partitioning=partitioning,
+                             schema=archive_schema(pa).append(pa.field('day', pa.string())))
+
+        # Partition pruning on the day key, keeping each day's rows up to its committed id
+        day_filter = None
+        for day, max_id in committed.items():
+            term = (ds.field('day') == day) & (ds.field('id') <= max_id)
+            day_filter = term if day_filter is None else day_filter | term
+        filter_expr = day_filter if filter_expr is None else filter_expr & day_filter
+        if event_names is not None:
+            name_filter = ds.field('event_name').isin(event_names)
+            filter_expr = name_filter if filter_expr is None else filter_expr & name_filter
+        if user_ids is not None:
+            user_filter = ds.field('user_id').isin(user_ids)
+            filter_expr = user_filter if filter_expr is None else filter_expr & user_filter
+        return dataset.to_table(columns=columns, filter=filter_expr)
+
+    def iter_days(self, columns: List[str], after_id: int = 0):
+        """Yield archived events one day at a time, oldest day first, each sorted by (timestamp, id)"""
+        pa = _import_pyarrow()
+        ds = pa.dataset
+        for day, max_id in sorted(self.committed_days().items()):
+            dataset = ds.dataset(os.path.join(self.archive_dir, f'day={day}'), format='parquet', schema=archive_schema(pa))
+            table = dataset.to_table(columns=columns, filter=(ds.field('id') > after_id) & (ds.field('id') <= max_id))
+            if table.num_rows:
+                yield table.sort_by([('timestamp', 'ascending'), ('id', 'ascending')])
+
+    def summarize(self, since: Optional[datetime] = None, count_events: bool = True) -> Dict[str, Any]:
+        """Compute the dashboard aggregates contributed by archived events.
+
+        With ``count_events=False`` only the user events are read and ``event_counts``
+        is left empty, for callers taking the counts from ``event_daily_rollups``.
+        """
+        pa = _import_pyarrow()
+        import pyarrow.compute as pc
+
+        event_names = None if count_events else ['resume_uploaded', 'analysis_completed']
+        table = self.scan(['event_name', 'user_id', 'sample_weight'], since=since, event_names=event_names)
+        # Counts are scaled back up by the sampling weights; files from before sampling have none
+        weights = pc.fill_null(table.column('sample_weight'), 1.0)
+        table = table.set_column(2, 'sample_weight', weights)
+        event_counts: Dict[str, float] = {}
+        if count_events:
+            for row in table.group_by('event_name').aggregate([('sample_weight', 'sum')]).to_pylist():
+                event_counts[row['event_name']] = row['sample_weight_sum']
+
+        def distinct_users(event_name: str) -> Dict[str, float]:
+            # Each user with the weight their rows were sampled with, 1 when unsampled
+            mask = pc.equal(table.column('event_name'), pa.scalar(event_name))
+            users = table.filter(mask).group_by('user_id').aggregate([('sample_weight', 'max')])
+            return dict(zip(users.column('user_id').to_pylist(), users.column('sample_weight_max').to_pylist()))
+
+        return {
+            'total_events': sum(event_counts.values()),
+            'event_counts': event_counts,
+            'users_uploaded': distinct_users('resume_uploaded'),
+            'users_analyzed': distinct_users('analysis_completed'),
+        }
+
+
+def compaction_cutoff(retention_days: int, now: Optional[datetime] = None) -> str:
+    """Return the first day (YYYY-MM-DD) that stays in the hot database"""
+    if retention_days < 1:
+        raise ValueError("retention_days must be at least 1 so the last 24 hours stay in the hot database")
+    now = now or datetime.now(timezone.utc)
+    return (now - timedelta(days=retention_days)).strftime('%Y-%m-%d')
+
+
+def compact_events(conn, archive: EventArchive, retention_days: int, vacuum: bool = False) -> Dict[str, Any]:
+    """Move events older than the retention horizon from SQLite into the archive.
+
+    Each day is archived and then, in a single transaction, deleted from ``events``
+    while its per-event-name counts (scaled by the sampling weights) are added to
+    ``event_daily_rollups`` and its highest archived id is recorded in ``archived_days``.
+    Readers only see archived rows up to that id, so a crash between the two steps
+    leaves events that are counted from ``events`` alone, in a file the next run
+    overwrites.
+    """
+    cutoff = compaction_cutoff(retention_days)
+    cursor = conn.cursor()
+    cursor.execute('''
+        SELECT DISTINCT substr(timestamp, 1, 10) AS day
+        FROM events
+        WHERE timestamp < ?
+        ORDER BY day
+    ''', (cutoff,))
+    days = [row[0] for row in cursor.fetchall()]
+
+    archived_count = 0
+    for day in days:
+        cursor.execute(f'''
+            SELECT {', '.join(ARCHIVE_COLUMNS)}
+            FROM events
+            WHERE timestamp >= ? AND timestamp < date(?, '+1 day')
+            ORDER BY id
+        ''', (day, day))
+        rows = cursor.fetchall()
+        if not rows:
+            continue
+        archive.write_day(day, rows)
+
+        max_id = max(row[0] for row in rows)
+        cursor.execute('''
+            INSERT INTO event_daily_rollups (day, event_name, events)
+            SELECT substr(timestamp, 1, 10), event_name, SUM(sample_weight)
+            FROM events
+            WHERE timestamp >= ? AND timestamp < date(?, '+1 day') AND id <= ?
+            GROUP BY event_name
+            ON CONFLICT(day, event_name) DO UPDATE SET events = events + excluded.events
+        ''', (day, day, max_id))
+        cursor.execute('''
+            INSERT INTO archived_days (day, max_id) VALUES (?, ?)
+            ON CONFLICT(day) DO UPDATE SET max_id = MAX(max_id, excluded.max_id)
+        ''', (day, max_id))
+        cursor.execute('''
+            DELETE FROM events
+            WHERE timestamp >= ? AND timestamp < date(?, '+1 day') AND id <= ?
+        ''', (day, day, max_id))
+        conn.commit()
+        archived_count += len(rows)
+        logger.info(f"Archived {len(rows)} analytics events for {day}")
+
+    if vacuum and archived_count:
+        conn.execute('VACUUM')
+
+    return {
+        'success': True,
+        'archived_count': archived_count,
+        'days': days,
+        'cutoff': cutoff
+    }
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Move old analytics events from SQLite into the Parquet archive.")
+    parser.add_argument("--db-path", default=os.getenv("ANALYTICS_DB_PATH", "analytics.db"), help="Analytics SQLite database")
+    parser.add_argument("--archive-dir", default=os.getenv("ANALYTICS_ARCHIVE_DIR"), help="Directory for the Parquet archive")
+    parser.add_argument(
+        "--retention-days",
+        type=int,
+        default=int(os.getenv("ANALYTICS_RETENTION_DAYS", "30")),
+        help="Days of events to keep in the hot database",
+    )
+    parser.add_argument("--vacuum", action="store_true", help="VACUUM the database after archiving")
+    args = parser.parse_args()
+
+    if not args.archive_dir:
+        parser.error("--archive-dir or ANALYTICS_ARCHIVE_DIR is required")
+
+    from analytics_handler import AnalyticsHandler
+
+    handler = AnalyticsHandler(db_path=args.db_path, archive_dir=args.archive_dir, retention_days=args.retention_days)
+    print(handler.compact_events(vacuum=args.vacuum))
@@ -0,0 +1,491 @@
+import logging
+import os
+import sqlite3
+import time
+from abc import ABC
+from collections import Counter
+from collections.abc import Iterable, Iterator
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Any, Optional
+
+from analytics_archive import EventArchive, _import_pyarrow, parse_event_timestamp
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+FETCH_SIZE = 10000
+# DuckDB connections are short-lived, so one finding the file locked by another waits for it
+DUCKDB_CONNECT_ATTEMPTS = 20
+DUCKDB_CONNECT_RETRY_SECONDS = 0.1
+# Stays well below SQLite's bound parameter limit
+USER_BATCH_SIZE = 500
+SYNC_BATCH_SIZE = 100000
+
+# Event names behind the upload -> analysis conversion metrics
+UPLOAD_EVENT = 'resume_uploaded'
+ANALYSIS_EVENT = 'analysis_completed'
+
+
+def distinct_users_sql(time_filter: str, event_name: str) -> str:
+    """
+    Estimated number of distinct users with the event: each user counts for the weight their rows were
+    sampled with, which is exact without sampling and unbiased under per-user sampling
+    """
+    return f'''
+        SELECT COALESCE(SUM(weight), 0) FROM (
+            SELECT MAX(sample_weight) AS weight FROM events
+            WHERE {time_filter} AND event_name = '{event_name}'
+            GROUP BY user_id
+        )
+    '''
+
+
+class AnalyticsBackend(ABC):
+    """
+    Storage backend that answers the analytical queries over the event data.
+    Events are always ingested into the SQLite database; a backend decides how they are scanned.
+    """
+
+    def dashboard_metrics(self, days: Optional[int]) -> Dict[str, Any]:
+        """
+        Aggregates for the dashboard over the last ``days`` days (all time when None):
+        basic (users, sessions, events), popular [(event, count)], conversion
+        (uploads, analyses, users uploaded, users analyzed) and hourly [(hour, count)] for the last 24 hours
+        """
+        raise NotImplementedError
+
+    def iter_events(self, after_id: int = 0) -> Iterator[tuple]:
+        """Yield (id, user_id, event_name, epoch seconds) for events after after_id, in time order"""
+        raise NotImplementedError
+
+    def iter_user_events(self, user_ids: Iterable[str]) -> Iterator[tuple]:
+        """Yield (id, user_id, event_name, epoch seconds) for every event of the given users"""
+        raise NotImplementedError
+
+    def sync(self, rebuild: bool = False) -> int:
+        """Bring the backend's copy of the events up to date, returning how many were added"""
+        return 0
+
+
+class SQLiteBackend(AnalyticsBackend):
+    """
+    Row-store backend reading the SQLite events table, plus the Parquet archive when one is configured
+    """
+
+    def __init__(self, db_path: str, archive: Optional[EventArchive] = None):
+        self.db_path = db_path
+        self.archive = archive
+
+    def dashboard_metrics(self, days: Optional[int]) -> Dict[str, Any]:
+        time_filter = f"timestamp > datetime('now', '-{days} days')" if days else "1=1"
+        session_filter = f"COALESCE(end_time, start_time) > datetime('now', '-{days} days')" if days else "1=1"
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.cursor()
+
+            # Users and sessions come from user_sessions, which sees every event before sampling;
+            # a session has an event in the window exactly when it ends inside it
+            cursor.execute(f'''
+                SELECT
+                    COUNT(DISTINCT user_id) as unique_users,
+                    COUNT(*) as sessions
+                FROM user_sessions
+                WHERE {session_filter}
+            ''')
+            unique_users, sessions = cursor.fetchone()
+
+            # Event counts are scaled back up by the sampling weights
+            cursor.execute(f'''
+                SELECT COALESCE(SUM(sample_weight), 0) as total_events
+                FROM events
+                WHERE {time_filter}
+            ''')
+            basic_metrics = (unique_users, sessions, cursor.fetchone()[0])
+
+            # Get popular events
+            cursor.execute(f'''
+                SELECT event_name, SUM(sample_weight) as count
+                FROM events
+                WHERE {time_filter}
+                GROUP BY event_name
+                ORDER BY count DESC
+                LIMIT 10
+            ''')
+            popular_events = cursor.fetchall()
+
+            # Get conversion metrics
+            cursor.execute(f'''
+                SELECT
+                    SUM(CASE WHEN event_name = '{UPLOAD_EVENT}' THEN sample_weight ELSE 0 END) as resumes_uploaded,
+                    SUM(CASE WHEN event_name = '{ANALYSIS_EVENT}' THEN sample_weight ELSE 0 END) as analyses_completed,
+                    ({distinct_users_sql(time_filter, UPLOAD_EVENT)}) as users_uploaded,
+                    ({distinct_users_sql(time_filter, ANALYSIS_EVENT)}) as users_analyzed
+                FROM events
+                WHERE {time_filter}
+            ''')
+            conversion_metrics = cursor.fetchone()
+
+            # Merge in archived events when the requested window reaches back into the archive
+            since = datetime.now(timezone.utc) - timedelta(days=days) if days else None
+            if self.archive and self._reaches_archive(cursor, since) and self.archive.has_data():
+                popular_events, total_events, conversion_metrics = self._merge_archive_metrics(
+                    cursor, time_filter, since
+                )
+                basic_metrics = (unique_users, sessions, total_events)
+
+            # Get hourly activity (last 24 hours)
+            cursor.execute('''
+                SELECT
+                    strftime('%H', timestamp) as hour,
+                    SUM(sample_weight) as events_count
+                FROM events
+                WHERE timestamp > datetime('now', '-1 day')
+                GROUP BY hour
+                ORDER BY hour
+            ''')
+            hourly_activity = cursor.fetchall()
+        finally:
+            conn.close()
+
+        return {
+            'basic': basic_metrics,
+            'popular': popular_events,
+            'conversion': conversion_metrics,
+            'hourly': hourly_activity
+        }
+
+    @staticmethod
+    def _reaches_archive(cursor, since: Optional[datetime]) -> bool:
+        """Return True if a window starting at ``since`` begins before the oldest hot event"""
+        if since is None:
+            return True
+        # Served by idx_events_timestamp
+        cursor.execute('SELECT MIN(timestamp) FROM events')
+        oldest = cursor.fetchone()[0]
+        return oldest is None or since < parse_event_timestamp(oldest)
+
+    def _merge_archive_metrics(self, cursor, time_filter: str, since: Optional[datetime]):
+        """Recompute the event aggregates over hot events plus archived events"""
+        # All-time event counts come from the daily rollups, only distinct users need the archive
+        summary = self.archive.summarize(since, count_events=since is not None)
+        if since is None:
+            cursor.execute('SELECT event_name, SUM(events) FROM event_daily_rollups GROUP BY event_name')
+            summary['event_counts'] = dict(cursor.fetchall())
+
+        def distinct_users(event_name: str, archived: Dict[str, float]) -> float:
+            cursor.execute(f'''
+                SELECT user_id, MAX(sample_weight)
+                FROM events
+                WHERE {time_filter} AND event_name = ?
+                GROUP BY user_id
+            ''', (event_name,))
+            users = dict(archived)
+            for user_id, weight in cursor.fetchall():
+                users[user_id] = max(weight, users.get(user_id, 0))
+            return sum(users.values())
+
+        users_uploaded = distinct_users(UPLOAD_EVENT, summary['users_uploaded'])
+        users_analyzed = distinct_users(ANALYSIS_EVENT, summary['users_analyzed'])
+
+        event_counts = Counter(summary['event_counts'])
+        cursor.execute(f'SELECT event_name, SUM(sample_weight) FROM events WHERE {time_filter} GROUP BY event_name')
+        for event_name, count in cursor.fetchall():
+            event_counts[event_name] += count
+
+        popular_events = event_counts.most_common(10)
+        conversion_metrics = (
+            event_counts[UPLOAD_EVENT],
+            event_counts[ANALYSIS_EVENT],
+            users_uploaded,
+            users_analyzed
+        )
+        return popular_events, sum(event_counts.values()), conversion_metrics
+
+    def iter_events(self, after_id: int = 0) -> Iterator[tuple]:
+        # Archived events are all older than the hot table, so reading them first keeps time order
+        if self.archive is not None:
+            for table in self.archive.iter_days(['id', 'user_id', 'event_name', 'timestamp'], after_id):
+                ids = table.column('id').to_pylist()
+                users = table.column('user_id').to_pylist()
+                names = table.column('event_name').to_pylist()
+                timestamps = [ts.timestamp() for ts in table.column('timestamp').to_pylist()]
+                yield from zip(ids, users, names, timestamps)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            cursor = conn.execute('''
+                SELECT id, user_id, event_name, (julianday(timestamp) - 2440587.5) * 86400.0
+                FROM events
+                WHERE id > ?
+                ORDER BY timestamp, id
+            ''', (after_id,))
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def iter_user_events(self, user_ids: Iterable[str]) -> Iterator[tuple]:
+        user_ids = list(user_ids)
+        if self.archive is not None and self.archive.has_data():
+            table = self.archive.scan(['id', 'user_id', 'event_name', 'timestamp'], user_ids=user_ids)
+            timestamps = [ts.timestamp() for ts in table.column('timestamp').to_pylist()]
+            yield from zip(table.column('id').to_pylist(), table.column('user_id').to_pylist(),
+                           table.column('event_name').to_pylist(), timestamps)
+
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for start in range(0, len(user_ids), USER_BATCH_SIZE):
+                batch = user_ids[start:start + USER_BATCH_SIZE]
+                # Served by the (user_id, timestamp, id, event_name) covering index
+                yield from conn.execute(f'''
+                    SELECT id, user_id, event_name, (julianday(timestamp) - 2440587.5) * 86400.0
+                    FROM events
+                    WHERE user_id IN ({', '.join('?' * len(batch))})
+                ''', batch)
+        finally:
+            conn.close()
+
+
+def _import_duckdb():
+    """Import duckdb lazily so it is only required when the columnar backend is selected"""
+    try:
+        import duckdb
+    except ImportError as e:
+        raise RuntimeError("The duckdb analytics backend requires duckdb (pip install duckdb)") from e
+    return duckdb
+
+
+class DuckDBBackend(AnalyticsBackend):
+    """
+    Columnar backend answering queries with DuckDB's vectorized engine.
+
+    DuckDB keeps a full-history copy of the events (timestamps as naive UTC) in its own file.
+    ``sync`` appends whatever was ingested since its highest event id, reading the Parquet archive
+    first so events compacted out of SQLite before they were synced are not lost.
+
+    A DuckDB file has a single writer, so queries only open it read-only and never sync. Syncing
+    runs from the CLI below on a schedule, or from the handler's background sync
+    (ANALYTICS_BACKEND_SYNC_INTERVAL) enabled in a single process.
+    """
+
+    def __init__(self, db_path: str, duckdb_path: str, archive: Optional[EventArchive] = None):
+        self.db_path = db_path
+        self.duckdb_path = duckdb_path
+        self.archive = archive
+
+    def connect(self, read_only: bool = False):
+        duckdb = _import_duckdb()
+        if read_only and not os.path.exists(self.duckdb_path):
+            raise RuntimeError(
+                f"The DuckDB analytics database {self.duckdb_path} doesn't exist yet, sync it first "
+                "(python analytics_backends.py or ANALYTICS_BACKEND_SYNC_INTERVAL)"
+            )
+        for attempt in range(DUCKDB_CONNECT_ATTEMPTS):
+            try:
+                conn = duckdb.connect(self.duckdb_path, read_only=read_only)
+                break
+            except (duckdb.IOException, duckdb.ConnectionException):
+                # Locked by the syncing process, or by a connection of this process opened the other way
+                if attempt == DUCKDB_CONNECT_ATTEMPTS - 1:
+                    raise
+                time.sleep(DUCKDB_CONNECT_RETRY_SECONDS)
+        if read_only:
+            return conn
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS events (
+                id BIGINT PRIMARY KEY,
+                event_name VARCHAR NOT NULL,
+                user_id VARCHAR NOT NULL,
+                session_id VARCHAR NOT NULL,
+                timestamp TIMESTAMP
+            )
+        ''')
+        conn.execute('ALTER TABLE events ADD COLUMN IF NOT EXISTS sample_weight DOUBLE DEFAULT 1')
+        return conn
+
+    def sync(self, rebuild: bool = False) -> int:
+        """Copy events not yet in DuckDB from the archive and SQLite, returning how many were added"""
+        pa = _import_pyarrow()
+        conn = self.connect()
+        try:
+            if rebuild:
+                conn.execute('DELETE FROM events')
+            after_id = conn.execute('SELECT COALESCE(MAX(id), 0) FROM events').fetchone()[0]
+            added = 0
+
+            if self.archive is not None:
+                columns = ['id', 'event_name', 'user_id', 'session_id', 'timestamp', 'sample_weight']
+                for table in self.archive.iter_days(columns, after_id):
+                    table = table.set_column(4, 'timestamp', table.column('timestamp').cast(pa.timestamp('us')))
+                    table = table.set_column(5, 'sample_weight', table.column('sample_weight').fill_null(1.0))
+                    added += self._append(conn, table)
+
+            source = sqlite3.connect(self.db_path)
+            try:
+                cursor = source.execute('''
+                    SELECT id, event_name, user_id, session_id, timestamp, sample_weight
+                    FROM events
+                    WHERE id > ?
+                    ORDER BY id
+                ''', (after_id,))
+                while True:
+                    rows = cursor.fetchmany(SYNC_BATCH_SIZE)
+                    if not rows:
+                        break
+                    columns = list(zip(*rows))
+                    table = pa.table({
+                        'id': pa.array(columns[0], type=pa.int64()),
+                        'event_name': pa.array(columns[1], type=pa.string()),
+                        'user_id': pa.array(columns[2], type=pa.string()),
+                        'session_id': pa.array(columns[3], type=pa.string()),
+                        'timestamp': pa.array([_naive_utc(value) for value in columns[4]], type=pa.timestamp('us')),
+                        'sample_weight': pa.array(columns[5], type=pa.float64()),
+                    })
+                    added += self._append(conn, table)
+            finally:
+                source.close()
+            return added
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _append(conn, table) -> int:
+        conn.register('new_events', table)
+        try:
+            # Rows already copied (an archive file overlapping a previous sync) are skipped
+            inserted = conn.execute('''
+                INSERT INTO events (id, event_name, user_id, session_id, timestamp, sample_weight)
+                SELECT id, event_name, user_id, session_id, timestamp, sample_weight FROM new_events
+                ON CONFLICT DO NOTHING
+            ''').fetchone()[0]
+        finally:
+            conn.unregister('new_events')
+        return inserted
+
+    def dashboard_metrics(self, days: Optional[int]) -> Dict[str, Any]:
+        now = datetime.now(timezone.utc).replace(tzinfo=None)
+        since = now - timedelta(days=days) if days else datetime.min
+        conn = self.connect(read_only=True)
+        try:
+            total_events = conn.execute('''
+                SELECT COALESCE(SUM(sample_weight), 0)
+                FROM events
+                WHERE timestamp > ?
+            ''', [since]).fetchone()[0]
+            popular_events = conn.execute('''
+                SELECT event_name, SUM(sample_weight) AS count
+                FROM events
+                WHERE timestamp > ?
+                GROUP BY event_name
+                ORDER BY count DESC
+                LIMIT 10
+            ''', [since]).fetchall()
+            conversion_metrics = conn.execute(f'''
+                SELECT
+                    SUM(sample_weight) FILTER (WHERE event_name = $event_uploaded),
+                    SUM(sample_weight) FILTER (WHERE event_name = $event_analyzed),
+                    ({distinct_users_sql('timestamp > $since', UPLOAD_EVENT)}),
+                    ({distinct_users_sql('timestamp > $since', ANALYSIS_EVENT)})
+                FROM events
+                WHERE timestamp > $since
+            ''', {'event_uploaded': UPLOAD_EVENT, 'event_analyzed': ANALYSIS_EVENT, 'since': since}).fetchone()
+            hourly_activity = conn.execute('''
+                SELECT strftime(timestamp, '%H') AS hour, SUM(sample_weight) AS events_count
+                FROM events
+                WHERE timestamp > ?
+                GROUP BY hour
+                ORDER BY hour
+            ''', [now - timedelta(days=1)]).fetchall()
+        finally:
+            conn.close()
+
+        # Sessions are not mirrored, they are read from SQLite where the sessionizer keeps them exact
+        source = sqlite3.connect(self.db_path)
+        try:
+            unique_users, sessions = source.execute('''
+                SELECT COUNT(DISTINCT user_id), COUNT(*)
+                FROM user_sessions
+                WHERE COALESCE(end_time, start_time) > ?
+            ''', (since.strftime('%Y-%m-%d %H:%M:%S') if days else '',)).fetchone()
+        finally:
+            source.close()
+
+        return {
+            'basic': (unique_users, sessions, total_events),
+            'popular': popular_events,
+            'conversion': conversion_metrics,
+            'hourly': hourly_activity
+        }
+
+    def iter_events(self, after_id: int = 0) -> Iterator[tuple]:
+        conn = self.connect(read_only=True)
+        try:
+            cursor = conn.execute('''
+                SELECT id, user_id, event_name, epoch_us(timestamp) / 1000000.0
+                FROM events
+                WHERE id > ?
+                ORDER BY timestamp, id
+            ''', [after_id])
+            while True:
+                rows = cursor.fetchmany(FETCH_SIZE)
+                if not rows:
+                    break
+                yield from rows
+        finally:
+            conn.close()
+
+    def iter_user_events(self, user_ids: Iterable[str]) -> Iterator[tuple]:
+        user_ids = list(user_ids)
+        conn = self.connect(read_only=True)
+        try:
+            for start in range(0, len(user_ids), USER_BATCH_SIZE):
+                batch = user_ids[start:start + USER_BATCH_SIZE]
+                yield from conn.execute(f'''
+                    SELECT id, user_id, event_name, epoch_us(timestamp) / 1000000.0
+                    FROM events
+                    WHERE user_id IN ({', '.join('?' * len(batch))})
+                ''', batch).fetchall()
+        finally:
+            conn.close()
+
+
+def _naive_utc(value: Any) -> Optional[datetime]:
+    if value is None:
+        return None
+    parsed = datetime.fromisoformat(str(value))
+    if parsed.tzinfo is not None:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+
+ANALYTICS_BACKENDS = ('sqlite', 'duckdb')
+
+
+def create_backend(name: str, db_path: str, archive: Optional[EventArchive] = None,
+                   duckdb_path: Optional[str] = None) -> AnalyticsBackend:
+    """Create the analytics backend selected by name"""
+    if name == 'sqlite':
+        return SQLiteBackend(db_path, archive)
+    if name == 'duckdb':
+        return DuckDBBackend(db_path, duckdb_path or os.path.splitext(db_path)[0] + '.duckdb', archive)
+    raise ValueError(f"Unknown analytics backend '{name}', expected one of {', '.join(ANALYTICS_BACKENDS)}")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Backfill the DuckDB analytics backend from SQLite and the Parquet archive.")
+    parser.add_argument("--db-path", default=os.getenv("ANALYTICS_DB_PATH", "analytics.db"), help="Analytics SQLite database")
+    parser.add_argument("--archive-dir", default=os.getenv("ANALYTICS_ARCHIVE_DIR"), help="Directory of the Parquet archive")
+    parser.add_argument("--duckdb-path", default=os.getenv("ANALYTICS_DUCKDB_PATH"), help="DuckDB database to fill")
+    parser.add_argument("--rebuild", action="store_true", help="Drop the events already in DuckDB and copy everything again")
+    args = parser.parse_args()
+
+    archive = EventArchive(args.archive_dir, args.db_path) if args.archive_dir else None
+    backend = create_backend('duckdb', args.db_path, archive, args.duckdb_path)
+    added = backend.sync(rebuild=args.rebuild)
+    logger.info(f"Copied {added} analytics events into {backend.duckdb_path}")
@@ -0,0 +1,228 @@
+"""
+Synthetic-load benchmark for the analytics subsystem.
+
+Generates a time-ordered stream of sessions for a population of users, drives
+AnalyticsHandler.process_events, get_analytics_dashboard and get_user_insights
+against a temporary database, and prints a JSON report so runs can be compared:
+
+    python analytics_benchmark.py --events 1000000 --users 20000 --sessions 100000 --output run.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+from collections.abc import Iterator
+from typing import Dict, List, Any, Optional
+
+DEFAULT_EVENT_MIX = 'page_viewed=60,feature_usage=20,resume_uploaded=8,analysis_completed=7,scroll_depth=5'
+FEATURES = ['python', 'sql', 'react', 'azure', 'docker', 'kubernetes', 'machine-learning', 'typescript']
+PAGES = ['/', '/upload', '/analysis', '/jobs', '/interview', '/profile']
+TIME_RANGES = ['24h', '7d', '30d', 'all']
+
+
+def parse_event_mix(spec: str) -> Dict[str, float]:
+    """Parse ``event=weight`` pairs separated by commas"""
+    mix = {}
+    for entry in spec.split(','):
+        if not entry.strip():
+            continue
+        name, _, weight = entry.partition('=')
+        mix[name.strip()] = float(weight or 1)
+    if not mix:
+        raise ValueError("The event mix needs at least one event")
+    return mix
+
+
+def generate_batches(events: int, users: int, sessions: int, spread_days: float, event_mix: Dict[str, float],
+                     batch_size: int, seed: int = 0) -> Iterator[List[Dict[str, Any]]]:
+    """Yield batches of tracker-shaped events, one session after another in start-time order"""
+    rng = random.Random(seed)
+    names = list(event_mix)
+    cumulative_weights = []
+    total = 0.0
+    for name in names:
+        total += event_mix[name]
+        cumulative_weights.append(total)
+
+    end_ms = time.time() * 1000
+    start_ms = end_ms - spread_days * 86400 * 1000
+    session_step_ms = (end_ms - start_ms) / max(sessions, 1)
+    mean_events_per_session = max(events / max(sessions, 1), 1.0)
+
+    batch: List[Dict[str, Any]] = []
+    produced = 0
+    session = 0
+    while produced < events:
+        user_id = f'user-{rng.randrange(users)}'
+        session_id = f'session-{session}'
+        timestamp = start_ms + (session % max(sessions, 1)) * session_step_ms + rng.random() * session_step_ms
+        session_events = min(events - produced, 1 + int(rng.expovariate(1 / mean_events_per_session)))
+        session += 1
+
+        for _ in range(session_events):
+            event_name = rng.choices(names, cum_weights=cumulative_weights)[0]
+            properties: Dict[str, Any] = {'sessionId': session_id, 'page': rng.choice(PAGES)}
+            if event_name == 'analysis_completed':
+                properties['matchScore'] = rng.randint(40, 100)
+            elif event_name == 'feature_usage':
+                properties['feature'] = rng.choice(FEATURES)
+            batch.append({
+                'event': event_name,
+                'userId': user_id,
+                'properties': properties,
+                'timestamp': min(timestamp, end_ms)
+            })
+            timestamp += rng.expovariate(1 / 20000)  # ~20s between events of a session
+            produced += 1
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def percentile(samples: List[float], pct: float) -> Optional[float]:
+    """Nearest-rank percentile"""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = max(1, math.ceil(pct / 100 * len(ordered)))
+    return ordered[rank - 1]
+
+
+def latency_summary(samples: List[float]) -> Dict[str, Any]:
+    return {
+        'count': len(samples),
+        'p50_ms': round(percentile(samples, 50) * 1000, 3) if samples else None,
+        'p99_ms': round(percentile(samples, 99) * 1000, 3) if samples else None,
+        'max_ms': round(max(samples) * 1000, 3) if samples else None,
+    }
+
+
+def database_size(db_path: str) -> int:
+    return sum(os.path.getsize(path) for path in (db_path, f'{db_path}-wal', f'{db_path}-shm') if os.path.exists(path))
+
+
+def peak_rss_bytes() -> int:
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+async def run_benchmark(args, work_dir: str) -> Dict[str, Any]:
+    db_path = os.path.join(work_dir, 'analytics.db')
+    # The handler module builds its global instance at import, keep it inside the work directory too
+    os.environ['ANALYTICS_DB_PATH'] = db_path
+    from analytics_handler import AnalyticsHandler
+
+    handler = AnalyticsHandler(
+        db_path=db_path,
+        backend=args.backend,
+        duckdb_path=os.path.join(work_dir, 'analytics.duckdb'),
+        sampling=args.sampling
+    )
+
+    batch_latencies = []
+    ingested = 0
+    started = time.perf_counter()
+    batches = generate_batches(args.events, args.users, args.sessions, args.spread_days,
+                               parse_event_mix(args.event_mix), args.batch_size, args.seed)
+    for batch in batches:
+        batch_started = time.perf_counter()
+        result = await handler.process_events(batch)
+        batch_latencies.append(time.perf_counter() - batch_started)
+        if not result.get('success'):
+            raise RuntimeError(f"process_events failed: {result.get('error')}")
+        ingested += result['processed_count']
+    ingest_seconds = time.perf_counter() - started
+
+    # Query backends only read what a sync has copied over, as the scheduled sync does in the app
+    sync_started = time.perf_counter()
+    synced = handler.sync_backend()
+    sync_seconds = time.perf_counter() - sync_started
+
+    dashboard_latencies: Dict[str, List[float]] = {time_range: [] for time_range in TIME_RANGES}
+    for _ in range(args.queries):
+        for time_range in TIME_RANGES:
+            # Measure the computation, not the watermark cache
+            handler.dashboard_cache.clear()
+            query_started = time.perf_counter()
+            handler.get_analytics_dashboard(time_range)
+            dashboard_latencies[time_range].append(time.perf_counter() - query_started)
+
+    rng = random.Random(args.seed + 1)
+    insights_latencies = []
+    for _ in range(args.queries):
+        query_started = time.perf_counter()
+        handler.get_user_insights(f'user-{rng.randrange(args.users)}')
+        insights_latencies.append(time.perf_counter() - query_started)
+
+    return {
+        'config': {
+            'events': args.events,
+            'users': args.users,
+            'sessions': args.sessions,
+            'spread_days': args.spread_days,
+            'event_mix': args.event_mix,
+            'batch_size': args.batch_size,
+            'queries': args.queries,
+            'backend': args.backend,
+            'sampling': args.sampling,
+            'seed': args.seed,
+        },
+        'ingest': {
+            'events': ingested,
+            'seconds': round(ingest_seconds, 3),
+            'events_per_second': round(ingested / ingest_seconds, 1) if ingest_seconds else None,
+            'batch_latency': latency_summary(batch_latencies),
+        },
+        'backend_sync': {
+            'events': synced,
+            'seconds': round(sync_seconds, 3),
+        },
+        'dashboard_latency': {time_range: latency_summary(samples) for time_range, samples in dashboard_latencies.items()},
+        'user_insights_latency': latency_summary(insights_latencies),
+        'db_size_bytes': database_size(db_path),
+        'peak_rss_bytes': peak_rss_bytes(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark AnalyticsHandler against a synthetic event stream.")
+    parser.add_argument("--events", type=int, default=1_000_000, help="Number of events to ingest")
+    parser.add_argument("--users", type=int, default=20_000, help="Number of distinct users")
+    parser.add_argument("--sessions", type=int, default=100_000, help="Number of sessions the events are spread over")
+    parser.add_argument("--spread-days", type=float, default=30, help="Days of history the events cover, ending now")
+    parser.add_argument("--event-mix", default=DEFAULT_EVENT_MIX, help="Relative event frequencies as event=weight,...")
+    parser.add_argument("--batch-size", type=int, default=500, help="Events per process_events call")
+    parser.add_argument("--queries", type=int, default=20, help="Repetitions of each dashboard range and user insights lookups")
+    parser.add_argument("--backend", default="sqlite", help="Analytics backend to benchmark (sqlite or duckdb)")
+    parser.add_argument("--sampling", default=None, help="Sampling policies, as for ANALYTICS_SAMPLING")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic stream")
+    parser.add_argument("--work-dir", default=None, help="Keep the databases in this directory instead of a temporary one")
+    parser.add_argument("--output", default=None, help="Write the JSON report to this file instead of stdout")
+    args = parser.parse_args()
+
+    if args.work_dir:
+        os.makedirs(args.work_dir, exist_ok=True)
+        report = asyncio.run(run_benchmark(args, args.work_dir))
+    else:
+        with tempfile.TemporaryDirectory(prefix='analytics-bench-') as work_dir:
+            report = asyncio.run(run_benchmark(args, work_dir))
+
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == "__main__":
+    main()
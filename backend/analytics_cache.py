@@ -0,0 +1,117 @@
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+
+class CacheEntry:
+    """A computed result together with the ingestion watermark it was computed at"""
+
+    def __init__(self, watermark: Optional[int], result: Dict[str, Any], computed_at: float):
+        self.watermark = watermark
+        self.result = result
+        self.computed_at = computed_at
+
+
+class WatermarkCache:
+    """Result cache keyed by ``(key, last_ingested_event_id)``.
+
+    A cached result is served as long as the ingestion watermark has not moved.
+    ``max_staleness`` lets a result younger than that many seconds be served
+    without even reading the watermark. When the watermark has moved but the
+    result is younger than ``stale_while_revalidate`` seconds, the stale result
+    is returned and recomputed on a background thread. ``max_age`` bounds how
+    long any result lives, because relative windows such as '24h' drift even
+    when nothing new is ingested.
+    """
+
+    def __init__(self, max_staleness: float = 0.0, stale_while_revalidate: float = 0.0, max_age: float = 300.0):
+        self.max_staleness = max_staleness
+        self.stale_while_revalidate = stale_while_revalidate
+        self.max_age = max_age
+        self._entries: Dict[Hashable, CacheEntry] = {}
+        self._refreshing: Set[Hashable] = set()
+        # Bumped by clear(), so a computation started before it does not store its result afterwards
+        self._generation = 0
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def get(
+        self,
+        key: Hashable,
+        read_watermark: Callable[[], Optional[int]],
+        compute: Callable[[], Dict[str, Any]],
+    ) -> Dict[str, Any]:
+        """Return the cached result for key, recomputing it when the watermark has advanced"""
+        with self._lock:
+            entry = self._entries.get(key)
+        now = time.monotonic()
+        age = now - entry.computed_at if entry else None
+
+        if entry and age <= min(self.max_staleness, self.max_age):
+            return entry.result
+
+        watermark = read_watermark()
+        if entry and age <= self.max_age:
+            if entry.watermark == watermark:
+                return entry.result
+            if age <= self.stale_while_revalidate:
+                self._refresh_in_background(key, read_watermark, compute)
+                return entry.result
+
+        return self._compute(key, watermark, compute)
+
+    def clear(self):
+        """Drop every cached result"""
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def _compute(
+        self,
+        key: Hashable,
+        watermark: Optional[int],
+        compute: Callable[[], Dict[str, Any]],
+        generation: Optional[int] = None,
+    ) -> Dict[str, Any]:
+        computed_at = time.monotonic()
+        if generation is None:
+            with self._lock:
+                generation = self._generation
+        result = compute()
+        # Errors are returned as results by the handler, never cache them
+        if result.get('success'):
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[key] = CacheEntry(watermark, result, computed_at)
+        return result
+
+    def _refresh_in_background(
+        self,
+        key: Hashable,
+        read_watermark: Callable[[], Optional[int]],
+        compute: Callable[[], Dict[str, Any]],
+    ):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+            generation = self._generation
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analytics-cache")
+
+        def refresh():
+            try:
+                self._compute(key, read_watermark(), compute, generation)
+            except Exception as e:
+                logger.error(f"Error refreshing cached result for {key}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._executor.submit(refresh)
@@ -0,0 +1,388 @@
+import base64
+import json
+import logging
+import sqlite3
+import sys
+import threading
+from array import array
+from collections import defaultdict
+from collections.abc import Callable, Iterable, Iterator
+from datetime import datetime, timezone
+from typing import Dict, List, Any, Optional, Set, Tuple
+
+from analytics_sampling import EventSampler
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# 1970-01-05 was a Monday, so weekly periods start on Mondays
+PERIOD_ORIGIN = 4 * 86400
+
+# Time-ordered event stream: (id, user_id, event_name, epoch seconds)
+EventRow = Tuple[int, str, str, float]
+
+# Every event of the given users, ordered by user then time
+UserHistory = Callable[[Iterable[str]], Iterator[EventRow]]
+
+# Version of the JSON layout of materialized states; states stored in another layout are rebuilt
+STATE_VERSION = 2
+
+
+def pack_array(values: array) -> str:
+    """Encode an array as base64 of its little-endian bytes"""
+    if sys.byteorder == 'big':
+        values = array(values.typecode, values)
+        values.byteswap()
+    return base64.b64encode(values.tobytes()).decode('ascii')
+
+
+def unpack_array(typecode: str, data: str) -> array:
+    values = array(typecode)
+    values.frombytes(base64.b64decode(data))
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def group_by_user(rows: Iterator[EventRow]) -> Dict[str, List[EventRow]]:
+    """Events of each user, in time order"""
+    events: Dict[str, List[EventRow]] = defaultdict(list)
+    seen: Set[int] = set()
+    for row in rows:
+        if row[0] not in seen:
+            seen.add(row[0])
+            events[row[1]].append(row)
+    for user_events in events.values():
+        user_events.sort(key=lambda row: (row[3], row[0]))
+    return events
+
+
+class UserIndex:
+    """Compact integer encoding of user ids, so per-user state lives in flat arrays"""
+
+    def __init__(self, ids: Optional[Dict[str, int]] = None):
+        self.ids: Dict[str, int] = ids or {}
+
+    def to_list(self) -> List[str]:
+        """User ids in code order"""
+        return sorted(self.ids, key=self.ids.__getitem__)
+
+    @classmethod
+    def from_list(cls, user_ids: List[str]) -> 'UserIndex':
+        return cls({user_id: code for code, user_id in enumerate(user_ids)})
+
+    def encode(self, user_id: str) -> Tuple[int, bool]:
+        """Return the user's integer id and whether it was just assigned"""
+        code = self.ids.get(user_id)
+        if code is not None:
+            return code, False
+        code = len(self.ids)
+        self.ids[user_id] = code
+        return code, True
+
+
+class FunnelState:
+    """Per-user state machines for an ordered-step funnel.
+
+    A user advances one step when the next step's event arrives; with a
+    conversion window, an attempt that has not completed within the window
+    starts over at the next occurrence of the first step. ``reached[k]`` is the
+    number of users that ever reached step k.
+
+    Event timestamps come from clients, so an event can be ingested after
+    later ones of the same user. Such a user is replayed from their full
+    history instead of advancing out of order.
+    """
+
+    def __init__(self, steps: List[str], window_seconds: Optional[float] = None):
+        self.steps = steps
+        self.window_seconds = window_seconds
+        self.users = UserIndex()
+        self.current_step = array('h')
+        self.best_step = array('h')
+        self.attempt_start = array('d')
+        self.last_seen = array('d')
+        self.reached = [0] * len(steps)
+        self.watermark = 0
+        self._step_names = set(steps)
+
+    def update(self, rows: Iterator[EventRow], history: UserHistory):
+        late: Set[str] = set()
+        for event_id, user_id, event_name, ts in rows:
+            if event_id > self.watermark:
+                self.watermark = event_id
+            if event_name not in self._step_names or user_id in late:
+                continue
+            user, is_new = self.users.encode(user_id)
+            if is_new:
+                self.current_step.append(-1)
+                self.best_step.append(-1)
+                self.attempt_start.append(0.0)
+                self.last_seen.append(ts)
+            elif ts < self.last_seen[user]:
+                late.add(user_id)
+                continue
+            self._advance(user, event_name, ts)
+        if late:
+            logger.info(f"Replaying {len(late)} users of funnel {self.steps} after late events")
+            for user_id, user_events in group_by_user(history(late)).items():
+                self._replay(self.users.ids[user_id], user_events)
+
+    def _advance(self, user: int, event_name: str, ts: float):
+        steps = self.steps
+        step = self.current_step[user]
+        if self.window_seconds is not None and step >= 0 and ts - self.attempt_start[user] > self.window_seconds:
+            step = -1
+        if step + 1 < len(steps) and event_name == steps[step + 1]:
+            step += 1
+            if step == 0:
+                self.attempt_start[user] = ts
+            if step > self.best_step[user]:
+                self.best_step[user] = step
+                self.reached[step] += 1
+        self.current_step[user] = step
+        self.last_seen[user] = max(self.last_seen[user], ts)
+
+    def _replay(self, user: int, user_events: List[EventRow]):
+        """Recompute a user's state from all of their events"""
+        for step in range(self.best_step[user] + 1):
+            self.reached[step] -= 1
+        self.current_step[user] = -1
+        self.best_step[user] = -1
+        self.attempt_start[user] = 0.0
+        self.last_seen[user] = float('-inf')
+        for _, _, event_name, ts in user_events:
+            if event_name in self._step_names:
+                self._advance(user, event_name, ts)
+
+    def result(self) -> Dict[str, Any]:
+        first = self.reached[0] if self.reached else 0
+        return {
+            'steps': [
+                {
+                    'event': name,
+                    'users': users,
+                    'conversion_rate': round(users / first * 100, 2) if first else 0,
+                    'step_conversion_rate': (
+                        round(users / self.reached[index - 1] * 100, 2) if index and self.reached[index - 1] else
+                        (100.0 if users else 0)
+                    )
+                } for index, (name, users) in enumerate(zip(self.steps, self.reached))
+            ],
+            'window_seconds': self.window_seconds
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'users': self.users.to_list(),
+            'current_step': pack_array(self.current_step),
+            'best_step': pack_array(self.best_step),
+            'attempt_start': pack_array(self.attempt_start),
+            'last_seen': pack_array(self.last_seen),
+            'reached': self.reached,
+            'watermark': self.watermark
+        }
+
+    def load(self, data: Dict[str, Any]):
+        self.users = UserIndex.from_list(data['users'])
+        self.current_step = unpack_array('h', data['current_step'])
+        self.best_step = unpack_array('h', data['best_step'])
+        self.attempt_start = unpack_array('d', data['attempt_start'])
+        self.last_seen = unpack_array('d', data['last_seen'])
+        self.reached = data['reached']
+        self.watermark = data['watermark']
+
+
+class CohortState:
+    """Retention matrix of cohorts grouped by the period of each user's first event.
+
+    ``active[c][k]`` counts users of cohort c active in period c + k. Events
+    of a user normally arrive in time order, so remembering each user's last
+    counted period is enough to count a user at most once per period. A user
+    with an event ingested behind their last counted period, which could move
+    their cohort or fill in a skipped period, is recounted from their full history.
+    """
+
+    def __init__(self, period_days: int = 7, event_names: Optional[List[str]] = None):
+        self.period_days = period_days
+        self.event_names = set(event_names) if event_names else None
+        self.users = UserIndex()
+        self.cohort = array('q')
+        self.last_period = array('q')
+        self.active: Dict[int, List[int]] = {}
+        self.watermark = 0
+
+    def _period(self, ts: float) -> int:
+        return int((ts - PERIOD_ORIGIN) // (self.period_days * 86400))
+
+    def update(self, rows: Iterator[EventRow], history: UserHistory):
+        event_names = self.event_names
+        cohort, last_period, active = self.cohort, self.last_period, self.active
+        previous_watermark = self.watermark
+        late: Set[str] = set()
+        for event_id, user_id, event_name, ts in rows:
+            if event_id > self.watermark:
+                self.watermark = event_id
+            if (event_names is not None and event_name not in event_names) or user_id in late:
+                continue
+            period = self._period(ts)
+            user, is_new = self.users.encode(user_id)
+            if is_new:
+                cohort.append(period)
+                last_period.append(period)
+                active.setdefault(period, [0])[0] += 1
+            elif period > last_period[user]:
+                self._count(cohort[user], period, 1)
+                last_period[user] = period
+            elif period < last_period[user]:
+                late.add(user_id)
+        if late:
+            logger.info(f"Recounting {len(late)} users of the cohorts after late events")
+            for user_id, user_events in group_by_user(history(late)).items():
+                # None of the user's events of this batch changed the counts before the late one,
+                # so what the user counted for so far comes from the events already materialized
+                before = [row for row in user_events if row[0] <= previous_watermark]
+                self._recount(self.users.ids[user_id], self._periods(before), self._periods(user_events))
+
+    def _periods(self, user_events: List[EventRow]) -> List[int]:
+        """Distinct periods a user was active in, oldest first"""
+        return sorted({
+            self._period(ts) for _, _, event_name, ts in user_events
+            if self.event_names is None or event_name in self.event_names
+        })
+
+    def _count(self, cohort: int, period: int, delta: int):
+        counts = self.active.setdefault(cohort, [0])
+        offset = period - cohort
+        if offset >= len(counts):
+            counts.extend([0] * (offset + 1 - len(counts)))
+        counts[offset] += delta
+
+    def _recount(self, user: int, old_periods: List[int], new_periods: List[int]):
+        for period in old_periods:
+            self._count(old_periods[0], period, -1)
+        for period in new_periods:
+            self._count(new_periods[0], period, 1)
+        self.cohort[user] = new_periods[0]
+        self.last_period[user] = new_periods[-1]
+        # A cohort whose only users moved to an earlier one is gone
+        for period in [period for period, counts in self.active.items() if not counts[0]]:
+            del self.active[period]
+
+    def result(self) -> Dict[str, Any]:
+        period_seconds = self.period_days * 86400
+        cohorts = []
+        for period in sorted(self.active):
+            counts = self.active[period]
+            start = datetime.fromtimestamp(PERIOD_ORIGIN + period * period_seconds, tz=timezone.utc)
+            cohorts.append({
+                'cohort_start': start.strftime('%Y-%m-%d'),
+                'size': counts[0],
+                'active_users': counts,
+                'retention': [round(count / counts[0] * 100, 2) for count in counts]
+            })
+        return {
+            'period_days': self.period_days,
+            'cohorts': cohorts
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'users': self.users.to_list(),
+            'cohort': pack_array(self.cohort),
+            'last_period': pack_array(self.last_period),
+            'active': [[period, counts] for period, counts in self.active.items()],
+            'watermark': self.watermark
+        }
+
+    def load(self, data: Dict[str, Any]):
+        self.users = UserIndex.from_list(data['users'])
+        self.cohort = unpack_array('q', data['cohort'])
+        self.last_period = unpack_array('q', data['last_period'])
+        self.active = {period: counts for period, counts in data['active']}
+        self.watermark = data['watermark']
+
+
+class FunnelCohortEngine:
+    """Computes funnels and cohort retention in one pass over time-ordered events.
+
+    Every definition is materialized in ``analytics_materializations`` together
+    with the id of the last event it has seen, so a repeat query only streams
+    the events ingested since then. The time-ordered event stream comes from
+    the configured analytics backend.
+
+    Funnels and cohorts follow each user's events one by one, so they refuse
+    event names that are sampled: their missing rows can't be weighted back.
+    """
+
+    def __init__(self, db_path: str, backend, sampler: Optional[EventSampler] = None):
+        self.db_path = db_path
+        self.backend = backend
+        self.sampler = sampler
+        self._states: Dict[str, Any] = {}
+        self._lock = threading.Lock()
+
+    def _check_unsampled(self, event_names: Optional[List[str]]):
+        sampled = self.sampler.sampled_event_names() if self.sampler else []
+        if not sampled:
+            return
+        if event_names is None:
+            raise ValueError(f"Events are sampled ({', '.join(sampled)}), list the event names to use")
+        sampled_names = sorted(set(event_names) & set(sampled))
+        if sampled_names:
+            raise ValueError(f"Sampled events can't be followed per user: {', '.join(sampled_names)}")
+
+    def funnel(self, steps: List[str], window_seconds: Optional[float] = None) -> Dict[str, Any]:
+        self._check_unsampled(steps)
+        key = 'funnel:' + json.dumps([steps, window_seconds])
+        state = self._refresh(key, lambda: FunnelState(steps, window_seconds))
+        return state.result()
+
+    def cohort_retention(self, period_days: int = 7, event_names: Optional[List[str]] = None) -> Dict[str, Any]:
+        self._check_unsampled(event_names)
+        key = 'cohort:' + json.dumps([period_days, sorted(event_names) if event_names else None])
+        state = self._refresh(key, lambda: CohortState(period_days, event_names))
+        return state.result()
+
+    def _refresh(self, key: str, create_state):
+        with self._lock:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                state = self._states.get(key)
+                if state is None:
+                    row = conn.execute(
+                        'SELECT state FROM analytics_materializations WHERE name = ?', (key,)
+                    ).fetchone()
+                    state = self._load(key, create_state, row[0]) if row else create_state()
+
+                previous_watermark = state.watermark
+                state.update(self.backend.iter_events(state.watermark), self.backend.iter_user_events)
+                if state.watermark != previous_watermark:
+                    conn.execute('''
+                        INSERT INTO analytics_materializations (name, watermark, state, updated_at)
+                        VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(name) DO UPDATE SET
+                            watermark = excluded.watermark,
+                            state = excluded.state,
+                            updated_at = excluded.updated_at
+                    ''', (key, state.watermark, json.dumps({'version': STATE_VERSION, 'state': state.to_dict()})))
+                    conn.commit()
+                self._states[key] = state
+                return state
+            finally:
+                conn.close()
+
+    @staticmethod
+    def _load(key: str, create_state, stored):
+        """Restore a materialized state, or start an empty one to rebuild when stored in another format"""
+        try:
+            saved = json.loads(stored)
+            if saved.get('version') == STATE_VERSION:
+                state = create_state()
+                state.load(saved['state'])
+                return state
+        except (ValueError, TypeError, KeyError, AttributeError):
+            pass
+        logger.info(f"Rebuilding {key}, its stored state is in an older format")
+        return create_state()
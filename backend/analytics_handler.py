@@ -1,3 +1,4 @@
+import base64
 import json
 import logging
 from datetime import datetime, timezone
@@ -7,13 +8,45 @@ from collections import defaultdict, Counter
 import sqlite3
 import os
 
+from analytics_archive import EventArchive, compact_events
+from analytics_backends import ANALYSIS_EVENT, UPLOAD_EVENT, create_backend
+from analytics_cache import WatermarkCache
+from analytics_funnels import FunnelCohortEngine
+from analytics_sampling import parse_sampling_config
+from analytics_sessions import UPSERT_SESSION_SQL, Sessionizer
+
 # Setup logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Dashboard time ranges; anything else means all time
+TIME_RANGE_DAYS = {'24h': 1, '7d': 7, '30d': 30}
+
+# User timeline paging
+TIMELINE_FIELDS = ('id', 'event', 'timestamp', 'properties')
+MAX_TIMELINE_PAGE_SIZE = 500
+
+def weighted_count(value: Optional[float]) -> int:
+    """Round a sum of sampling weights to the event count it estimates"""
+    return int(round(value or 0))
+
 class AnalyticsHandler:
-    def __init__(self, db_path: str = "analytics.db"):
+    def __init__(self, db_path: str = "analytics.db", archive_dir: Optional[str] = None,
+                 retention_days: Optional[int] = None, cache_max_staleness: float = 0.0,
+                 cache_stale_while_revalidate: float = 0.0, backend: str = "sqlite",
+                 duckdb_path: Optional[str] = None, sampling: Optional[str] = None):
         self.db_path = db_path
+        self.archive = EventArchive(archive_dir, db_path) if archive_dir else None
+        self.retention_days = retention_days
+        self.sessionizer = Sessionizer()
+        self.sampler = parse_sampling_config(sampling)
+        self.sampler.check_user_metrics([UPLOAD_EVENT, ANALYSIS_EVENT])
+        self.backend = create_backend(backend, db_path, self.archive, duckdb_path)
+        self.funnels = FunnelCohortEngine(db_path, self.backend, self.sampler)
+        self.dashboard_cache = WatermarkCache(
+            max_staleness=cache_max_staleness,
+            stale_while_revalidate=cache_stale_while_revalidate
+        )
         self.init_database()
         
     def init_database(self):
@@ -46,7 +79,8 @@ class AnalyticsHandler:
                 events_count INTEGER DEFAULT 0,
                 user_agent TEXT,
                 referrer TEXT,
-                UNIQUE(user_id, session_id)
+                session_seq INTEGER NOT NULL DEFAULT 0,
+                UNIQUE(user_id, session_id, session_seq)
             )
         ''')
         
@@ -67,8 +101,90 @@ class AnalyticsHandler:
             )
         ''')
         
+        # Number of received events each stored event stands for under sampling
+        existing_columns = {row[1] for row in cursor.execute('PRAGMA table_info(events)')}
+        if 'sample_weight' not in existing_columns:
+            cursor.execute('ALTER TABLE events ADD COLUMN sample_weight REAL NOT NULL DEFAULT 1')
+        
+        # Session columns maintained by the sessionizer
+        existing_columns = {row[1] for row in cursor.execute('PRAGMA table_info(user_sessions)')}
+        if 'session_seq' not in existing_columns:
+            # The old UNIQUE(user_id, session_id) merged every reuse of a session id into one row;
+            # SQLite can't change a table constraint, so rebuild the table around the new key
+            cursor.execute('ALTER TABLE user_sessions RENAME TO user_sessions_old')
+            cursor.execute('''
+                CREATE TABLE user_sessions (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    user_id TEXT NOT NULL,
+                    session_id TEXT NOT NULL,
+                    start_time DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    end_time DATETIME,
+                    page_views INTEGER DEFAULT 0,
+                    events_count INTEGER DEFAULT 0,
+                    user_agent TEXT,
+                    referrer TEXT,
+                    session_seq INTEGER NOT NULL DEFAULT 0,
+                    duration_seconds REAL,
+                    entry_page TEXT,
+                    exit_page TEXT,
+                    UNIQUE(user_id, session_id, session_seq)
+                )
+            ''')
+            copied_columns = ', '.join(column for column in [
+                'id', 'user_id', 'session_id', 'start_time', 'end_time', 'page_views', 'events_count',
+                'user_agent', 'referrer', 'duration_seconds', 'entry_page', 'exit_page'
+            ] if column in existing_columns)
+            cursor.execute(f'INSERT INTO user_sessions ({copied_columns}) SELECT {copied_columns} FROM user_sessions_old')
+            cursor.execute('DROP TABLE user_sessions_old')
+            existing_columns = {row[1] for row in cursor.execute('PRAGMA table_info(user_sessions)')}
+        for column, column_type in [('duration_seconds', 'REAL'), ('entry_page', 'TEXT'), ('exit_page', 'TEXT')]:
+            if column not in existing_columns:
+                cursor.execute(f'ALTER TABLE user_sessions ADD COLUMN {column} {column_type}')
+        
+        # Per-day event counts of archived events, kept after the rows leave the events table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS event_daily_rollups (
+                day TEXT NOT NULL,
+                event_name TEXT NOT NULL,
+                events INTEGER DEFAULT 0,
+                PRIMARY KEY (day, event_name)
+            )
+        ''')
+        
+        # Highest event id of each day whose archive file is complete and whose rows left the events table
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS archived_days (
+                day TEXT PRIMARY KEY,
+                max_id INTEGER NOT NULL
+            )
+        ''')
+        # Days compacted before the marker table existed are known from their rollups, and the highest
+        # id archived for each of them from the names of its files
+        if self.archive:
+            cursor.execute('''
+                SELECT DISTINCT day FROM event_daily_rollups
+                WHERE day NOT IN (SELECT day FROM archived_days)
+            ''')
+            for (day,) in cursor.fetchall():
+                max_id = self.archive.last_file_id(day)
+                if max_id is not None:
+                    cursor.execute('INSERT INTO archived_days (day, max_id) VALUES (?, ?)', (day, max_id))
+        
+        # Incrementally maintained funnel and cohort results
+        cursor.execute('''
+            CREATE TABLE IF NOT EXISTS analytics_materializations (
+                name TEXT PRIMARY KEY,
+                watermark INTEGER NOT NULL,
+                state BLOB NOT NULL,
+                updated_at DATETIME DEFAULT CURRENT_TIMESTAMP
+            )
+        ''')
+        
         # Create indexes for better performance
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_user_id ON events(user_id)')
+        # Covers user timeline pages ordered by (timestamp, id) without touching the table rows;
+        # it also serves every lookup the old single-column user_id index did
+        cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_user_timestamp ON events(user_id, timestamp, id, event_name)')
+        cursor.execute('DROP INDEX IF EXISTS idx_events_user_id')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_timestamp ON events(timestamp)')
         cursor.execute('CREATE INDEX IF NOT EXISTS idx_events_event_name ON events(event_name)')
         
@@ -78,11 +194,18 @@ class AnalyticsHandler:
 
     async def process_events(self, events: List[Dict[str, Any]]) -> Dict[str, Any]:
         """Process a batch of analytics events"""
+        # SQLite calls block, so keep them off the event loop serving the API
+        return await asyncio.to_thread(self._write_events, events)
+
+    def _write_events(self, events: List[Dict[str, Any]]) -> Dict[str, Any]:
+        """Write a batch of analytics events to the database"""
+        conn = None
         try:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
             processed_count = 0
+            event_rows = []
             user_insights_updates = defaultdict(dict)
             
             for event in events:
@@ -97,38 +220,36 @@ class AnalyticsHandler:
                     logger.warning(f"Skipping invalid event: {event}")
                     continue
                 
-                # Insert event
-                cursor.execute('''
-                    INSERT INTO events (event_name, user_id, session_id, properties, timestamp)
-                    VALUES (?, ?, ?, ?, ?)
-                ''', (event_name, user_id, session_id, json.dumps(properties), timestamp))
+                event_rows.append((event_name, user_id, session_id, json.dumps(properties), timestamp))
                 
                 # Update session tracking
-                cursor.execute('''
-                    INSERT OR REPLACE INTO user_sessions 
-                    (user_id, session_id, start_time, page_views, events_count, user_agent, referrer)
-                    VALUES (?, ?, ?, 
-                        COALESCE((SELECT page_views FROM user_sessions WHERE user_id=? AND session_id=?), 0) + ?,
-                        COALESCE((SELECT events_count FROM user_sessions WHERE user_id=? AND session_id=?), 0) + 1,
-                        ?, ?)
-                ''', (
-                    user_id, session_id, timestamp,
-                    user_id, session_id, 1 if event_name == 'page_viewed' else 0,
-                    user_id, session_id,
-                    properties.get('userAgent', ''),
-                    properties.get('referrer', '')
-                ))
+                self.sessionizer.observe(user_id, session_id, event_name, properties, timestamp)
                 
                 # Collect data for user insights updates
                 self._update_user_insights_data(user_insights_updates, user_id, event_name, properties, timestamp)
                 
                 processed_count += 1
             
-            # Batch update user insights
-            await self._batch_update_user_insights(cursor, user_insights_updates)
+            # Insert the sampled events with the weight each one stands for;
+            # sessions and user insights are still built from every event
+            cursor.executemany('''
+                INSERT INTO events (event_name, user_id, session_id, properties, timestamp, sample_weight)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', [row + (weight,) for row, weight in self.sampler.apply(event_rows)])
             
-            conn.commit()
-            conn.close()
+            # Batch update sessions and user insights
+            session_rows = self.sessionizer.drain(
+                lambda user_id, session_id, until: self._latest_session(cursor, user_id, session_id, until)
+            )
+            try:
+                cursor.executemany(UPSERT_SESSION_SQL, session_rows)
+                self._batch_update_user_insights(cursor, user_insights_updates)
+                
+                conn.commit()
+            except Exception:
+                # Keep the session counts for the next batch rather than losing them with this one
+                self.sessionizer.requeue(session_rows)
+                raise
             
             logger.info(f"Processed {processed_count} analytics events successfully")
             
@@ -145,6 +266,33 @@ class AnalyticsHandler:
                 'error': str(e),
                 'processed_count': 0
             }
+        finally:
+            # A failed batch must not keep holding the write lock
+            if conn is not None:
+                conn.close()
+
+    @staticmethod
+    def _latest_session(cursor, user_id: str, session_id: str, until: datetime) -> Optional[tuple]:
+        """Sequence number and time span of the stored session with this session id that ended last among
+        those starting before ``until``, and the highest sequence number stored for it"""
+        row = cursor.execute('''
+            SELECT session_seq, start_time, COALESCE(end_time, start_time),
+                   MAX(session_seq) OVER ()
+            FROM user_sessions
+            WHERE user_id = ? AND session_id = ?
+            ORDER BY julianday(start_time) <= julianday(?) DESC, julianday(COALESCE(end_time, start_time)) DESC
+            LIMIT 1
+        ''', (user_id, session_id, until.isoformat())).fetchone()
+        if row is None:
+            return None
+        start_time, end_time = (datetime.fromisoformat(value) for value in row[1:3])
+        # Rows written before timestamps carried their timezone are UTC
+        return (
+            row[0],
+            start_time if start_time.tzinfo else start_time.replace(tzinfo=timezone.utc),
+            end_time if end_time.tzinfo else end_time.replace(tzinfo=timezone.utc),
+            row[3],
+        )
 
     def _update_user_insights_data(self, insights_data: Dict, user_id: str, event_name: str, properties: Dict, timestamp: datetime):
         """Collect data for user insights updates"""
@@ -175,7 +323,7 @@ class AnalyticsHandler:
             if feature:
                 data['skills'].append(feature)
 
-    async def _batch_update_user_insights(self, cursor, insights_data: Dict):
+    def _batch_update_user_insights(self, cursor, insights_data: Dict):
         """Batch update user insights"""
         for user_id, data in insights_data.items():
             avg_match_score = sum(data['match_scores']) / len(data['match_scores']) if data['match_scores'] else 0
@@ -200,67 +348,43 @@ class AnalyticsHandler:
                 avg_match_score, top_skills
             ))
 
+    def get_ingestion_watermark(self) -> Optional[int]:
+        """Return the id of the last ingested event"""
+        conn = sqlite3.connect(self.db_path)
+        try:
+            # AUTOINCREMENT ids are never reused, so this keeps advancing after events are archived
+            row = conn.execute("SELECT seq FROM sqlite_sequence WHERE name = 'events'").fetchone()
+            return row[0] if row else None
+        finally:
+            conn.close()
+
     def get_analytics_dashboard(self, time_range: str = '7d') -> Dict[str, Any]:
-        """Get analytics dashboard data"""
+        """Get analytics dashboard data, served from cache until new events are ingested"""
+        try:
+            return self.dashboard_cache.get(
+                time_range,
+                self.get_ingestion_watermark,
+                lambda: self._compute_analytics_dashboard(time_range)
+            )
+        except Exception as e:
+            logger.error(f"Error getting analytics dashboard: {str(e)}")
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def _compute_analytics_dashboard(self, time_range: str) -> Dict[str, Any]:
+        """Compute analytics dashboard data"""
         try:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
             
-            # Define time filter
-            if time_range == '24h':
-                time_filter = "timestamp > datetime('now', '-1 day')"
-            elif time_range == '7d':
-                time_filter = "timestamp > datetime('now', '-7 days')"
-            elif time_range == '30d':
-                time_filter = "timestamp > datetime('now', '-30 days')"
-            else:
-                time_filter = "1=1"  # All time
-            
-            # Get basic metrics
-            cursor.execute(f'''
-                SELECT 
-                    COUNT(DISTINCT user_id) as unique_users,
-                    COUNT(DISTINCT session_id) as sessions,
-                    COUNT(*) as total_events
-                FROM events 
-                WHERE {time_filter}
-            ''')
-            basic_metrics = cursor.fetchone()
-            
-            # Get popular events
-            cursor.execute(f'''
-                SELECT event_name, COUNT(*) as count
-                FROM events 
-                WHERE {time_filter}
-                GROUP BY event_name
-                ORDER BY count DESC
-                LIMIT 10
-            ''')
-            popular_events = cursor.fetchall()
-            
-            # Get conversion metrics
-            cursor.execute(f'''
-                SELECT 
-                    SUM(CASE WHEN event_name = 'resume_uploaded' THEN 1 ELSE 0 END) as resumes_uploaded,
-                    SUM(CASE WHEN event_name = 'analysis_completed' THEN 1 ELSE 0 END) as analyses_completed,
-                    COUNT(DISTINCT CASE WHEN event_name = 'resume_uploaded' THEN user_id END) as users_uploaded,
-                    COUNT(DISTINCT CASE WHEN event_name = 'analysis_completed' THEN user_id END) as users_analyzed
-                FROM events 
-                WHERE {time_filter}
-            ''')
-            conversion_metrics = cursor.fetchone()
-            
-            # Get hourly activity (last 24 hours)
-            cursor.execute('''
-                SELECT 
-                    strftime('%H', timestamp) as hour,
-                    COUNT(*) as events_count
-                FROM events 
-                WHERE timestamp > datetime('now', '-1 day')
-                GROUP BY hour
-                ORDER BY hour
-            ''')
-            hourly_activity = cursor.fetchall()
+            # Event aggregates come from the configured analytics backend
+            metrics = self.backend.dashboard_metrics(TIME_RANGE_DAYS.get(time_range))
+            basic_metrics = metrics['basic']
+            popular_events = metrics['popular']
+            conversion_metrics = metrics['conversion']
+            hourly_activity = metrics['hourly']
             
             # Get top user insights
             cursor.execute('''
@@ -290,17 +414,17 @@ class AnalyticsHandler:
                     'basic_metrics': {
                         'unique_users': basic_metrics[0],
                         'sessions': basic_metrics[1],
-                        'total_events': basic_metrics[2]
+                        'total_events': weighted_count(basic_metrics[2])
                     },
                     'conversion_metrics': {
-                        'resumes_uploaded': conversion_metrics[0],
-                        'analyses_completed': conversion_metrics[1],
-                        'users_uploaded': conversion_metrics[2],
-                        'users_analyzed': conversion_metrics[3],
+                        'resumes_uploaded': weighted_count(conversion_metrics[0]),
+                        'analyses_completed': weighted_count(conversion_metrics[1]),
+                        'users_uploaded': weighted_count(conversion_metrics[2]),
+                        'users_analyzed': weighted_count(conversion_metrics[3]),
                         'conversion_rate': round(conversion_rate, 2)
                     },
-                    'popular_events': [{'event': row[0], 'count': row[1]} for row in popular_events],
-                    'hourly_activity': [{'hour': row[0], 'events': row[1]} for row in hourly_activity],
+                    'popular_events': [{'event': row[0], 'count': weighted_count(row[1])} for row in popular_events],
+                    'hourly_activity': [{'hour': row[0], 'events': weighted_count(row[1])} for row in hourly_activity],
                     'top_users': [
                         {
                             'user_id': row[0],
@@ -322,6 +446,77 @@ class AnalyticsHandler:
                 'error': str(e)
             }
 
+    def get_funnel(self, steps: List[str], window_seconds: Optional[float] = None) -> Dict[str, Any]:
+        """Get how many users went through each of the ordered funnel steps"""
+        try:
+            if not steps:
+                return {'success': False, 'error': 'At least one funnel step is required'}
+            return {'success': True, **self.funnels.funnel(list(steps), window_seconds)}
+            
+        except Exception as e:
+            logger.error(f"Error computing funnel: {str(e)}")
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def get_cohort_retention(self, period_days: int = 7, event_names: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Get the retention matrix of users grouped by the period they were first seen"""
+        try:
+            if period_days < 1:
+                return {'success': False, 'error': 'period_days must be at least 1'}
+            return {'success': True, **self.funnels.cohort_retention(period_days, event_names)}
+            
+        except Exception as e:
+            logger.error(f"Error computing cohort retention: {str(e)}")
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def sync_backend(self) -> int:
+        """Copy newly ingested events into the analytics backend, when it keeps its own copy"""
+        added = self.backend.sync()
+        if added:
+            # Cached dashboards are keyed by the ingestion watermark, which a sync doesn't move
+            self.dashboard_cache.clear()
+        return added
+
+    async def run_backend_sync(self, interval: float):
+        """Sync the analytics backend every ``interval`` seconds; run it in a single process"""
+        while True:
+            try:
+                added = await asyncio.to_thread(self.sync_backend)
+                if added:
+                    logger.info(f"Synced {added} analytics events into the {type(self.backend).__name__}")
+            except Exception as e:
+                logger.error(f"Error syncing the analytics backend: {str(e)}")
+            await asyncio.sleep(interval)
+
+    def compact_events(self, retention_days: Optional[int] = None, vacuum: bool = False) -> Dict[str, Any]:
+        """Move events older than the retention horizon into the columnar archive"""
+        retention_days = retention_days or self.retention_days
+        if not self.archive or not retention_days:
+            return {'success': False, 'error': 'Archiving requires an archive directory and a retention horizon'}
+        
+        try:
+            conn = sqlite3.connect(self.db_path)
+            try:
+                result = compact_events(conn, self.archive, retention_days, vacuum=vacuum)
+            finally:
+                conn.close()
+            self.dashboard_cache.clear()
+            logger.info(f"Archived {result['archived_count']} analytics events older than {result['cutoff']}")
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error compacting analytics events: {str(e)}")
+            return {
+                'success': False,
+                'error': str(e),
+                'archived_count': 0
+            }
+
     def get_user_insights(self, user_id: str) -> Dict[str, Any]:
         """Get insights for a specific user"""
         try:
@@ -338,20 +533,14 @@ class AnalyticsHandler:
                 return {'success': False, 'error': 'User not found'}
             
             # Get recent events
-            cursor.execute('''
-                SELECT event_name, properties, timestamp
-                FROM events 
-                WHERE user_id = ?
-                ORDER BY timestamp DESC
-                LIMIT 50
-            ''', (user_id,))
-            recent_events = cursor.fetchall()
+            recent_events, _ = self._fetch_user_timeline(cursor, user_id, 50, None, ['event', 'properties', 'timestamp'])
             
             # Get session summary
             cursor.execute('''
                 SELECT COUNT(*) as session_count, 
                        SUM(page_views) as total_page_views,
-                       AVG(events_count) as avg_events_per_session
+                       AVG(events_count) as avg_events_per_session,
+                       AVG(duration_seconds) as avg_session_duration
                 FROM user_sessions 
                 WHERE user_id = ?
             ''', (user_id,))
@@ -369,19 +558,14 @@ class AnalyticsHandler:
                     'total_events': user_data[5],
                     'total_page_views': session_summary[1] if session_summary else 0,
                     'avg_events_per_session': round(session_summary[2], 2) if session_summary and session_summary[2] else 0,
+                    'avg_session_duration_seconds': round(session_summary[3], 2) if session_summary and session_summary[3] else 0,
                     'resumes_uploaded': user_data[6],
                     'analyses_completed': user_data[7],
                     'avg_match_score': user_data[8],
                     'top_skills': json.loads(user_data[9]) if user_data[9] else [],
                     'user_status': user_data[10]
                 },
-                'recent_events': [
-                    {
-                        'event': row[0],
-                        'properties': json.loads(row[1]) if row[1] else {},
-                        'timestamp': row[2]
-                    } for row in recent_events
-                ]
+                'recent_events': recent_events
             }
             
         except Exception as e:
@@ -391,8 +575,126 @@ class AnalyticsHandler:
                 'error': str(e)
             }
 
+    def get_user_timeline(self, user_id: str, limit: int = 50, cursor: Optional[str] = None,
+                          fields: Optional[List[str]] = None,
+                          property_keys: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Get one page of a user's events, newest first.
+
+        Pages are keyset-paginated on (timestamp, id): pass the returned
+        ``next_cursor`` to get the following page. ``fields`` selects which of
+        id, event, timestamp and properties are returned; properties are only
+        decoded when asked for, and ``property_keys`` extracts just those keys
+        in SQLite instead of decoding the whole JSON document.
+        """
+        try:
+            fields = list(fields or TIMELINE_FIELDS)
+            unknown_fields = set(fields) - set(TIMELINE_FIELDS)
+            if unknown_fields:
+                return {'success': False, 'error': f"Unknown fields: {', '.join(sorted(unknown_fields))}"}
+            limit = max(1, min(int(limit), MAX_TIMELINE_PAGE_SIZE))
+            after = self._decode_timeline_cursor(cursor) if cursor else None
+            
+            conn = sqlite3.connect(self.db_path)
+            try:
+                events, next_cursor = self._fetch_user_timeline(
+                    conn.cursor(), user_id, limit, after, fields, property_keys
+                )
+            finally:
+                conn.close()
+            
+            result = {
+                'success': True,
+                'user_id': user_id,
+                'events': events,
+                'next_cursor': next_cursor
+            }
+            sampled_events = self.sampler.sampled_event_names()
+            if sampled_events:
+                # Only part of these events are stored, so the timeline can miss some of them
+                result['sampled_events'] = sampled_events
+            return result
+            
+        except Exception as e:
+            logger.error(f"Error getting user timeline: {str(e)}")
+            return {
+                'success': False,
+                'error': str(e)
+            }
+
+    def _fetch_user_timeline(self, cursor, user_id: str, limit: int, after: Optional[tuple],
+                             fields: List[str], property_keys: Optional[List[str]] = None):
+        """Fetch up to limit events older than the (timestamp, id) position after"""
+        columns = ['timestamp', 'id', 'event_name']
+        params: List[Any] = []
+        if 'properties' in fields:
+            if property_keys is None:
+                columns.append('properties')
+            else:
+                for key in property_keys:
+                    columns.append('json_extract(properties, ?)')
+                    params.append('$.' + json.dumps(key))
+        
+        where = 'user_id = ?'
+        params.append(user_id)
+        if after:
+            where += ' AND (timestamp, id) < (?, ?)'
+            params.extend(after)
+        params.append(limit + 1)
+        
+        cursor.execute(f'''
+            SELECT {', '.join(columns)}
+            FROM events
+            WHERE {where}
+            ORDER BY timestamp DESC, id DESC
+            LIMIT ?
+        ''', params)
+        rows = cursor.fetchall()
+        
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = self._encode_timeline_cursor(rows[-1][0], rows[-1][1])
+        
+        events = []
+        for row in rows:
+            event = {}
+            if 'id' in fields:
+                event['id'] = row[1]
+            if 'event' in fields:
+                event['event'] = row[2]
+            if 'properties' in fields:
+                if property_keys is None:
+                    event['properties'] = json.loads(row[3]) if row[3] else {}
+                else:
+                    event['properties'] = dict(zip(property_keys, row[3:]))
+            if 'timestamp' in fields:
+                event['timestamp'] = row[0]
+            events.append(event)
+        return events, next_cursor
+
+    @staticmethod
+    def _encode_timeline_cursor(timestamp: str, event_id: int) -> str:
+        return base64.urlsafe_b64encode(json.dumps([timestamp, event_id]).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_timeline_cursor(cursor: str) -> tuple:
+        try:
+            timestamp, event_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+            return (str(timestamp), int(event_id))
+        except Exception as e:
+            raise ValueError('Invalid timeline cursor') from e
+
 # Global analytics handler instance
-analytics_handler = AnalyticsHandler()
+analytics_handler = AnalyticsHandler(
+    db_path=os.getenv("ANALYTICS_DB_PATH", "analytics.db"),
+    archive_dir=os.getenv("ANALYTICS_ARCHIVE_DIR"),
+    retention_days=int(os.getenv("ANALYTICS_RETENTION_DAYS", "0")) or None,
+    cache_max_staleness=float(os.getenv("ANALYTICS_DASHBOARD_MAX_STALENESS", "0")),
+    cache_stale_while_revalidate=float(os.getenv("ANALYTICS_DASHBOARD_STALE_WHILE_REVALIDATE", "0")),
+    backend=os.getenv("ANALYTICS_BACKEND", "sqlite"),
+    duckdb_path=os.getenv("ANALYTICS_DUCKDB_PATH"),
+    sampling=os.getenv("ANALYTICS_SAMPLING")
+)
 
 async def process_analytics_events(events: List[Dict[str, Any]]) -> Dict[str, Any]:
     """Main function to process analytics events"""
@@ -404,4 +706,22 @@ def get_analytics_dashboard(time_range: str = '7d') -> Dict[str, Any]:
 
 def get_user_insights(user_id: str) -> Dict[str, Any]:
     """Get user insights"""
-    return analytics_handler.get_user_insights(user_id) 
\ No newline at end of file
+    return analytics_handler.get_user_insights(user_id)
+
+def get_user_timeline(user_id: str, limit: int = 50, cursor: Optional[str] = None,
+                      fields: Optional[List[str]] = None,
+                      property_keys: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Get a page of a user's event timeline"""
+    return analytics_handler.get_user_timeline(user_id, limit, cursor, fields, property_keys)
+
+def get_funnel(steps: List[str], window_seconds: Optional[float] = None) -> Dict[str, Any]:
+    """Get funnel conversion for ordered event steps"""
+    return analytics_handler.get_funnel(steps, window_seconds)
+
+def get_cohort_retention(period_days: int = 7, event_names: Optional[List[str]] = None) -> Dict[str, Any]:
+    """Get cohort retention"""
+    return analytics_handler.get_cohort_retention(period_days, event_names)
+
+def compact_analytics_events(retention_days: Optional[int] = None, vacuum: bool = False) -> Dict[str, Any]:
+    """Archive events older than the retention horizon"""
+    return analytics_handler.compact_events(retention_days, vacuum=vacuum) 
\ No newline at end of file
@@ -0,0 +1,150 @@
+import asyncio
+import json
+import logging
+import math
+import time
+import zlib
+from collections.abc import AsyncGenerator, AsyncIterable
+from typing import Dict, List, Any, Optional
+
+# Setup logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+MAX_LINE_BYTES = 64 * 1024  # A single analytics event is a few hundred bytes
+INFLATE_CHUNK_BYTES = 256 * 1024  # Bounds how much one compressed chunk may expand at a time
+
+
+class IngestError(ValueError):
+    """Raised when a request body cannot be read as (gzip-compressed) NDJSON"""
+
+
+def validate_event(raw: Any) -> Optional[Dict[str, Any]]:
+    """Return the event in the shape AnalyticsHandler.process_events expects, or None if it is invalid"""
+    if not isinstance(raw, dict):
+        return None
+    event_name = raw.get('event')
+    user_id = raw.get('userId')
+    properties = raw.get('properties', {})
+    if not isinstance(event_name, str) or not event_name:
+        return None
+    if not isinstance(user_id, str) or not user_id:
+        return None
+    if not isinstance(properties, dict) or not properties.get('sessionId'):
+        return None
+
+    timestamp = raw.get('timestamp')
+    if timestamp is None:
+        timestamp = time.time() * 1000
+    elif isinstance(timestamp, bool) or not isinstance(timestamp, (int, float)):
+        return None
+
+    return {
+        'event': event_name,
+        'userId': user_id,
+        'properties': properties,
+        'timestamp': timestamp
+    }
+
+
+async def _iter_decoded(body: AsyncIterable[bytes], gzip_encoded: bool) -> AsyncGenerator[bytes, None]:
+    if not gzip_encoded:
+        async for data in body:
+            yield data
+        return
+
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        async for data in body:
+            while data:
+                yield decompressor.decompress(data, INFLATE_CHUNK_BYTES)
+                data = decompressor.unconsumed_tail
+        yield decompressor.flush()
+    except zlib.error as e:
+        raise IngestError(f"Invalid gzip body: {e}") from e
+
+
+async def iter_ndjson_events(
+    body: AsyncIterable[bytes], gzip_encoded: bool = False
+) -> AsyncGenerator[Optional[Dict[str, Any]], None]:
+    """Parse an NDJSON body incrementally, yielding validated events and None for each rejected line"""
+    buffer = b''
+    async for data in _iter_decoded(body, gzip_encoded):
+        buffer += data
+        lines = buffer.split(b'\n')
+        buffer = lines.pop()
+        if len(buffer) > MAX_LINE_BYTES:
+            raise IngestError(f"NDJSON line exceeds {MAX_LINE_BYTES} bytes")
+        for line in lines:
+            if line.strip():
+                yield _parse_line(line)
+    if buffer.strip():
+        yield _parse_line(buffer)
+
+
+def _parse_line(line: bytes) -> Optional[Dict[str, Any]]:
+    try:
+        return validate_event(json.loads(line))
+    except ValueError:
+        return None
+
+
+class AnalyticsIngestQueue:
+    """Bounded queue of event chunks drained by a single background writer.
+
+    Requests only enqueue, so ingestion never holds the event loop for the
+    SQLite write. When the queue is full the caller is expected to answer
+    429 with the ``retry_after`` estimate.
+    """
+
+    def __init__(self, handler, max_chunks: int = 64, chunk_size: int = 500):
+        self.handler = handler
+        self.chunk_size = chunk_size
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_chunks)
+        self.avg_chunk_seconds = 0.05
+        self._writer_task: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._writer_task is None:
+            self._writer_task = asyncio.create_task(self._writer())
+
+    async def stop(self):
+        """Flush queued chunks and stop the writer"""
+        if self._writer_task is None:
+            return
+        await self.queue.join()
+        self._writer_task.cancel()
+        try:
+            await self._writer_task
+        except asyncio.CancelledError:
+            pass
+        self._writer_task = None
+
+    def is_full(self) -> bool:
+        return self.queue.full()
+
+    def try_enqueue(self, events: List[Dict[str, Any]]) -> bool:
+        try:
+            self.queue.put_nowait(events)
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def retry_after(self) -> int:
+        """Seconds until the writer has likely drained the current backlog"""
+        return max(1, math.ceil(self.queue.qsize() * self.avg_chunk_seconds))
+
+    async def _writer(self):
+        while True:
+            events = await self.queue.get()
+            started = time.monotonic()
+            try:
+                result = await self.handler.process_events(events)
+                if not result.get('success'):
+                    logger.error(f"Dropped {len(events)} analytics events: {result.get('error')}")
+            except Exception as e:
+                logger.error(f"Error writing analytics events: {str(e)}")
+            finally:
+                elapsed = time.monotonic() - started
+                self.avg_chunk_seconds = 0.8 * self.avg_chunk_seconds + 0.2 * elapsed
+                self.queue.task_done()
@@ -0,0 +1,163 @@
+import hashlib
+import random
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Event rows as written by AnalyticsHandler: (event_name, user_id, session_id, properties, timestamp)
+EventRow = tuple
+
+
+class SamplingPolicy:
+    """Decides which rows of one event name are stored, and the weight each stored row stands for"""
+
+    def select(self, rows: List[EventRow]) -> List[Tuple[int, float]]:
+        """Return (position in rows, weight) for every row to store, in order"""
+        raise NotImplementedError
+
+
+class FixedRateSampler(SamplingPolicy):
+    """Keep each event independently with probability ``rate``"""
+
+    def __init__(self, rate: float, rng: Optional[random.Random] = None):
+        if not 0 < rate <= 1:
+            raise ValueError("Sampling rate must be in (0, 1]")
+        self.rate = rate
+        self.weight = 1 / rate
+        self.rng = rng or random.Random()
+
+    def select(self, rows: List[EventRow]) -> List[Tuple[int, float]]:
+        return [(index, self.weight) for index in range(len(rows)) if self.rng.random() < self.rate]
+
+
+class UserHashSampler(SamplingPolicy):
+    """Keep every event of a deterministic ``rate`` fraction of users.
+
+    The decision only depends on the user id, so a sampled user's event
+    history stays complete and per-user sequences (funnels, timelines) hold.
+    """
+
+    def __init__(self, rate: float, salt: str = ''):
+        if not 0 < rate <= 1:
+            raise ValueError("Sampling rate must be in (0, 1]")
+        self.rate = rate
+        self.weight = 1 / rate
+        self.threshold = int(rate * 2 ** 64)
+        self.salt = salt.encode()
+
+    def keeps(self, user_id: str) -> bool:
+        digest = hashlib.blake2b(user_id.encode(), digest_size=8, key=self.salt).digest()
+        return int.from_bytes(digest, 'big') < self.threshold
+
+    def select(self, rows: List[EventRow]) -> List[Tuple[int, float]]:
+        return [(index, self.weight) for index, row in enumerate(rows) if self.keeps(row[1])]
+
+
+class ReservoirSampler(SamplingPolicy):
+    """Store at most ``max_per_second`` events on average, whatever the incoming rate.
+
+    A token bucket refilled at ``max_per_second`` (holding up to ``burst``
+    tokens) sets how many rows of a batch may be stored. When a batch has more
+    rows than tokens, a uniform reservoir of that size is kept and each stored
+    row carries the weight ``batch rows / stored rows``, so weights still add
+    up to the number of events received.
+    """
+
+    def __init__(self, max_per_second: float, burst: Optional[float] = None, rng: Optional[random.Random] = None):
+        if max_per_second <= 0:
+            raise ValueError("max_per_second must be positive")
+        self.max_per_second = max_per_second
+        self.burst = burst if burst is not None else max_per_second
+        self.tokens = self.burst
+        self.updated_at = time.monotonic()
+        self.rng = rng or random.Random()
+        self._lock = threading.Lock()
+
+    def select(self, rows: List[EventRow]) -> List[Tuple[int, float]]:
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated_at) * self.max_per_second)
+            self.updated_at = now
+            # Always keep one row so the event name never disappears from the dashboards
+            capacity = max(1, int(self.tokens))
+            if len(rows) <= capacity:
+                self.tokens = max(0.0, self.tokens - len(rows))
+                return [(index, 1.0) for index in range(len(rows))]
+            self.tokens = max(0.0, self.tokens - capacity)
+
+        kept = sorted(self.rng.sample(range(len(rows)), capacity))
+        weight = len(rows) / capacity
+        return [(index, weight) for index in kept]
+
+
+class EventSampler:
+    """Applies per-event-name sampling policies to a batch of event rows; unlisted events are all kept"""
+
+    def __init__(self, policies: Optional[Dict[str, SamplingPolicy]] = None):
+        self.policies = policies or {}
+
+    def apply(self, rows: List[EventRow]) -> List[Tuple[EventRow, float]]:
+        """Return the rows to store with their sampling weights, in batch order"""
+        if not self.policies:
+            return [(row, 1.0) for row in rows]
+
+        groups: Dict[str, List[int]] = {}
+        for index, row in enumerate(rows):
+            if row[0] in self.policies:
+                groups.setdefault(row[0], []).append(index)
+
+        # Rows of unsampled event names keep weight 1, sampled ones only if their policy selects them
+        weights = {index: 1.0 for index in range(len(rows))}
+        for event_name, indexes in groups.items():
+            for index in indexes:
+                del weights[index]
+            selected = self.policies[event_name].select([rows[index] for index in indexes])
+            for position, weight in selected:
+                weights[indexes[position]] = weight
+
+        return [(row, weights[index]) for index, row in enumerate(rows) if index in weights]
+
+    def sampled_event_names(self) -> List[str]:
+        return sorted(self.policies)
+
+    def check_user_metrics(self, event_names: List[str]):
+        """Reject policies that would bias the distinct-user metrics built on these events.
+
+        A distinct user is scaled by the weight of their rows, which estimates
+        the number of users only when whole users are kept or dropped.
+        """
+        for event_name in event_names:
+            policy = self.policies.get(event_name)
+            if policy is not None and not isinstance(policy, UserHashSampler):
+                raise ValueError(
+                    f"'{event_name}' is counted per user, it can only be sampled with the user policy"
+                )
+
+
+def parse_sampling_config(spec: Optional[str]) -> EventSampler:
+    """Build an EventSampler from ``event=policy:value`` pairs separated by commas.
+
+    Policies are ``rate`` (fixed rate), ``user`` (per-user hash rate) and
+    ``reservoir`` (events per second), e.g.
+    ``page_viewed=rate:0.1,feature_used=user:0.25,scroll_depth=reservoir:50``.
+    """
+    policies: Dict[str, SamplingPolicy] = {}
+    for entry in (spec or '').split(','):
+        entry = entry.strip()
+        if not entry:
+            continue
+        try:
+            event_name, policy = entry.split('=', 1)
+            kind, value = policy.split(':', 1)
+            number = float(value)
+        except ValueError:
+            raise ValueError(f"Invalid sampling policy '{entry}', expected event=policy:value")
+        if kind == 'rate':
+            policies[event_name.strip()] = FixedRateSampler(number)
+        elif kind == 'user':
+            policies[event_name.strip()] = UserHashSampler(number)
+        elif kind == 'reservoir':
+            policies[event_name.strip()] = ReservoirSampler(number)
+        else:
+            raise ValueError(f"Unknown sampling policy '{kind}', expected rate, user or reservoir")
+    return EventSampler(policies)
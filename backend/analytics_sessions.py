@@ -0,0 +1,235 @@
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Any, Optional, Tuple
+
+DEFAULT_INACTIVITY_GAP = timedelta(minutes=30)
+DEFAULT_MAX_OPEN_SESSIONS = 10000
+
+# (user_id, session_id, until) -> (session_seq, start_time, end_time) of the stored session that ended
+# last among those starting before until, and the highest session_seq stored for the id; None when it has none
+SessionLookup = Callable[[str, str, datetime], Optional[Tuple[int, datetime, datetime, int]]]
+# (session_seq, start_time, end_time)
+SessionSpan = Tuple[int, datetime, datetime]
+
+# Upsert that merges a session delta into its user_sessions row, extending the session's time span.
+# A session id reused after the inactivity gap (a tab left open overnight) gets the next session_seq,
+# so only deltas of the same session are merged
+UPSERT_SESSION_SQL = '''
+    INSERT INTO user_sessions
+    (user_id, session_id, session_seq, start_time, end_time, duration_seconds, page_views, events_count,
+     entry_page, exit_page, user_agent, referrer)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(user_id, session_id, session_seq) DO UPDATE SET
+        start_time = MIN(start_time, excluded.start_time),
+        end_time = MAX(COALESCE(end_time, excluded.end_time), excluded.end_time),
+        duration_seconds = ROUND((
+            julianday(MAX(COALESCE(end_time, excluded.end_time), excluded.end_time))
+            - julianday(MIN(start_time, excluded.start_time))
+        ) * 86400, 3),
+        page_views = page_views + excluded.page_views,
+        events_count = events_count + excluded.events_count,
+        entry_page = CASE WHEN excluded.start_time < start_time
+            THEN COALESCE(excluded.entry_page, entry_page) ELSE COALESCE(entry_page, excluded.entry_page) END,
+        exit_page = CASE WHEN excluded.end_time >= COALESCE(end_time, excluded.end_time)
+            THEN COALESCE(excluded.exit_page, exit_page) ELSE exit_page END,
+        user_agent = COALESCE(NULLIF(user_agent, ''), excluded.user_agent),
+        referrer = COALESCE(NULLIF(referrer, ''), excluded.referrer)
+'''
+
+
+class OpenSession:
+    """In-memory state of a session, with the counts not yet written to the database"""
+
+    def __init__(self, user_id: str, session_id: str, timestamp: datetime, page: Optional[str]):
+        self.user_id = user_id
+        self.session_id = session_id
+        # Position among the sessions sharing this session id, resolved at drain time when not known
+        self.seq: Optional[int] = None
+        self.start_time = timestamp
+        self.end_time = timestamp
+        self.entry_page = page
+        self.exit_page = page
+        self.user_agent = ''
+        self.referrer = ''
+        self.pending_events = 0
+        self.pending_page_views = 0
+
+    def to_row(self) -> tuple:
+        """Row for UPSERT_SESSION_SQL"""
+        return (
+            self.user_id,
+            self.session_id,
+            self.seq,
+            self.start_time,
+            self.end_time,
+            (self.end_time - self.start_time).total_seconds(),
+            self.pending_page_views,
+            self.pending_events,
+            self.entry_page,
+            self.exit_page,
+            self.user_agent,
+            self.referrer
+        )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'OpenSession':
+        """Delta back from a row of to_row"""
+        (user_id, session_id, seq, start_time, end_time, _, page_views, events,
+         entry_page, exit_page, user_agent, referrer) = row
+        session = cls(user_id, session_id, start_time, entry_page)
+        session.seq = seq
+        session.end_time = end_time
+        session.exit_page = exit_page
+        session.user_agent = user_agent
+        session.referrer = referrer
+        session.pending_events = events
+        session.pending_page_views = page_views
+        return session
+
+
+class Sessionizer:
+    """Tracks open sessions in a bounded LRU as events are ingested.
+
+    Sessions are extended by each event and closed once no event has arrived
+    for ``inactivity_gap`` (measured on event time, so replays and backfills
+    sessionize the same way). ``drain`` returns one row per session touched
+    since the previous drain, so every ingestion batch costs a single
+    ``executemany`` instead of per-event subqueries. Sessions evicted from the
+    LRU are simply drained early; the database row keeps their history.
+
+    A session id seen again after the gap starts a new session with the next
+    sequence number, and so does an event arriving late that is older than the
+    open session by more than the gap. Sessions whose number isn't known yet
+    (first seen by this process after a restart or an eviction, reopened, or
+    late) continue a stored session of their id when they are within the gap of
+    it, which ``drain`` asks ``lookup`` for.
+    """
+
+    def __init__(self, max_open_sessions: int = DEFAULT_MAX_OPEN_SESSIONS,
+                 inactivity_gap: timedelta = DEFAULT_INACTIVITY_GAP):
+        self.max_open_sessions = max_open_sessions
+        self.inactivity_gap = inactivity_gap
+        self.open_sessions: 'OrderedDict[Tuple[str, str], OpenSession]' = OrderedDict()
+        self.closed_sessions: List[OpenSession] = []
+        self.dirty_sessions: 'Dict[Tuple[str, str], OpenSession]' = {}
+        # Sessions of late events, kept apart so they don't reopen or extend the open session of their id
+        self.late_sessions: List[OpenSession] = []
+        self.clock: Optional[datetime] = None
+        self._lock = threading.Lock()
+
+    def observe(self, user_id: str, session_id: str, event_name: str, properties: Dict[str, Any], timestamp: datetime):
+        """Extend (or open) the session an event belongs to"""
+        page = properties.get('page') or properties.get('url')
+        key = (user_id, session_id)
+        with self._lock:
+            session = self.open_sessions.get(key)
+            if session and session.start_time - timestamp > self.inactivity_gap:
+                self._add_event(self._late_session(key, timestamp, page), event_name, properties, timestamp, page)
+                return
+            if session and timestamp - session.end_time > self.inactivity_gap:
+                # Numbered at drain time, after the session it follows
+                self._close(key)
+                session = None
+            if session is None:
+                session = OpenSession(user_id, session_id, timestamp, page)
+                self.open_sessions[key] = session
+                if len(self.open_sessions) > self.max_open_sessions:
+                    self._close(next(iter(self.open_sessions)))
+            else:
+                self.open_sessions.move_to_end(key)
+
+            self._add_event(session, event_name, properties, timestamp, page)
+            self.dirty_sessions[key] = session
+            if self.clock is None or timestamp > self.clock:
+                self.clock = timestamp
+
+    def _late_session(self, key: Tuple[str, str], timestamp: datetime, page: Optional[str]) -> OpenSession:
+        for session in self.late_sessions:
+            if ((session.user_id, session.session_id) == key
+                    and timestamp - session.end_time <= self.inactivity_gap
+                    and session.start_time - timestamp <= self.inactivity_gap):
+                return session
+        session = OpenSession(key[0], key[1], timestamp, page)
+        self.late_sessions.append(session)
+        return session
+
+    @staticmethod
+    def _add_event(session: OpenSession, event_name: str, properties: Dict[str, Any], timestamp: datetime,
+                   page: Optional[str]):
+        if timestamp < session.start_time:
+            session.start_time = timestamp
+            session.entry_page = page or session.entry_page
+        if timestamp >= session.end_time:
+            session.end_time = timestamp
+            session.exit_page = page or session.exit_page
+        session.pending_events += 1
+        if event_name == 'page_viewed':
+            session.pending_page_views += 1
+        session.user_agent = session.user_agent or properties.get('userAgent', '')
+        session.referrer = session.referrer or properties.get('referrer', '')
+
+    def drain(self, lookup: Optional[SessionLookup] = None) -> List[tuple]:
+        """Close inactive sessions and return the rows to upsert for every session with pending counts.
+
+        ``lookup`` is a ``SessionLookup``. Rows whose write fails must be handed back to ``requeue``.
+        """
+        with self._lock:
+            # Least recently extended sessions come first, so stop at the first one still active
+            while self.open_sessions and self.clock is not None:
+                key, session = next(iter(self.open_sessions.items()))
+                if self.clock - session.end_time <= self.inactivity_gap:
+                    break
+                self._close(key)
+
+            # Closed sessions come first, so a session reopened since sees them as the latest, and late
+            # sessions last, so they can't take the number of a session continuing a stored one
+            known: Dict[Tuple[str, str], Tuple[int, List[SessionSpan]]] = {}
+            rows = []
+            for session in self.closed_sessions:
+                self._resolve_seq(session, known, lookup)
+                rows.append(session.to_row())
+            self.closed_sessions = []
+            for session in self.dirty_sessions.values():
+                self._resolve_seq(session, known, lookup)
+                rows.append(session.to_row())
+                session.pending_events = 0
+                session.pending_page_views = 0
+            self.dirty_sessions = {}
+            for session in self.late_sessions:
+                self._resolve_seq(session, known, lookup)
+                rows.append(session.to_row())
+            self.late_sessions = []
+            return rows
+
+    def requeue(self, rows: List[tuple]):
+        """Hand back drained rows that were not written, so the next drain writes them again"""
+        with self._lock:
+            # The upsert merges deltas of the same session, so they can go back as closed deltas
+            self.closed_sessions[:0] = [OpenSession.from_row(row) for row in rows]
+
+    def _resolve_seq(self, session: OpenSession, known: Dict[Tuple[str, str], Tuple[int, List[SessionSpan]]],
+                     lookup: Optional[SessionLookup]):
+        """Number a session, continuing a session of its id drained or stored before when within the gap"""
+        key = (session.user_id, session.session_id)
+        max_seq, spans = known.get(key, (-1, []))
+        if session.seq is None:
+            candidates = list(spans)
+            stored = lookup(*key, session.end_time + self.inactivity_gap) if lookup else None
+            if stored is not None:
+                candidates.append(stored[:3])
+                max_seq = max(max_seq, stored[3])
+            for seq, start_time, end_time in sorted(candidates, key=lambda span: span[2], reverse=True):
+                if (session.start_time - end_time <= self.inactivity_gap
+                        and start_time - session.end_time <= self.inactivity_gap):
+                    session.seq = seq
+                    break
+            else:
+                session.seq = max_seq + 1
+        known[key] = (max(max_seq, session.seq), spans + [(session.seq, session.start_time, session.end_time)])
+
+    def _close(self, key: Tuple[str, str]):
+        session = self.open_sessions.pop(key)
+        self.dirty_sessions.pop(key, None)
+        if session.pending_events:
+            self.closed_sessions.append(session)
@@ -1,3 +1,4 @@
+import asyncio
 import json
 import logging
 import os
@@ -18,6 +19,9 @@ from quart import (
 from quart_cors import cors
 import aiofiles
 
+from analytics_handler import analytics_handler
+from analytics_ingest import AnalyticsIngestQueue, IngestError, iter_ndjson_events
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -42,6 +46,12 @@ class Config:
         self.enable_interview_prep = os.getenv("ENABLE_INTERVIEW_PREP", "true").lower() == "true"
         self.enable_skill_assessment = os.getenv("ENABLE_SKILL_ASSESSMENT", "true").lower() == "true"
         
+        # Analytics ingestion (bounded so event bursts cannot starve the main API)
+        self.analytics_ingest_max_chunks = int(os.getenv("ANALYTICS_INGEST_MAX_CHUNKS", "64"))
+        self.analytics_ingest_chunk_size = int(os.getenv("ANALYTICS_INGEST_CHUNK_SIZE", "500"))
+        # Seconds between syncs of a backend with its own copy of the events (DuckDB); set it in one process only
+        self.analytics_backend_sync_interval = float(os.getenv("ANALYTICS_BACKEND_SYNC_INTERVAL", "0"))
+        
         # Disabled expensive features
         self.use_vectors = False
         self.use_search = False
@@ -49,6 +59,12 @@ class Config:
 
 config = Config()
 
+analytics_ingest_queue = AnalyticsIngestQueue(
+    analytics_handler,
+    max_chunks=config.analytics_ingest_max_chunks,
+    chunk_size=config.analytics_ingest_chunk_size
+)
+
 # Initialize Azure OpenAI client
 try:
     openai_client = AsyncAzureOpenAI(
@@ -442,6 +458,51 @@ async def skill_assessment():
         logger.error(f"Skill assessment error: {e}")
         return jsonify({"error": "Failed to assess skills"}), 500
 
+@app.route("/api/analytics/events", methods=["POST"])
+async def ingest_analytics_events():
+    """Accept a stream of (optionally gzip-compressed) NDJSON analytics events"""
+    def too_many_requests(accepted: int, rejected: int):
+        # Only whole chunks are settled, "consumed" counts the leading lines of the body the client must not resend
+        response = jsonify({
+            "error": "Analytics ingestion is busy, retry later",
+            "accepted": accepted,
+            "rejected": rejected,
+            "consumed": accepted + rejected
+        })
+        response.headers["Retry-After"] = str(analytics_ingest_queue.retry_after())
+        return response, 429
+    
+    if analytics_ingest_queue.is_full():
+        return too_many_requests(0, 0)
+    
+    gzip_encoded = request.headers.get("Content-Encoding", "").lower() == "gzip"
+    accepted = 0
+    rejected = 0
+    chunk = []
+    chunk_rejected = 0
+    try:
+        async for event in iter_ndjson_events(request.body, gzip_encoded):
+            if event is None:
+                chunk_rejected += 1
+                continue
+            chunk.append(event)
+            if len(chunk) >= analytics_ingest_queue.chunk_size:
+                # Lines before this chunk are already settled; the client resends from "consumed" onwards
+                if not analytics_ingest_queue.try_enqueue(chunk):
+                    return too_many_requests(accepted, rejected)
+                accepted += len(chunk)
+                rejected += chunk_rejected
+                chunk = []
+                chunk_rejected = 0
+        if chunk and not analytics_ingest_queue.try_enqueue(chunk):
+            return too_many_requests(accepted, rejected)
+        accepted += len(chunk)
+        rejected += chunk_rejected
+    except IngestError as e:
+        return jsonify({"error": str(e), "accepted": accepted, "rejected": rejected + chunk_rejected}), 400
+    
+    return jsonify({"accepted": accepted, "rejected": rejected}), 202
+
 @app.route("/api/health")
 async def health_check():
     """Health check endpoint"""
@@ -489,12 +550,29 @@ async def health_check():
 # Error handlers
 @app.errorhandler(404)
 async def not_found(error):
-    return jsonify({"error": "Endpoint not found", "available_endpoints": ["/", "/config", "/api/health", "/api/career-chat", "/api/resume-analysis", "/api/interview-prep", "/api/skill-assessment"]}), 404
+    return jsonify({"error": "Endpoint not found", "available_endpoints": ["/", "/config", "/api/health", "/api/career-chat", "/api/resume-analysis", "/api/interview-prep", "/api/skill-assessment", "/api/analytics/events"]}), 404
 
 @app.errorhandler(500)
 async def internal_error(error):
     return jsonify({"error": "Internal server error"}), 500
 
+analytics_backend_sync_task: Optional[asyncio.Task] = None
+
+@app.before_serving
+async def start_analytics_ingestion():
+    global analytics_backend_sync_task
+    await analytics_ingest_queue.start()
+    if config.analytics_backend_sync_interval > 0:
+        analytics_backend_sync_task = asyncio.create_task(
+            analytics_handler.run_backend_sync(config.analytics_backend_sync_interval)
+        )
+
+@app.after_serving
+async def stop_analytics_ingestion():
+    await analytics_ingest_queue.stop()
+    if analytics_backend_sync_task is not None:
+        analytics_backend_sync_task.cancel()
+
 # Initialize app on module import
 logger.info("🚀 Starting AI Career Navigator - Optimized for GPT-4.1")
 logger.info(f"📍 Azure OpenAI Endpoint: {config.azure_openai_endpoint}")
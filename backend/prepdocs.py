@@ -12,14 +12,17 @@ from rich.logging import RichHandler
 from load_azd_env import load_azd_env
 from prepdocslib.blobmanager import BlobManager
 from prepdocslib.csvparser import CsvParser
+from prepdocslib.embeddingcache import EmbeddingCache
 from prepdocslib.embeddings import (
     AzureOpenAIEmbeddingService,
     ImageEmbeddings,
     OpenAIEmbeddingService,
 )
+from prepdocslib.filemanifest import DEFAULT_FILE_MANIFEST_PATH
 from prepdocslib.fileprocessor import FileProcessor
 from prepdocslib.filestrategy import FileStrategy
 from prepdocslib.htmlparser import LocalHTMLParser
+from prepdocslib.indexmanifest import IndexManifest
 from prepdocslib.integratedvectorizerstrategy import (
     IntegratedVectorizerStrategy,
 )
@@ -31,6 +34,7 @@ from prepdocslib.listfilestrategy import (
 )
 from prepdocslib.parser import Parser
 from prepdocslib.pdfparser import DocumentAnalysisParser, LocalPdfParser
+from prepdocslib.pipeline import PipelineConcurrency
 from prepdocslib.strategy import DocumentAction, SearchInfo, Strategy
 from prepdocslib.textparser import TextParser
 from prepdocslib.textsplitter import SentenceTextSplitter, SimpleTextSplitter
@@ -104,6 +108,10 @@ def setup_list_file_strategy(
     datalake_filesystem: Union[str, None],
     datalake_path: Union[str, None],
     datalake_key: Union[str, None],
+    file_manifest_path: str = DEFAULT_FILE_MANIFEST_PATH,
+    include: Optional[list[str]] = None,
+    exclude: Optional[list[str]] = None,
+    extensions: Optional[list[str]] = None,
 ):
     list_file_strategy: ListFileStrategy
     if datalake_storage_account:
@@ -119,7 +127,13 @@ def setup_list_file_strategy(
         )
     elif local_files:
         logger.info("Using local files: %s", local_files)
-        list_file_strategy = LocalListFileStrategy(path_pattern=local_files)
+        list_file_strategy = LocalListFileStrategy(
+            path_pattern=local_files,
+            manifest_path=file_manifest_path,
+            include=include,
+            exclude=exclude,
+            extensions=extensions,
+        )
     else:
         raise ValueError("Either local_files or datalake_storage_account must be provided.")
     return list_file_strategy
@@ -138,6 +152,9 @@ def setup_embeddings_service(
     openai_org: Union[str, None],
     disable_vectors: bool = False,
     disable_batch_vectors: bool = False,
+    requests_per_minute: Optional[int] = None,
+    tokens_per_minute: Optional[int] = None,
+    cache: Optional[EmbeddingCache] = None,
 ):
     if disable_vectors:
         logger.info("Not setting up embeddings service")
@@ -156,6 +173,9 @@ def setup_embeddings_service(
             open_ai_api_version=openai_api_version,
             credential=azure_open_ai_credential,
             disable_batch=disable_batch_vectors,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            cache=cache,
         )
     else:
         if openai_key is None:
@@ -166,6 +186,9 @@ def setup_embeddings_service(
             credential=openai_key,
             organization=openai_org,
             disable_batch=disable_batch_vectors,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            cache=cache,
         )
 
 
@@ -178,8 +201,9 @@ def setup_file_processors(
     search_images: bool = False,
     use_content_understanding: bool = False,
     content_understanding_endpoint: Union[str, None] = None,
+    split_by_token_offsets: bool = False,
 ):
-    sentence_text_splitter = SentenceTextSplitter()
+    sentence_text_splitter = SentenceTextSplitter(split_by_token_offsets=split_by_token_offsets)
 
     doc_int_parser: Optional[DocumentAnalysisParser] = None
     # check if Azure Document Intelligence credentials are provided
@@ -276,6 +300,52 @@ if __name__ == "__main__":
     parser.add_argument(
         "--disablebatchvectors", action="store_true", help="Don't compute embeddings in batch for the sections"
     )
+    parser.add_argument(
+        "--embeddingcache",
+        required=False,
+        help="Optional. Directory of a persistent embedding cache, so unchanged sections are not embedded again",
+    )
+    parser.add_argument(
+        "--embeddingcachemaxmb",
+        type=float,
+        required=False,
+        help="Optional. Evict the least recently used cached embeddings beyond this size",
+    )
+    parser.add_argument(
+        "--include",
+        action="append",
+        help="Only ingest local files whose path or name matches this pattern, e.g. '*.pdf' (can be repeated)",
+    )
+    parser.add_argument(
+        "--exclude",
+        action="append",
+        help="Skip local files and directories whose path or name matches this pattern (can be repeated)",
+    )
+    parser.add_argument(
+        "--extensions", help="Only ingest local files with one of these comma-separated extensions, e.g. 'pdf,docx'"
+    )
+    parser.add_argument(
+        "--filemanifest",
+        default=DEFAULT_FILE_MANIFEST_PATH,
+        help=f"Path of the manifest recording the local files already ingested (default: {DEFAULT_FILE_MANIFEST_PATH})",
+    )
+    parser.add_argument(
+        "--indexmanifest",
+        required=False,
+        help="Optional. Path of a local manifest of the indexed sections, so re-ingesting an edited file only uploads the sections that changed and deletes the removed ones",
+    )
+    parser.add_argument(
+        "--parseconcurrency", type=int, default=4, help="Number of files parsed concurrently (default: 4)"
+    )
+    parser.add_argument(
+        "--splitconcurrency", type=int, default=2, help="Number of files split into sections concurrently (default: 2)"
+    )
+    parser.add_argument(
+        "--embedconcurrency", type=int, default=4, help="Number of files uploaded and embedded concurrently (default: 4)"
+    )
+    parser.add_argument(
+        "--indexconcurrency", type=int, default=2, help="Number of files indexed concurrently (default: 2)"
+    )
     parser.add_argument(
         "--remove",
         action="store_true",
@@ -388,6 +458,10 @@ if __name__ == "__main__":
         datalake_filesystem=os.getenv("AZURE_ADLS_GEN2_FILESYSTEM"),
         datalake_path=os.getenv("AZURE_ADLS_GEN2_FILESYSTEM_PATH"),
         datalake_key=clean_key_if_exists(args.datalakekey),
+        file_manifest_path=args.filemanifest,
+        include=args.include,
+        exclude=args.exclude,
+        extensions=args.extensions.split(",") if args.extensions else None,
     )
 
     openai_host = os.environ["OPENAI_HOST"]
@@ -414,6 +488,17 @@ if __name__ == "__main__":
         openai_org=os.getenv("OPENAI_ORGANIZATION"),
         disable_vectors=dont_use_vectors,
         disable_batch_vectors=args.disablebatchvectors,
+        # Optional quota of the embedding deployment, otherwise learned from the rate limit response headers
+        requests_per_minute=int(os.getenv("AZURE_OPENAI_EMB_RPM", "0")) or None,
+        tokens_per_minute=int(os.getenv("AZURE_OPENAI_EMB_TPM", "0")) or None,
+        cache=(
+            EmbeddingCache(
+                args.embeddingcache,
+                max_bytes=int(args.embeddingcachemaxmb * 1024 * 1024) if args.embeddingcachemaxmb else None,
+            )
+            if args.embeddingcache
+            else None
+        ),
     )
 
     ingestion_strategy: Strategy
@@ -445,6 +530,7 @@ if __name__ == "__main__":
             search_images=use_gptvision,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            split_by_token_offsets=os.getenv("USE_TOKEN_OFFSET_SPLITTER") == "true",
         )
         image_embeddings_service = setup_image_embeddings_service(
             azure_credential=azd_credential,
@@ -467,6 +553,13 @@ if __name__ == "__main__":
             category=args.category,
             use_content_understanding=use_content_understanding,
             content_understanding_endpoint=os.getenv("AZURE_CONTENTUNDERSTANDING_ENDPOINT"),
+            concurrency=PipelineConcurrency(
+                parse=args.parseconcurrency,
+                split=args.splitconcurrency,
+                embed=args.embedconcurrency,
+                index=args.indexconcurrency,
+            ),
+            index_manifest=IndexManifest(args.indexmanifest) if args.indexmanifest else None,
         )
 
     loop.run_until_complete(main(ingestion_strategy, setup_index=not args.remove and not args.removeall))
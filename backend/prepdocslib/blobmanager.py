@@ -1,8 +1,13 @@
+import asyncio
 import datetime
 import io
 import logging
 import os
 import re
+import time
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 from typing import Optional, Union
 
 import pymupdf
@@ -14,12 +19,78 @@ from azure.storage.blob import (
 )
 from azure.storage.blob.aio import BlobServiceClient, ContainerClient
 from PIL import Image, ImageDraw, ImageFont
-from pypdf import PdfReader
 
 from .listfilestrategy import File
 
 logger = logging.getLogger("scripts")
 
+# How long the SAS URLs of page images stay valid
+SAS_VALIDITY = datetime.timedelta(days=1)
+
+# How many open documents each rendering process keeps, for PDFs processed concurrently
+RENDER_DOCUMENTS_CACHED = 4
+
+# Set up in each rendering process by load_render_font and open_render_document
+_render_docs: "OrderedDict[tuple[str, int], pymupdf.Document]" = OrderedDict()
+_render_font: Optional[ImageFont.FreeTypeFont] = None
+
+
+def load_render_font():
+    global _render_font
+    try:
+        _render_font = ImageFont.truetype("arial.ttf", 20)
+    except OSError:
+        try:
+            _render_font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
+        except OSError:
+            logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
+
+
+def open_render_document(path: str, mtime_ns: int) -> pymupdf.Document:
+    """
+    Open a document once per rendering process, keyed by its modification time so a rewritten file is reopened
+    """
+    key = (path, mtime_ns)
+    doc = _render_docs.get(key)
+    if doc is None:
+        doc = pymupdf.open(path)
+        _render_docs[key] = doc
+        if len(_render_docs) > RENDER_DOCUMENTS_CACHED:
+            _, evicted = _render_docs.popitem(last=False)
+            evicted.close()
+    else:
+        _render_docs.move_to_end(key)
+    return doc
+
+
+def render_page_image(path: str, mtime_ns: int, page_number: int, blob_name: str) -> bytes:
+    """
+    Render a page of a document as a PNG, with the blob name written above it
+    """
+    page = open_render_document(path, mtime_ns).load_page(page_number)
+    pix = page.get_pixmap()
+    original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
+
+    # Create a new image with additional space for text
+    text_height = 40  # Height of the text area
+    new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
+
+    # Paste the original image onto the new image
+    new_img.paste(original_img, (0, text_height))
+
+    # Draw the text on the white area
+    draw = ImageDraw.Draw(new_img)
+    text = f"SourceFileName:{blob_name}"
+
+    # 10 pixels from the top and left of the image
+    x = 10
+    y = 10
+    draw.text((x, y), text, font=_render_font, fill="black")
+
+    output = io.BytesIO()
+    new_img.save(output, format="PNG")
+    return output.getvalue()
+
 
 class BlobManager:
     """
@@ -35,6 +106,8 @@ class BlobManager:
         resourceGroup: str,
         subscriptionId: str,
         store_page_images: bool = False,
+        render_processes: Optional[int] = None,
+        upload_concurrency: int = 8,
     ):
         self.endpoint = endpoint
         self.credential = credential
@@ -44,123 +117,193 @@ class BlobManager:
         self.resourceGroup = resourceGroup
         self.subscriptionId = subscriptionId
         self.user_delegation_key: Optional[UserDelegationKey] = None
+        self.user_delegation_key_expiry: Optional[datetime.datetime] = None
+        self.render_processes = render_processes or max(1, (os.cpu_count() or 1) // 2)
+        self.upload_concurrency = upload_concurrency
+        self.service_client: Optional[BlobServiceClient] = None
+        self.container_client: Optional[ContainerClient] = None
+        self.container_known_to_exist = False
+        self.container_lock = asyncio.Lock()
+        # Shared by every PDF of the run, so concurrent files don't each start a process per core
+        self.render_executor: Optional[ProcessPoolExecutor] = None
+        # Pages being rendered or uploaded, across files, so rendered images can't pile up ahead of the uploads
+        self.page_semaphore = asyncio.Semaphore(upload_concurrency)
+
+    async def open(self):
+        """Open the clients shared by every upload and removal of the run"""
+        if self.service_client is None:
+            self.service_client = BlobServiceClient(
+                account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
+            )
+            self.container_client = self.service_client.get_container_client(self.container)
+
+    async def close(self):
+        if self.render_executor is not None:
+            executor, self.render_executor = self.render_executor, None
+            # Waiting for the worker processes to exit would block the event loop
+            await asyncio.to_thread(executor.shutdown, wait=True, cancel_futures=True)
+        if self.container_client is not None:
+            await self.container_client.close()
+            self.container_client = None
+        if self.service_client is not None:
+            await self.service_client.close()
+            self.service_client = None
+
+    async def __aenter__(self) -> "BlobManager":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_clients(self) -> tuple[BlobServiceClient, ContainerClient]:
+        # Opened on first use when the manager isn't used with async with, close() must then be called
+        if self.service_client is None or self.container_client is None:
+            await self.open()
+        return self.service_client, self.container_client  # type: ignore[return-value]
+
+    async def container_exists(self, create: bool = False) -> bool:
+        """Whether the container exists, only asked to the service until it is known to"""
+        _, container_client = await self.get_clients()
+        async with self.container_lock:
+            if not self.container_known_to_exist:
+                if await container_client.exists():
+                    self.container_known_to_exist = True
+                elif create:
+                    await container_client.create_container()
+                    self.container_known_to_exist = True
+        return self.container_known_to_exist
 
     async def upload_blob(self, file: File) -> Optional[list[str]]:
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential, max_single_put_size=4 * 1024 * 1024
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
-                await container_client.create_container()
-
-            # Re-open and upload the original file
-            if file.url is None:
-                with open(file.content.name, "rb") as reopened_file:
-                    blob_name = BlobManager.blob_name_from_file_name(file.content.name)
-                    logger.info("Uploading blob for whole file -> %s", blob_name)
-                    blob_client = await container_client.upload_blob(blob_name, reopened_file, overwrite=True)
-                    file.url = blob_client.url
-
-            if self.store_page_images:
-                if os.path.splitext(file.content.name)[1].lower() == ".pdf":
-                    return await self.upload_pdf_blob_images(service_client, container_client, file)
-                else:
-                    logger.info("File %s is not a PDF, skipping image upload", file.content.name)
+        await self.container_exists(create=True)
+        _, container_client = await self.get_clients()
+
+        # Re-open and upload the original file
+        if file.url is None:
+            with open(file.content.name, "rb") as reopened_file:
+                blob_name = BlobManager.blob_name_from_file_name(file.content.name)
+                logger.info("Uploading blob for whole file -> %s", blob_name)
+                # Small files go in a single request, larger ones as blocks uploaded in parallel
+                blob_client = await container_client.upload_blob(
+                    blob_name, reopened_file, overwrite=True, max_concurrency=self.upload_concurrency
+                )
+                file.url = blob_client.url
+
+        if self.store_page_images:
+            if os.path.splitext(file.content.name)[1].lower() == ".pdf":
+                return await self.upload_pdf_blob_images(file)
+            else:
+                logger.info("File %s is not a PDF, skipping image upload", file.content.name)
 
         return None
 
+    def get_render_executor(self) -> ProcessPoolExecutor:
+        # Started on first use, shut down by close()
+        if self.render_executor is None:
+            self.render_executor = ProcessPoolExecutor(max_workers=self.render_processes, initializer=load_render_font)
+        return self.render_executor
+
     def get_managedidentity_connectionstring(self):
         return f"ResourceId=/subscriptions/{self.subscriptionId}/resourceGroups/{self.resourceGroup}/providers/Microsoft.Storage/storageAccounts/{self.account};"
 
-    async def upload_pdf_blob_images(
-        self, service_client: BlobServiceClient, container_client: ContainerClient, file: File
-    ) -> list[str]:
-        with open(file.content.name, "rb") as reopened_file:
-            reader = PdfReader(reopened_file)
-            page_count = len(reader.pages)
-        doc = pymupdf.open(file.content.name)
-        sas_uris = []
+    async def get_user_delegation_key(self, service_client: BlobServiceClient) -> UserDelegationKey:
+        """User delegation key for signing SAS URLs, requested once and renewed before it expires"""
+        now = datetime.datetime.now(datetime.timezone.utc)
+        if (
+            self.user_delegation_key is None
+            or self.user_delegation_key_expiry is None
+            or self.user_delegation_key_expiry - now < SAS_VALIDITY
+        ):
+            expiry = now + 2 * SAS_VALIDITY
+            self.user_delegation_key = await service_client.get_user_delegation_key(now, expiry)
+            self.user_delegation_key_expiry = expiry
+        return self.user_delegation_key
+
+    async def upload_pdf_blob_images(self, file: File) -> list[str]:
+        service_client, container_client = await self.get_clients()
+        path = file.content.name
+        with pymupdf.open(path) as doc:
+            page_count = doc.page_count
+        mtime_ns = os.stat(path).st_mtime_ns
         start_time = datetime.datetime.now(datetime.timezone.utc)
-        expiry_time = start_time + datetime.timedelta(days=1)
+        expiry_time = start_time + SAS_VALIDITY
+        user_delegation_key = await self.get_user_delegation_key(service_client)
+        executor = self.get_render_executor()
+        started = time.perf_counter()
 
-        font = None
-        try:
-            font = ImageFont.truetype("arial.ttf", 20)
-        except OSError:
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/freefont/FreeMono.ttf", 20)
-            except OSError:
-                logger.info("Unable to find arial.ttf or FreeMono.ttf, using default font")
-
-        for i in range(page_count):
-            blob_name = BlobManager.blob_image_name_from_file_page(file.content.name, i)
-            logger.info("Converting page %s to image and uploading -> %s", i, blob_name)
-
-            doc = pymupdf.open(file.content.name)
-            page = doc.load_page(i)
-            pix = page.get_pixmap()
-            original_img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)  # type: ignore
-
-            # Create a new image with additional space for text
-            text_height = 40  # Height of the text area
-            new_img = Image.new("RGB", (original_img.width, original_img.height + text_height), "white")
-
-            # Paste the original image onto the new image
-            new_img.paste(original_img, (0, text_height))
-
-            # Draw the text on the white area
-            draw = ImageDraw.Draw(new_img)
-            text = f"SourceFileName:{blob_name}"
-
-            # 10 pixels from the top and left of the image
-            x = 10
-            y = 10
-            draw.text((x, y), text, font=font, fill="black")
-
-            output = io.BytesIO()
-            new_img.save(output, format="PNG")
-            output.seek(0)
-
-            blob_client = await container_client.upload_blob(blob_name, output, overwrite=True)
-            if not self.user_delegation_key:
-                self.user_delegation_key = await service_client.get_user_delegation_key(start_time, expiry_time)
-
-            if blob_client.account_name is not None:
-                sas_token = generate_blob_sas(
-                    account_name=blob_client.account_name,
-                    container_name=blob_client.container_name,
-                    blob_name=blob_client.blob_name,
-                    user_delegation_key=self.user_delegation_key,
-                    permission=BlobSasPermissions(read=True),
-                    expiry=expiry_time,
-                    start=start_time,
+        loop = asyncio.get_running_loop()
+
+        async def render_and_upload(page_number: int) -> Optional[str]:
+            blob_name = BlobManager.blob_image_name_from_file_page(path, page_number)
+            # Held from rendering to the end of the upload, so only this many images are in memory
+            async with self.page_semaphore:
+                logger.info("Converting page %s to image and uploading -> %s", page_number, blob_name)
+                image = await loop.run_in_executor(
+                    executor, render_page_image, path, mtime_ns, page_number, blob_name
                 )
-                sas_uris.append(f"{blob_client.url}?{sas_token}")
+                blob_client = await container_client.upload_blob(blob_name, image, overwrite=True)
+            if blob_client.account_name is None:
+                return None
+            sas_token = generate_blob_sas(
+                account_name=blob_client.account_name,
+                container_name=blob_client.container_name,
+                blob_name=blob_client.blob_name,
+                user_delegation_key=user_delegation_key,
+                permission=BlobSasPermissions(read=True),
+                expiry=expiry_time,
+                start=start_time,
+            )
+            return f"{blob_client.url}?{sas_token}"
 
-        return sas_uris
+        # Pages are rendered in the shared worker processes, which keep the document open between pages, and
+        # uploaded as soon as they are rendered. Results are gathered in page order, since image embeddings are
+        # indexed by page.
+        tasks = [asyncio.create_task(render_and_upload(i)) for i in range(page_count)]
+        try:
+            sas_uris = await asyncio.gather(*tasks)
+        except BrokenProcessPool:
+            # A crashed worker breaks the whole pool, start a new one for the next file
+            if self.render_executor is executor:
+                self.render_executor = None
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        finally:
+            # One page failing fails the file, cancel the pages not rendered yet
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+
+        elapsed = time.perf_counter() - started
+        logger.info(
+            "Uploaded %d page images of '%s' in %.1fs (%.1f pages/s)",
+            page_count,
+            os.path.basename(file.content.name),
+            elapsed,
+            page_count / elapsed if elapsed else 0.0,
+        )
+        return [sas_uri for sas_uri in sas_uris if sas_uri is not None]
 
     async def remove_blob(self, path: Optional[str] = None):
-        async with BlobServiceClient(
-            account_url=self.endpoint, credential=self.credential
-        ) as service_client, service_client.get_container_client(self.container) as container_client:
-            if not await container_client.exists():
-                return
-            if path is None:
-                prefix = None
-                blobs = container_client.list_blob_names()
-            else:
-                prefix = os.path.splitext(os.path.basename(path))[0]
-                blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
-            async for blob_path in blobs:
-                # This still supports PDFs split into individual pages, but we could remove in future to simplify code
-                if (
-                    prefix is not None
-                    and (
-                        not re.match(rf"{prefix}-\d+\.pdf", blob_path) or not re.match(rf"{prefix}-\d+\.png", blob_path)
-                    )
-                ) or (path is not None and blob_path == os.path.basename(path)):
-                    continue
-                logger.info("Removing blob %s", blob_path)
-                await container_client.delete_blob(blob_path)
+        if not await self.container_exists():
+            return
+        _, container_client = await self.get_clients()
+        if path is None:
+            prefix = None
+            blobs = container_client.list_blob_names()
+        else:
+            prefix = os.path.splitext(os.path.basename(path))[0]
+            blobs = container_client.list_blob_names(name_starts_with=os.path.splitext(os.path.basename(prefix))[0])
+        async for blob_path in blobs:
+            # This still supports PDFs split into individual pages, but we could remove in future to simplify code
+            if (
+                prefix is not None
+                and (
+                    not re.match(rf"{prefix}-\d+\.pdf", blob_path) or not re.match(rf"{prefix}-\d+\.png", blob_path)
+                )
+            ) or (path is not None and blob_path == os.path.basename(path)):
+                continue
+            logger.info("Removing blob %s", blob_path)
+            await container_client.delete_blob(blob_path)
 
     @classmethod
     def sourcepage_from_file_page(cls, filename, page=0) -> str:
@@ -0,0 +1,315 @@
+import hashlib
+import logging
+import mmap
+import os
+import re
+import sqlite3
+import struct
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger("scripts")
+
+DTYPE_FORMATS = {"float32": "f", "float16": "e"}
+INITIAL_SLOTS = 1024
+
+
+class VectorFile:
+    """
+    Fixed-size vector records in a memory-mapped file, addressed by slot number
+    """
+
+    def __init__(self, path: str, dimensions: int, dtype: str):
+        self.path = path
+        self.record_format = f"<{dimensions}{DTYPE_FORMATS[dtype]}"
+        self.record_size = struct.calcsize(self.record_format)
+        self.file = open(path, "a+b")
+        self.mmap: Optional[mmap.mmap] = None
+        self._map()
+
+    def _map(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        size = os.fstat(self.file.fileno()).st_size
+        if size:
+            self.mmap = mmap.mmap(self.file.fileno(), size)
+
+    @property
+    def capacity(self) -> int:
+        return len(self.mmap) // self.record_size if self.mmap is not None else 0
+
+    def read(self, slot: int) -> list[float]:
+        return list(struct.unpack_from(self.record_format, self.mmap, slot * self.record_size))
+
+    def write(self, slot: int, vector: list[float]):
+        if slot >= self.capacity:
+            # Grow geometrically so appends stay amortized O(1)
+            self.file.truncate(max(slot + 1, 2 * self.capacity, INITIAL_SLOTS) * self.record_size)
+            self._map()
+        struct.pack_into(self.record_format, self.mmap, slot * self.record_size, *vector)
+
+    def flush(self):
+        if self.mmap is not None:
+            self.mmap.flush()
+
+    def close(self):
+        if self.mmap is not None:
+            self.mmap.close()
+            self.mmap = None
+        self.file.close()
+
+
+class EmbeddingCache:
+    """
+    Persistent embedding cache keyed by (model, dimensions, sha256 of the text).
+
+    Vectors live in one memory-mapped file per model and dimension count, and an
+    SQLite index maps each text hash to its slot in that file. When max_bytes is
+    set, the least recently used vectors are evicted and their slots reused;
+    gc() also compacts the files so their size on disk drops.
+    """
+
+    def __init__(self, directory: str, max_bytes: Optional[int] = None, dtype: str = "float32"):
+        if dtype not in DTYPE_FORMATS:
+            raise ValueError(f"Unsupported embedding cache dtype '{dtype}', expected one of {list(DTYPE_FORMATS)}")
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.dtype = dtype
+        self.files: dict[str, VectorFile] = {}
+        # Embeddings are looked up and stored from worker threads, the lock serializes them on the connection
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(directory, "index.db"), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS vector_files (
+                name TEXT PRIMARY KEY,
+                dimensions INTEGER NOT NULL,
+                dtype TEXT NOT NULL,
+                next_slot INTEGER NOT NULL DEFAULT 0,
+                generation INTEGER NOT NULL DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS vectors (
+                file TEXT NOT NULL,
+                text_hash BLOB NOT NULL,
+                slot INTEGER NOT NULL,
+                last_used REAL NOT NULL,
+                PRIMARY KEY (file, text_hash)
+            );
+            CREATE INDEX IF NOT EXISTS idx_vectors_last_used ON vectors(last_used);
+            CREATE TABLE IF NOT EXISTS free_slots (
+                file TEXT NOT NULL,
+                slot INTEGER NOT NULL,
+                PRIMARY KEY (file, slot)
+            );
+            """
+        )
+
+    @staticmethod
+    def text_hash(text: str) -> bytes:
+        return hashlib.sha256(text.encode("utf-8")).digest()
+
+    def _file_name(self, model: str, dimensions: int, dtype: Optional[str] = None) -> str:
+        return f"{re.sub('[^0-9a-zA-Z_.-]', '_', model)}-{dimensions}-{dtype or self.dtype}.vec"
+
+    def _vector_path(self, name: str, generation: int) -> str:
+        return os.path.join(self.directory, f"{name}.{generation}")
+
+    def _vector_file(self, name: str) -> VectorFile:
+        vector_file = self.files.get(name)
+        if vector_file is None:
+            dimensions, dtype, generation = self.conn.execute(
+                "SELECT dimensions, dtype, generation FROM vector_files WHERE name = ?", (name,)
+            ).fetchone()
+            vector_file = VectorFile(self._vector_path(name, generation), dimensions, dtype)
+            self.files[name] = vector_file
+        return vector_file
+
+    def _slots(self, name: str, hashes: list[bytes]) -> dict[bytes, int]:
+        slots: dict[bytes, int] = {}
+        # Stay well below SQLite's bound parameter limit
+        for start in range(0, len(hashes), 500):
+            chunk = hashes[start : start + 500]
+            rows = self.conn.execute(
+                f"SELECT text_hash, slot FROM vectors WHERE file = ? AND text_hash IN ({','.join('?' * len(chunk))})",
+                (name, *chunk),
+            ).fetchall()
+            slots.update(rows)
+        return slots
+
+    def get_many(self, model: str, dimensions: int, texts: list[str]) -> list[Optional[list[float]]]:
+        """Return the cached embedding of each text, or None for misses"""
+        name = self._file_name(model, dimensions)
+        hashes = [self.text_hash(text) for text in texts]
+        with self._lock:
+            slots = self._slots(name, hashes)
+            if not slots:
+                return [None] * len(texts)
+
+            vector_file = self._vector_file(name)
+            now = time.time()
+            self.conn.executemany(
+                "UPDATE vectors SET last_used = ? WHERE file = ? AND text_hash = ?",
+                [(now, name, text_hash) for text_hash in slots],
+            )
+            self.conn.commit()
+            return [vector_file.read(slots[text_hash]) if text_hash in slots else None for text_hash in hashes]
+
+    def put_many(self, model: str, dimensions: int, texts: list[str], embeddings: list[list[float]]):
+        """Store embeddings, evicting the least recently used ones beyond max_bytes"""
+        name = self._file_name(model, dimensions)
+        vectors: dict[bytes, list[float]] = {}
+        for text, embedding in zip(texts, embeddings):
+            if len(embedding) != dimensions:
+                logger.warning("Not caching an embedding of %d dimensions, expected %d", len(embedding), dimensions)
+                continue
+            vectors[self.text_hash(text)] = embedding
+        if not vectors:
+            return
+
+        with self._lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO vector_files (name, dimensions, dtype) VALUES (?, ?, ?)",
+                (name, dimensions, self.dtype),
+            )
+            vector_file = self._vector_file(name)
+            slots = self._slots(name, list(vectors))
+            new_hashes = [text_hash for text_hash in vectors if text_hash not in slots]
+            if new_hashes:
+                # Reuse evicted slots first, then append past the end of the file
+                free_slots = [
+                    row[0]
+                    for row in self.conn.execute(
+                        "SELECT slot FROM free_slots WHERE file = ? LIMIT ?", (name, len(new_hashes))
+                    ).fetchall()
+                ]
+                self.conn.executemany(
+                    "DELETE FROM free_slots WHERE file = ? AND slot = ?", [(name, slot) for slot in free_slots]
+                )
+                appended = len(new_hashes) - len(free_slots)
+                if appended:
+                    (next_slot,) = self.conn.execute(
+                        "SELECT next_slot FROM vector_files WHERE name = ?", (name,)
+                    ).fetchone()
+                    self.conn.execute(
+                        "UPDATE vector_files SET next_slot = next_slot + ? WHERE name = ?", (appended, name)
+                    )
+                    free_slots.extend(range(next_slot, next_slot + appended))
+                now = time.time()
+                self.conn.executemany(
+                    "INSERT INTO vectors (file, text_hash, slot, last_used) VALUES (?, ?, ?, ?)",
+                    [(name, text_hash, slot, now) for text_hash, slot in zip(new_hashes, free_slots)],
+                )
+                slots.update(zip(new_hashes, free_slots))
+            for text_hash, embedding in vectors.items():
+                vector_file.write(slots[text_hash], embedding)
+            # Vectors reach the disk before the index that points at them
+            vector_file.flush()
+            self.conn.commit()
+            if self.max_bytes is not None:
+                self._evict(self.max_bytes)
+
+    def size_bytes(self) -> int:
+        """Bytes taken by the cached vectors"""
+        with self._lock:
+            return self._size_bytes()
+
+    def _size_bytes(self) -> int:
+        total = 0
+        for name, count in self.conn.execute("SELECT file, COUNT(*) FROM vectors GROUP BY file").fetchall():
+            total += count * self._vector_file(name).record_size
+        return total
+
+    def evict(self, max_bytes: int) -> int:
+        """Drop the least recently used vectors until the cache fits in max_bytes, returning how many were dropped"""
+        with self._lock:
+            return self._evict(max_bytes)
+
+    def _evict(self, max_bytes: int) -> int:
+        excess = self._size_bytes() - max_bytes
+        evicted = 0
+        while excess > 0:
+            rows = self.conn.execute(
+                "SELECT file, text_hash, slot FROM vectors ORDER BY last_used LIMIT 1000"
+            ).fetchall()
+            if not rows:
+                break
+            for name, text_hash, slot in rows:
+                if excess <= 0:
+                    break
+                self.conn.execute("DELETE FROM vectors WHERE file = ? AND text_hash = ?", (name, text_hash))
+                self.conn.execute("INSERT OR IGNORE INTO free_slots (file, slot) VALUES (?, ?)", (name, slot))
+                excess -= self._vector_file(name).record_size
+                evicted += 1
+        self.conn.commit()
+        return evicted
+
+    def gc(self, max_bytes: Optional[int] = None) -> dict[str, int]:
+        """Evict down to max_bytes (or the configured limit), then rewrite every vector file without its free slots"""
+        with self._lock:
+            return self._gc(max_bytes if max_bytes is not None else self.max_bytes)
+
+    def _gc(self, max_bytes: Optional[int]) -> dict[str, int]:
+        evicted = self._evict(max_bytes) if max_bytes is not None else 0
+
+        vector_files = self.conn.execute("SELECT name, dimensions, dtype, generation FROM vector_files").fetchall()
+        for name, dimensions, dtype, generation in vector_files:
+            # Write the live vectors densely into the next generation's file; the index only switches
+            # to it on commit, so a crash at any point leaves a consistent cache (plus a stray file)
+            vector_file = self._vector_file(name)
+            rows = self.conn.execute("SELECT text_hash, slot FROM vectors WHERE file = ? ORDER BY slot", (name,)).fetchall()
+            new_path = self._vector_path(name, generation + 1)
+            if os.path.exists(new_path):
+                os.remove(new_path)
+            compacted = VectorFile(new_path, dimensions, dtype)
+            for new_slot, (_, slot) in enumerate(rows):
+                compacted.write(new_slot, vector_file.read(slot))
+            compacted.file.truncate(len(rows) * compacted.record_size)
+            compacted.flush()
+            compacted.close()
+
+            self.conn.executemany(
+                "UPDATE vectors SET slot = ? WHERE file = ? AND text_hash = ?",
+                [(new_slot, name, text_hash) for new_slot, (text_hash, _) in enumerate(rows)],
+            )
+            self.conn.execute("DELETE FROM free_slots WHERE file = ?", (name,))
+            self.conn.execute(
+                "UPDATE vector_files SET next_slot = ?, generation = ? WHERE name = ?", (len(rows), generation + 1, name)
+            )
+            self.conn.commit()
+            vector_file.close()
+            del self.files[name]
+
+            # Remove the previous generation and anything left over by an interrupted gc
+            for entry in os.listdir(self.directory):
+                if entry.startswith(f"{name}.") and entry != os.path.basename(new_path):
+                    os.remove(os.path.join(self.directory, entry))
+
+        self.conn.execute("VACUUM")
+        return {"evicted": evicted, "size_bytes": self._size_bytes()}
+
+    def close(self):
+        with self._lock:
+            for vector_file in self.files.values():
+                vector_file.close()
+            self.files.clear()
+            self.conn.close()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Garbage collect the persistent embedding cache.")
+    parser.add_argument("directory", help="Embedding cache directory")
+    parser.add_argument("--maxsizemb", type=float, help="Evict the least recently used embeddings beyond this size")
+    args = parser.parse_args()
+
+    cache = EmbeddingCache(args.directory)
+    try:
+        max_bytes = int(args.maxsizemb * 1024 * 1024) if args.maxsizemb is not None else None
+        print(cache.gc(max_bytes))
+    finally:
+        cache.close()
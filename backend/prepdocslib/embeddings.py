@@ -1,3 +1,4 @@
+import asyncio
 import logging
 from abc import ABC
 from collections.abc import Awaitable
@@ -5,7 +6,6 @@ from typing import Callable, Optional, Union
 from urllib.parse import urljoin
 
 import aiohttp
-import tiktoken
 from azure.core.credentials import AzureKeyCredential
 from azure.core.credentials_async import AsyncTokenCredential
 from azure.identity.aio import get_bearer_token_provider
@@ -18,6 +18,10 @@ from tenacity import (
 )
 from typing_extensions import TypedDict
 
+from .embeddingcache import EmbeddingCache
+from .ratelimiter import RateLimiter, retry_after_seconds
+from .tokens import count_tokens
+
 logger = logging.getLogger("scripts")
 
 
@@ -52,10 +56,23 @@ class OpenAIEmbeddings(ABC):
         "text-embedding-3-large": True,
     }
 
-    def __init__(self, open_ai_model_name: str, open_ai_dimensions: int, disable_batch: bool = False):
+    def __init__(
+        self,
+        open_ai_model_name: str,
+        open_ai_dimensions: int,
+        disable_batch: bool = False,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 8,
+        cache: Optional[EmbeddingCache] = None,
+    ):
         self.open_ai_model_name = open_ai_model_name
         self.open_ai_dimensions = open_ai_dimensions
         self.disable_batch = disable_batch
+        # Shared by every call, so concurrent callers stay within one quota
+        self.rate_limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+        self.max_concurrency = max_concurrency
+        self.cache = cache
 
     async def create_client(self) -> AsyncOpenAI:
         raise NotImplementedError
@@ -64,10 +81,15 @@ class OpenAIEmbeddings(ABC):
         logger.info("Rate limited on the OpenAI embeddings API, sleeping before retrying...")
 
     def calculate_token_length(self, text: str):
-        encoding = tiktoken.encoding_for_model(self.open_ai_model_name)
-        return len(encoding.encode(text))
-
-    def split_text_into_batches(self, texts: list[str]) -> list[EmbeddingBatch]:
+        return count_tokens(text, self.open_ai_model_name)
+
+    def split_text_into_batches(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[EmbeddingBatch]:
+        """
+        Groups texts into batches within the model's limits. token_counts, when given, holds the
+        counts the text splitter already computed (None where unknown) so those texts are not encoded again.
+        """
         batch_info = OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL.get(self.open_ai_model_name)
         if not batch_info:
             raise NotImplementedError(
@@ -79,8 +101,10 @@ class OpenAIEmbeddings(ABC):
         batches: list[EmbeddingBatch] = []
         batch: list[str] = []
         batch_token_length = 0
-        for text in texts:
-            text_token_length = self.calculate_token_length(text)
+        for index, text in enumerate(texts):
+            text_token_length = token_counts[index] if token_counts else None
+            if text_token_length is None:
+                text_token_length = self.calculate_token_length(text)
             if batch_token_length + text_token_length >= batch_token_limit and len(batch) > 0:
                 batches.append(EmbeddingBatch(batch, batch_token_length))
                 batch = []
@@ -98,29 +122,49 @@ class OpenAIEmbeddings(ABC):
 
         return batches
 
-    async def create_embedding_batch(self, texts: list[str], dimensions_args: ExtraArgs) -> list[list[float]]:
-        batches = self.split_text_into_batches(texts)
-        embeddings = []
+    async def create_embedding_batch(
+        self, texts: list[str], dimensions_args: ExtraArgs, token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[list[float]]:
+        batches = self.split_text_into_batches(texts, token_counts)
         client = await self.create_client()
-        for batch in batches:
-            async for attempt in AsyncRetrying(
-                retry=retry_if_exception_type(RateLimitError),
-                wait=wait_random_exponential(min=15, max=60),
-                stop=stop_after_attempt(15),
-                before_sleep=self.before_retry_sleep,
-            ):
-                with attempt:
-                    emb_response = await client.embeddings.create(
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def embed(batch: EmbeddingBatch) -> list[list[float]]:
+            async with semaphore:
+                return await self.create_embeddings_for_batch(client, batch, dimensions_args)
+
+        # Batches are sent concurrently as the rate limiter allows, gather keeps them in input order
+        batch_embeddings = await asyncio.gather(*(embed(batch) for batch in batches))
+        return [embedding for embeddings in batch_embeddings for embedding in embeddings]
+
+    async def create_embeddings_for_batch(
+        self, client: AsyncOpenAI, batch: EmbeddingBatch, dimensions_args: ExtraArgs
+    ) -> list[list[float]]:
+        async for attempt in AsyncRetrying(
+            retry=retry_if_exception_type(RateLimitError),
+            # The rate limiter holds the retry for the delay the service asked for, this only adds jitter
+            wait=wait_random_exponential(min=1, max=15),
+            stop=stop_after_attempt(15),
+            before_sleep=self.before_retry_sleep,
+        ):
+            with attempt:
+                await self.rate_limiter.acquire(batch.token_length)
+                try:
+                    raw_response = await client.embeddings.with_raw_response.create(
                         model=self.open_ai_model_name, input=batch.texts, **dimensions_args
                     )
-                    embeddings.extend([data.embedding for data in emb_response.data])
-                    logger.info(
-                        "Computed embeddings in batch. Batch size: %d, Token count: %d",
-                        len(batch.texts),
-                        batch.token_length,
-                    )
+                except RateLimitError as e:
+                    self.rate_limiter.pause(retry_after_seconds(e.response.headers))
+                    raise
+                self.rate_limiter.update_from_headers(raw_response.headers)
+                emb_response = raw_response.parse()
+                logger.info(
+                    "Computed embeddings in batch. Batch size: %d, Token count: %d",
+                    len(batch.texts),
+                    batch.token_length,
+                )
 
-        return embeddings
+        return [data.embedding for data in emb_response.data]
 
     async def create_embedding_single(self, text: str, dimensions_args: ExtraArgs) -> list[float]:
         client = await self.create_client()
@@ -138,8 +182,33 @@ class OpenAIEmbeddings(ABC):
 
         return emb_response.data[0].embedding
 
-    async def create_embeddings(self, texts: list[str]) -> list[list[float]]:
+    async def create_embeddings(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[list[float]]:
+        if self.cache is None:
+            return await self.create_embeddings_uncached(texts, token_counts)
 
+        # Only texts missing from the cache are sent to the API. The cache reads SQLite and the vector files,
+        # keep that off the event loop driving the other files
+        embeddings = await asyncio.to_thread(
+            self.cache.get_many, self.open_ai_model_name, self.open_ai_dimensions, texts
+        )
+        misses = [index for index, embedding in enumerate(embeddings) if embedding is None]
+        logger.info("Embedding cache: %d hits, %d misses", len(texts) - len(misses), len(misses))
+        if misses:
+            miss_texts = [texts[index] for index in misses]
+            miss_token_counts = [token_counts[index] for index in misses] if token_counts else None
+            computed = await self.create_embeddings_uncached(miss_texts, miss_token_counts)
+            await asyncio.to_thread(
+                self.cache.put_many, self.open_ai_model_name, self.open_ai_dimensions, miss_texts, computed
+            )
+            for index, embedding in zip(misses, computed):
+                embeddings[index] = embedding
+        return embeddings
+
+    async def create_embeddings_uncached(
+        self, texts: list[str], token_counts: Optional[list[Optional[int]]] = None
+    ) -> list[list[float]]:
         dimensions_args: ExtraArgs = (
             {"dimensions": self.open_ai_dimensions}
             if OpenAIEmbeddings.SUPPORTED_DIMENSIONS_MODEL.get(self.open_ai_model_name)
@@ -147,7 +216,7 @@ class OpenAIEmbeddings(ABC):
         )
 
         if not self.disable_batch and self.open_ai_model_name in OpenAIEmbeddings.SUPPORTED_BATCH_AOAI_MODEL:
-            return await self.create_embedding_batch(texts, dimensions_args)
+            return await self.create_embedding_batch(texts, dimensions_args, token_counts)
 
         return [await self.create_embedding_single(text, dimensions_args) for text in texts]
 
@@ -168,8 +237,20 @@ class AzureOpenAIEmbeddingService(OpenAIEmbeddings):
         credential: Union[AsyncTokenCredential, AzureKeyCredential],
         open_ai_custom_url: Union[str, None] = None,
         disable_batch: bool = False,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 8,
+        cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(
+            open_ai_model_name,
+            open_ai_dimensions,
+            disable_batch,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_concurrency=max_concurrency,
+            cache=cache,
+        )
         self.open_ai_service = open_ai_service
         if open_ai_service:
             self.open_ai_endpoint = f"https://{open_ai_service}.openai.azure.com"
@@ -217,8 +298,20 @@ class OpenAIEmbeddingService(OpenAIEmbeddings):
         credential: str,
         organization: Optional[str] = None,
         disable_batch: bool = False,
+        requests_per_minute: Optional[int] = None,
+        tokens_per_minute: Optional[int] = None,
+        max_concurrency: int = 8,
+        cache: Optional[EmbeddingCache] = None,
     ):
-        super().__init__(open_ai_model_name, open_ai_dimensions, disable_batch)
+        super().__init__(
+            open_ai_model_name,
+            open_ai_dimensions,
+            disable_batch,
+            requests_per_minute=requests_per_minute,
+            tokens_per_minute=tokens_per_minute,
+            max_concurrency=max_concurrency,
+            cache=cache,
+        )
         self.credential = credential
         self.organization = organization
 
@@ -0,0 +1,96 @@
+import hashlib
+import os
+import sqlite3
+import threading
+from typing import NamedTuple, Optional
+
+DEFAULT_FILE_MANIFEST_PATH = os.path.join(".prepdocs", "files.db")
+
+# Large enough to keep the disk busy, small enough to keep several hashing threads in memory
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class FileState(NamedTuple):
+    size: int
+    mtime_ns: int
+    md5: str
+
+
+def hash_file(path: str, chunk_size: int = HASH_CHUNK_SIZE) -> str:
+    """MD5 of a file, read in chunks so large files are never held in memory"""
+    md5 = hashlib.md5()
+    with open(path, "rb") as file:
+        while chunk := file.read(chunk_size):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+
+class FileManifest:
+    """
+    Local record of the size, modification time and hash of every ingested file. A file whose size and
+    modification time did not change is assumed unchanged without being read again.
+    """
+
+    def __init__(self, path: str = DEFAULT_FILE_MANIFEST_PATH):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        # Files are checked from worker threads, the lock serializes them on the connection
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                mtime_ns INTEGER NOT NULL,
+                md5 TEXT NOT NULL
+            )
+            """
+        )
+
+    def get(self, path: str) -> Optional[FileState]:
+        with self._lock:
+            row = self.conn.execute("SELECT size, mtime_ns, md5 FROM files WHERE path = ?", (path,)).fetchone()
+        return FileState(*row) if row else None
+
+    def put(self, path: str, state: FileState):
+        with self._lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, size, mtime_ns, md5) VALUES (?, ?, ?, ?)", (path, *state)
+            )
+
+    def record(self, path: str, state: FileState):
+        self.put(os.path.abspath(path), state)
+
+    def check(self, path: str) -> tuple[bool, Optional[FileState]]:
+        """
+        Whether the file is unchanged since it was last recorded, and the state to record for it, None when the
+        record is current. Nothing is written: the caller records a changed file once it is ingested, so a file
+        that fails or is never reached is picked up again by the next run.
+        """
+        key = os.path.abspath(path)
+        stat = os.stat(path)
+        stored = self.get(key)
+        if stored is None:
+            stored = self._stored_sidecar(path)
+        elif stored.size == stat.st_size and stored.mtime_ns == stat.st_mtime_ns:
+            return True, None
+
+        current = FileState(stat.st_size, stat.st_mtime_ns, hash_file(path))
+        return stored is not None and stored.md5 == current.md5, current
+
+    @staticmethod
+    def _stored_sidecar(path: str) -> Optional[FileState]:
+        # Adopt the hash of the .md5 file written next to the file by earlier versions, so upgrading doesn't
+        # re-ingest the whole corpus
+        hash_path = f"{path}.md5"
+        if not os.path.exists(hash_path):
+            return None
+        with open(hash_path, encoding="utf-8") as md5_f:
+            return FileState(-1, -1, md5_f.read().strip())
+
+    def close(self):
+        self.conn.close()
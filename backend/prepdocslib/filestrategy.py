@@ -1,13 +1,17 @@
+import asyncio
 import logging
-from typing import Optional
+from typing import Optional, Union
 
 from azure.core.credentials import AzureKeyCredential
 
 from .blobmanager import BlobManager
 from .embeddings import ImageEmbeddings, OpenAIEmbeddings
 from .fileprocessor import FileProcessor
+from .indexmanifest import IndexManifest
 from .listfilestrategy import File, ListFileStrategy
 from .mediadescriber import ContentUnderstandingDescriber
+from .page import Page
+from .pipeline import PipelineConcurrency, PipelineStage, run_pipeline
 from .searchmanager import SearchManager, Section
 from .strategy import DocumentAction, SearchInfo, Strategy
 
@@ -20,20 +24,32 @@ async def parse_file(
     category: Optional[str] = None,
     image_embeddings: Optional[ImageEmbeddings] = None,
 ) -> list[Section]:
-    key = file.file_extension().lower()
-    processor = file_processors.get(key)
+    processor = file_processors.get(file.file_extension().lower())
     if processor is None:
         logger.info("Skipping '%s', no parser found.", file.filename())
         return []
+    pages = await parse_pages(file, processor)
+    return split_sections(file, processor, pages, category, image_embeddings)
+
+
+async def parse_pages(file: File, processor: FileProcessor) -> list[Page]:
     logger.info("Ingesting '%s'", file.filename())
-    pages = [page async for page in processor.parser.parse(content=file.content)]
+    return [page async for page in processor.parser.parse(content=file.content)]
+
+
+def split_sections(
+    file: File,
+    processor: FileProcessor,
+    pages: list[Page],
+    category: Optional[str] = None,
+    image_embeddings: Optional[ImageEmbeddings] = None,
+) -> list[Section]:
     logger.info("Splitting '%s' into sections", file.filename())
     if image_embeddings:
         logger.warning("Each page will be split into smaller chunks of text, but images will be of the entire page.")
-    sections = [
+    return [
         Section(split_page, content=file, category=category) for split_page in processor.splitter.split_pages(pages)
     ]
-    return sections
 
 
 class FileStrategy(Strategy):
@@ -56,6 +72,8 @@ class FileStrategy(Strategy):
         category: Optional[str] = None,
         use_content_understanding: bool = False,
         content_understanding_endpoint: Optional[str] = None,
+        concurrency: Optional[PipelineConcurrency] = None,
+        index_manifest: Optional[IndexManifest] = None,
     ):
         self.list_file_strategy = list_file_strategy
         self.blob_manager = blob_manager
@@ -70,6 +88,9 @@ class FileStrategy(Strategy):
         self.category = category
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.concurrency = concurrency or PipelineConcurrency()
+        self.pipeline_metrics: list[dict] = []
+        self.index_manifest = index_manifest
 
     def setup_search_manager(self):
         self.search_manager = SearchManager(
@@ -80,6 +101,7 @@ class FileStrategy(Strategy):
             self.embeddings,
             field_name_embedding=self.search_field_name_embedding,
             search_images=self.image_embeddings is not None,
+            manifest=self.index_manifest,
         )
 
     async def setup(self):
@@ -98,28 +120,107 @@ class FileStrategy(Strategy):
 
     async def run(self):
         self.setup_search_manager()
-        if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    sections = await parse_file(file, self.file_processors, self.category, self.image_embeddings)
-                    if sections:
-                        blob_sas_uris = await self.blob_manager.upload_blob(file)
-                        blob_image_embeddings: Optional[list[list[float]]] = None
-                        if self.image_embeddings and blob_sas_uris:
-                            blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
-                        await self.search_manager.update_content(sections, blob_image_embeddings, url=file.url)
-                finally:
-                    if file:
-                        file.close()
-        elif self.document_action == DocumentAction.Remove:
-            paths = self.list_file_strategy.list_paths()
-            async for path in paths:
-                await self.blob_manager.remove_blob(path)
-                await self.search_manager.remove_content(path)
-        elif self.document_action == DocumentAction.RemoveAll:
-            await self.blob_manager.remove_blob()
-            await self.search_manager.remove_content()
+        # One blob client for the whole run instead of one per file
+        async with self.blob_manager:
+            try:
+                if self.document_action == DocumentAction.Add:
+                    concurrency = self.concurrency
+                    self.pipeline_metrics = await run_pipeline(
+                        self.list_file_strategy.list(),
+                        [
+                            PipelineStage("parse", self._parse_stage, concurrency.parse, self._discard),
+                            PipelineStage("split", self._split_stage, concurrency.split, self._discard),
+                            PipelineStage("embed", self._embed_stage, concurrency.embed, self._discard),
+                            PipelineStage("index", self._index_stage, concurrency.index, self._discard),
+                        ],
+                        queue_size=concurrency.queue_size,
+                    )
+                elif self.document_action == DocumentAction.Remove:
+                    paths = self.list_file_strategy.list_paths()
+                    async for path in paths:
+                        await self.blob_manager.remove_blob(path)
+                        await self.search_manager.remove_content(path)
+                elif self.document_action == DocumentAction.RemoveAll:
+                    await self.blob_manager.remove_blob()
+                    await self.search_manager.remove_content()
+            finally:
+                # Parsers keep their clients open between documents, close them once the run is over
+                for parser in {processor.parser for processor in self.file_processors.values()}:
+                    await parser.close()
+
+    # Each stage closes the file when it drops it or fails, the index stage closes it once indexed
+
+    @staticmethod
+    def _discard(item: Union[File, tuple]):
+        # Items of every stage after parsing are tuples starting with their file
+        file = item if isinstance(item, File) else item[0]
+        logger.warning("'%s' was not indexed, the run stopped before it was done", file.filename())
+        file.close()
+
+    async def _parse_stage(self, file: File):
+        try:
+            processor = self.file_processors.get(file.file_extension().lower())
+            if processor is None:
+                logger.info("Skipping '%s', no parser found.", file.filename())
+                file.close()
+                return None
+            return file, processor, await parse_pages(file, processor)
+        except BaseException:
+            file.close()
+            raise
+
+    async def _split_stage(self, item: tuple[File, FileProcessor, list[Page]]):
+        file, processor, pages = item
+        try:
+            # Splitting is CPU bound (tokenization), keep it off the event loop driving the other stages
+            sections = await asyncio.to_thread(
+                split_sections, file, processor, pages, self.category, self.image_embeddings
+            )
+            if not sections:
+                file.close()
+                return None
+            return file, sections
+        except BaseException:
+            file.close()
+            raise
+
+    async def _embed_stage(self, item: tuple[File, list[Section]]):
+        file, sections = item
+        try:
+            blob_sas_uris = await self.blob_manager.upload_blob(file)
+            blob_image_embeddings: Optional[list[list[float]]] = None
+            if self.image_embeddings and blob_sas_uris:
+                blob_image_embeddings = await self.image_embeddings.create_embeddings(blob_sas_uris)
+            section_embeddings: Optional[list[Optional[list[float]]]] = None
+            if self.embeddings and self.search_field_name_embedding:
+                # Sections the index already has unchanged are not uploaded, so don't embed them either
+                pending = self.search_manager.sections_to_upload(sections, blob_image_embeddings, file.url)
+                embeddings = (
+                    await self.embeddings.create_embeddings(
+                        texts=[sections[index].split_page.text for index in pending],
+                        token_counts=[sections[index].split_page.token_count for index in pending],
+                    )
+                    if pending
+                    else []
+                )
+                section_embeddings = [None] * len(sections)
+                for index, embedding in zip(pending, embeddings):
+                    section_embeddings[index] = embedding
+            return file, sections, blob_image_embeddings, section_embeddings
+        except BaseException:
+            file.close()
+            raise
+
+    async def _index_stage(self, item: tuple[File, list[Section], Optional[list], Optional[list]]):
+        file, sections, blob_image_embeddings, section_embeddings = item
+        try:
+            await self.search_manager.update_content(
+                sections, blob_image_embeddings, url=file.url, section_embeddings=section_embeddings
+            )
+            await self.list_file_strategy.mark_indexed(file)
+            return file
+        finally:
+            file.close()
 
 
 class UploadUserFileStrategy:
@@ -0,0 +1,55 @@
+import os
+import sqlite3
+
+
+class IndexManifest:
+    """
+    Local record of the chunks uploaded to the search index for each source file: their stable IDs
+    and a hash of their indexed fields. Diffing a file's new chunks against it tells which chunks
+    must be uploaded and which ones no longer exist and must be deleted from the index.
+    """
+
+    def __init__(self, path: str):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                file_id TEXT NOT NULL,
+                sourcefile TEXT NOT NULL,
+                chunk_id TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                PRIMARY KEY (file_id, chunk_id)
+            );
+            CREATE INDEX IF NOT EXISTS idx_chunks_sourcefile ON chunks(sourcefile);
+            """
+        )
+
+    def get(self, file_id: str) -> dict[str, str]:
+        """Chunk ID to content hash of everything indexed for the file, empty if the file was never indexed"""
+        rows = self.conn.execute("SELECT chunk_id, content_hash FROM chunks WHERE file_id = ?", (file_id,)).fetchall()
+        return dict(rows)
+
+    def replace(self, file_id: str, sourcefile: str, chunks: dict[str, str]):
+        """Record the chunks now indexed for the file, once the index was updated"""
+        with self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE file_id = ?", (file_id,))
+            self.conn.executemany(
+                "INSERT INTO chunks (file_id, sourcefile, chunk_id, content_hash) VALUES (?, ?, ?, ?)",
+                [(file_id, sourcefile, chunk_id, content_hash) for chunk_id, content_hash in chunks.items()],
+            )
+
+    def remove(self, sourcefile: str):
+        with self.conn:
+            self.conn.execute("DELETE FROM chunks WHERE sourcefile = ?", (sourcefile,))
+
+    def clear(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM chunks")
+
+    def close(self):
+        self.conn.close()
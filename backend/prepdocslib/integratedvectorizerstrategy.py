@@ -159,20 +159,22 @@ class IntegratedVectorizerStrategy(Strategy):
         await ds_client.close()
 
     async def run(self):
-        if self.document_action == DocumentAction.Add:
-            files = self.list_file_strategy.list()
-            async for file in files:
-                try:
-                    await self.blob_manager.upload_blob(file)
-                finally:
-                    if file:
-                        file.close()
-        elif self.document_action == DocumentAction.Remove:
-            paths = self.list_file_strategy.list_paths()
-            async for path in paths:
-                await self.blob_manager.remove_blob(path)
-        elif self.document_action == DocumentAction.RemoveAll:
-            await self.blob_manager.remove_blob()
+        async with self.blob_manager:
+            if self.document_action == DocumentAction.Add:
+                files = self.list_file_strategy.list()
+                async for file in files:
+                    try:
+                        await self.blob_manager.upload_blob(file)
+                        await self.list_file_strategy.mark_indexed(file)
+                    finally:
+                        if file:
+                            file.close()
+            elif self.document_action == DocumentAction.Remove:
+                paths = self.list_file_strategy.list_paths()
+                async for path in paths:
+                    await self.blob_manager.remove_blob(path)
+            elif self.document_action == DocumentAction.RemoveAll:
+                await self.blob_manager.remove_blob()
 
         # Create an indexer
         indexer = SearchIndexer(
@@ -1,11 +1,13 @@
+import asyncio
 import base64
-import hashlib
 import logging
 import os
 import re
 import tempfile
 from abc import ABC
 from collections.abc import AsyncGenerator
+from concurrent.futures import ThreadPoolExecutor
+from fnmatch import fnmatch
 from glob import glob
 from typing import IO, Optional, Union
 
@@ -14,6 +16,8 @@ from azure.storage.filedatalake.aio import (
     DataLakeServiceClient,
 )
 
+from .filemanifest import DEFAULT_FILE_MANIFEST_PATH, FileManifest, FileState
+
 logger = logging.getLogger("scripts")
 
 
@@ -60,57 +64,154 @@ class ListFileStrategy(ABC):
         if False:  # pragma: no cover - this is necessary for mypy to type check
             yield
 
+    async def mark_indexed(self, file: File):
+        """Called once a listed file is ingested, so it isn't listed again until it changes"""
+        pass
+
 
 class LocalListFileStrategy(ListFileStrategy):
     """
     Concrete strategy for listing files that are located in a local filesystem
     """
 
-    def __init__(self, path_pattern: str):
+    def __init__(
+        self,
+        path_pattern: str,
+        manifest_path: str = DEFAULT_FILE_MANIFEST_PATH,
+        hash_concurrency: int = 4,
+        include: Optional[list[str]] = None,
+        exclude: Optional[list[str]] = None,
+        extensions: Optional[list[str]] = None,
+        walk_concurrency: int = 8,
+    ):
         self.path_pattern = path_pattern
+        self.manifest_path = manifest_path
+        self.hash_concurrency = hash_concurrency
+        self.manifest: Optional[FileManifest] = None
+        # States of the changed files listed, recorded in the manifest by mark_indexed
+        self.changed: dict[str, FileState] = {}
+        self.include = include or []
+        self.exclude = exclude or []
+        self.extensions = {
+            extension.lower() if extension.startswith(".") else f".{extension.lower()}" for extension in extensions or []
+        }
+        self.walk_concurrency = walk_concurrency
 
     async def list_paths(self) -> AsyncGenerator[str, None]:
         async for p in self._list_paths(self.path_pattern):
             yield p
 
     async def _list_paths(self, path_pattern: str) -> AsyncGenerator[str, None]:
-        for path in glob(path_pattern):
+        directories = []
+        for path in await asyncio.to_thread(glob, path_pattern):
             if os.path.isdir(path):
-                async for p in self._list_paths(f"{path}/*"):
-                    yield p
-            else:
+                if not self._is_excluded(path):
+                    directories.append(path)
+            elif self._is_listed(path):
                 # Only list files, not directories
                 yield path
+        if not directories:
+            return
+
+        # Directories are scanned in worker threads, which hand over entries as they find them, so files
+        # are listed while the rest of the tree is still being walked
+        loop = asyncio.get_running_loop()
+        entries: asyncio.Queue[tuple[str, str]] = asyncio.Queue()
+        executor = ThreadPoolExecutor(max_workers=self.walk_concurrency, thread_name_prefix="list-files")
+
+        def emit(kind: str, path: str):
+            loop.call_soon_threadsafe(entries.put_nowait, (kind, path))
+
+        def scan(directory: str):
+            try:
+                with os.scandir(directory) as iterator:
+                    for entry in iterator:
+                        # Hidden entries were never matched by glob
+                        if entry.name.startswith("."):
+                            continue
+                        if entry.is_dir():
+                            if not self._is_excluded(entry.path):
+                                emit("directory", entry.path)
+                        elif self._is_listed(entry.path):
+                            emit("file", entry.path)
+            except OSError as error:
+                logger.warning("Skipping directory %s: %s", directory, error)
+            finally:
+                emit("scanned", directory)
+
+        try:
+            for directory in directories:
+                loop.run_in_executor(executor, scan, directory)
+            scanning = len(directories)
+            while scanning:
+                kind, path = await entries.get()
+                if kind == "file":
+                    yield path
+                elif kind == "directory":
+                    loop.run_in_executor(executor, scan, path)
+                    scanning += 1
+                else:
+                    scanning -= 1
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+    def _is_excluded(self, path: str) -> bool:
+        name = os.path.basename(path)
+        return any(fnmatch(path, pattern) or fnmatch(name, pattern) for pattern in self.exclude)
+
+    def _is_listed(self, path: str) -> bool:
+        """Apply the extension, include and exclude filters to a file, before it is ever opened"""
+        if self.extensions and os.path.splitext(path)[1].lower() not in self.extensions:
+            return False
+        name = os.path.basename(path)
+        if self.include and not any(fnmatch(path, pattern) or fnmatch(name, pattern) for pattern in self.include):
+            return False
+        return not self._is_excluded(path)
 
     async def list(self) -> AsyncGenerator[File, None]:
+        if self.manifest is None:
+            self.manifest = FileManifest(self.manifest_path)
+        # Files are checked in worker threads, so hashing the changed ones overlaps with listing the others
+        pending: set[asyncio.Task] = set()
         async for path in self.list_paths():
-            if not self.check_md5(path):
+            pending.add(asyncio.create_task(self._check_path(path)))
+            if len(pending) >= self.hash_concurrency:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    path, unchanged = task.result()
+                    if not unchanged:
+                        yield File(content=open(path, mode="rb"))
+        for task in asyncio.as_completed(pending):
+            path, unchanged = await task
+            if not unchanged:
                 yield File(content=open(path, mode="rb"))
 
+    async def _check_path(self, path: str) -> tuple[str, bool]:
+        return path, await asyncio.to_thread(self.check_md5, path)
+
     def check_md5(self, path: str) -> bool:
         # if filename ends in .md5 skip
         if path.endswith(".md5"):
             return True
 
-        # if there is a file called .md5 in this directory, see if its updated
-        stored_hash = None
-        with open(path, "rb") as file:
-            existing_hash = hashlib.md5(file.read()).hexdigest()
-        hash_path = f"{path}.md5"
-        if os.path.exists(hash_path):
-            with open(hash_path, encoding="utf-8") as md5_f:
-                stored_hash = md5_f.read()
-
-        if stored_hash and stored_hash.strip() == existing_hash.strip():
+        if self.manifest is None:
+            self.manifest = FileManifest(self.manifest_path)
+        unchanged, state = self.manifest.check(path)
+        if unchanged:
             logger.info("Skipping %s, no changes detected.", path)
+            if state is not None:
+                # Same content as when it was ingested, only the size or modification time to refresh
+                self.manifest.record(path, state)
             return True
-
-        # Write the hash
-        with open(hash_path, "w", encoding="utf-8") as md5_f:
-            md5_f.write(existing_hash)
-
+        if state is not None:
+            self.changed[path] = state
         return False
 
+    async def mark_indexed(self, file: File):
+        state = self.changed.pop(file.content.name, None)
+        if state is not None and self.manifest is not None:
+            await asyncio.to_thread(self.manifest.record, file.content.name, state)
+
 
 class ADLSGen2ListFileStrategy(ListFileStrategy):
     """
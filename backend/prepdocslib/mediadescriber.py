@@ -1,11 +1,15 @@
+import asyncio
+import functools
+import hashlib
 import logging
+import time
 from abc import ABC
+from typing import Optional
 
 import aiohttp
+from azure.core.credentials import AccessToken
 from azure.core.credentials_async import AsyncTokenCredential
-from azure.identity.aio import get_bearer_token_provider
 from rich.progress import Progress
-from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_fixed
 
 logger = logging.getLogger("scripts")
 
@@ -38,35 +42,75 @@ class ContentUnderstandingDescriber:
         },
     }
 
-    def __init__(self, endpoint: str, credential: AsyncTokenCredential):
+    # Tokens are refreshed this long before they expire, so a request never goes out with a stale one
+    TOKEN_REFRESH_MARGIN_SECONDS = 300
+    # Polling starts fast since small images are often analyzed in well under a second, then backs off
+    POLL_INITIAL_INTERVAL_SECONDS = 0.25
+    POLL_MAX_INTERVAL_SECONDS = 5.0
+    POLL_BACKOFF = 1.5
+    POLL_TIMEOUT_SECONDS = 120
+
+    def __init__(self, endpoint: str, credential: AsyncTokenCredential, max_connections: int = 16):
         self.endpoint = endpoint
         self.credential = credential
-
-    async def poll_api(self, session, poll_url, headers):
-
-        @retry(stop=stop_after_attempt(60), wait=wait_fixed(2), retry=retry_if_exception_type(ValueError))
-        async def poll():
+        self.max_connections = max_connections
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._token: Optional[AccessToken] = None
+        self._token_lock = asyncio.Lock()
+        # Descriptions by SHA-256 of the image bytes, so repeated logos and diagrams are described once
+        self._descriptions: dict[str, asyncio.Task[str]] = {}
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        """Session shared by all requests, so connections are pooled and reused"""
+        if self._session is None or self._session.closed:
+            self._session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.max_connections))
+        return self._session
+
+    async def close(self):
+        """Close the pooled session, once at the end of the run; a later request opens a new one"""
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    async def get_auth_headers(self) -> dict[str, str]:
+        async with self._token_lock:
+            if self._token is None or self._token.expires_on - time.time() < self.TOKEN_REFRESH_MARGIN_SECONDS:
+                self._token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
+            return {"Authorization": f"Bearer {self._token.token}"}
+
+    async def poll_api(self, session: aiohttp.ClientSession, poll_url: str, headers: dict[str, str]):
+        interval = self.POLL_INITIAL_INTERVAL_SECONDS
+        deadline = time.monotonic() + self.POLL_TIMEOUT_SECONDS
+        while True:
             async with session.get(poll_url, headers=headers) as response:
                 response.raise_for_status()
                 response_json = await response.json()
-                if response_json["status"] == "Failed":
-                    raise Exception("Failed")
-                if response_json["status"] == "Running":
-                    raise ValueError("Running")
+                retry_after = response.headers.get("Retry-After")
+            if response_json["status"] == "Failed":
+                raise Exception("Failed")
+            if response_json["status"] not in ("NotStarted", "Running"):
                 return response_json
-
-        return await poll()
+            if time.monotonic() >= deadline:
+                raise TimeoutError(f"Content Understanding operation still running after {self.POLL_TIMEOUT_SECONDS}s")
+            # The service tells how long to wait when it knows better
+            delay = interval
+            if retry_after:
+                try:
+                    delay = float(retry_after)
+                except ValueError:
+                    pass
+            await asyncio.sleep(min(delay, max(0.0, deadline - time.monotonic())))
+            interval = min(interval * self.POLL_BACKOFF, self.POLL_MAX_INTERVAL_SECONDS)
 
     async def create_analyzer(self):
         logger.info("Creating analyzer '%s'...", self.analyzer_schema["analyzerId"])
 
-        token_provider = get_bearer_token_provider(self.credential, "https://cognitiveservices.azure.com/.default")
-        token = await token_provider()
-        headers = {"Authorization": f"Bearer {token}", "Content-Type": "application/json"}
+        headers = {**await self.get_auth_headers(), "Content-Type": "application/json"}
         params = {"api-version": self.CU_API_VERSION}
         analyzer_id = self.analyzer_schema["analyzerId"]
         cu_endpoint = f"{self.endpoint}/contentunderstanding/analyzers/{analyzer_id}"
-        async with aiohttp.ClientSession() as session:
+        session = await self.get_session()
+        try:
             async with session.put(
                 url=cu_endpoint, params=params, headers=headers, json=self.analyzer_schema
             ) as response:
@@ -82,26 +126,43 @@ class ContentUnderstandingDescriber:
             with Progress() as progress:
                 progress.add_task("Creating analyzer...", total=None, start=False)
                 await self.poll_api(session, poll_url, headers)
+        finally:
+            await self.close()
 
     async def describe_image(self, image_bytes: bytes) -> str:
+        image_hash = hashlib.sha256(image_bytes).hexdigest()
+        task = self._descriptions.get(image_hash)
+        if task is None:
+            # Concurrent requests for the same image wait for the same analysis
+            task = asyncio.ensure_future(self._analyze_image(image_bytes))
+            task.add_done_callback(functools.partial(self._forget_failure, image_hash))
+            self._descriptions[image_hash] = task
+        else:
+            logger.info("Reusing the description of an identical image")
+        # Shielded so one waiter being cancelled doesn't cancel the analysis for the others
+        return await asyncio.shield(task)
+
+    def _forget_failure(self, image_hash: str, task: "asyncio.Task[str]"):
+        # Don't cache failures, the next request for the image tries again. Runs when the analysis ends,
+        # even if every waiter was cancelled before it did.
+        if (task.cancelled() or task.exception() is not None) and self._descriptions.get(image_hash) is task:
+            del self._descriptions[image_hash]
+
+    async def _analyze_image(self, image_bytes: bytes) -> str:
         logger.info("Sending image to Azure Content Understanding service...")
-        async with aiohttp.ClientSession() as session:
-            token = await self.credential.get_token("https://cognitiveservices.azure.com/.default")
-            headers = {"Authorization": "Bearer " + token.token}
-            params = {"api-version": self.CU_API_VERSION}
-            analyzer_name = self.analyzer_schema["analyzerId"]
-            async with session.post(
-                url=f"{self.endpoint}/contentunderstanding/analyzers/{analyzer_name}:analyze",
-                params=params,
-                headers=headers,
-                data=image_bytes,
-            ) as response:
-                response.raise_for_status()
-                poll_url = response.headers["Operation-Location"]
-
-                with Progress() as progress:
-                    progress.add_task("Processing...", total=None, start=False)
-                    results = await self.poll_api(session, poll_url, headers)
-
-                fields = results["result"]["contents"][0]["fields"]
-                return fields["Description"]["valueString"]
+        session = await self.get_session()
+        headers = await self.get_auth_headers()
+        params = {"api-version": self.CU_API_VERSION}
+        analyzer_name = self.analyzer_schema["analyzerId"]
+        async with session.post(
+            url=f"{self.endpoint}/contentunderstanding/analyzers/{analyzer_name}:analyze",
+            params=params,
+            headers=headers,
+            data=image_bytes,
+        ) as response:
+            response.raise_for_status()
+            poll_url = response.headers["Operation-Location"]
+
+        results = await self.poll_api(session, poll_url, headers)
+        fields = results["result"]["contents"][0]["fields"]
+        return fields["Description"]["valueString"]
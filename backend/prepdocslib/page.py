@@ -1,3 +1,6 @@
+from typing import Optional
+
+
 class Page:
     """
     A single page from a document
@@ -8,6 +11,8 @@ class Page:
         text (str): The text of the page
     """
 
+    __slots__ = ("page_num", "offset", "text")
+
     def __init__(self, page_num: int, offset: int, text: str):
         self.page_num = page_num
         self.offset = offset
@@ -18,11 +23,59 @@ class SplitPage:
     """
     A section of a page that has been split into a smaller chunk.
 
+    A split page either holds its text, or is a view of the characters start to end of a text shared by
+    all the sections of a document, sliced only when the text is read.
+
     Attributes:
         page_num (int): Page number (0-indexed)
         text (str): The text of the section
+        token_count (Optional[int]): Number of embedding-model tokens in the text, when the splitter counted them
+        tokens (Optional[list[int]]): The tokens themselves, when the splitter was asked to keep them
     """
 
-    def __init__(self, page_num: int, text: str):
+    __slots__ = ("page_num", "_text", "_buffer", "_start", "_end", "token_count", "tokens")
+
+    def __init__(
+        self, page_num: int, text: str, token_count: Optional[int] = None, tokens: Optional[list[int]] = None
+    ):
         self.page_num = page_num
-        self.text = text
+        self._text: Optional[str] = text
+        self._buffer: Optional[str] = None
+        self._start = 0
+        self._end = len(text)
+        self.token_count = token_count
+        self.tokens = tokens
+
+    @classmethod
+    def view(
+        cls,
+        page_num: int,
+        buffer: str,
+        start: int,
+        end: int,
+        token_count: Optional[int] = None,
+        tokens: Optional[list[int]] = None,
+    ) -> "SplitPage":
+        split_page = cls.__new__(cls)
+        split_page.page_num = page_num
+        split_page._text = None
+        split_page._buffer = buffer
+        split_page._start = start
+        split_page._end = end
+        split_page.token_count = token_count
+        split_page.tokens = tokens
+        return split_page
+
+    @property
+    def text(self) -> str:
+        if self._text is not None:
+            return self._text
+        # Not kept, so only the shared text stays in memory
+        return self._buffer[self._start : self._end]  # type: ignore[index]
+
+    @text.setter
+    def text(self, text: str):
+        self._text = text
+        self._buffer = None
+        self._start = 0
+        self._end = len(text)
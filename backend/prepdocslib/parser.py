@@ -13,3 +13,7 @@ class Parser(ABC):
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         if False:
             yield  # pragma: no cover - this is necessary for mypy to type check
+
+    async def close(self):
+        """Release what the parser keeps open across documents, once they are all parsed"""
+        pass
@@ -1,9 +1,13 @@
+import asyncio
+import contextlib
+import heapq
 import html
 import io
 import logging
+import threading
 from collections.abc import AsyncGenerator
 from enum import Enum
-from typing import IO, Union
+from typing import IO, Optional, Union
 
 import pymupdf
 from azure.ai.documentintelligence.aio import DocumentIntelligenceClient
@@ -26,6 +30,12 @@ from .parser import Parser
 logger = logging.getLogger("scripts")
 
 
+class ObjectType(Enum):
+    NONE = -1
+    TABLE = 0
+    FIGURE = 1
+
+
 class LocalPdfParser(Parser):
     """
     Concrete parser backed by PyPDF that can parse PDFs into pages
@@ -57,12 +67,15 @@ class DocumentAnalysisParser(Parser):
         model_id="prebuilt-layout",
         use_content_understanding=True,
         content_understanding_endpoint: Union[str, None] = None,
+        figure_concurrency: int = 4,
     ):
         self.model_id = model_id
         self.endpoint = endpoint
         self.credential = credential
         self.use_content_understanding = use_content_understanding
         self.content_understanding_endpoint = content_understanding_endpoint
+        self.figure_concurrency = figure_concurrency
+        self.cu_describer: Optional[ContentUnderstandingDescriber] = None
 
     async def parse(self, content: IO) -> AsyncGenerator[Page, None]:
         logger.info("Extracting text from '%s' using Azure Document Intelligence", content.name)
@@ -78,7 +91,12 @@ class DocumentAnalysisParser(Parser):
                     raise ValueError(
                         "AzureKeyCredential is not supported for Content Understanding, use keyless auth instead"
                     )
-                cu_describer = ContentUnderstandingDescriber(self.content_understanding_endpoint, self.credential)
+                if self.cu_describer is None:
+                    # Kept across documents, so its token and description cache are reused
+                    self.cu_describer = ContentUnderstandingDescriber(
+                        self.content_understanding_endpoint, self.credential
+                    )
+                cu_describer = self.cu_describer
                 content_bytes = content.read()
                 try:
                     poller = await document_intelligence_client.begin_analyze_document(
@@ -108,80 +126,133 @@ class DocumentAnalysisParser(Parser):
                 )
             analyze_result: AnalyzeResult = await poller.result()
 
+            figures = (analyze_result.figures or []) if self.use_content_understanding and file_analyzed else []
+            figure_tasks: list[asyncio.Task[str]] = []
+            if figures:
+                if cu_describer is None:
+                    raise ValueError("cu_describer should not be None, unable to describe figure")
+                # Describe all the figures of the document concurrently up front, each page waits for its own
+                semaphore = asyncio.Semaphore(self.figure_concurrency)
+                crop_lock = threading.Lock()
+
+                async def describe(figure: DocumentFigure) -> str:
+                    async with semaphore:
+                        return await DocumentAnalysisParser.figure_to_html(
+                            doc_for_pymupdf, figure, cu_describer, crop_lock
+                        )
+
+                figure_tasks = [asyncio.create_task(describe(figure)) for figure in figures]
+
             offset = 0
-            for page in analyze_result.pages:
-                tables_on_page = [
-                    table
-                    for table in (analyze_result.tables or [])
-                    if table.bounding_regions and table.bounding_regions[0].page_number == page.page_number
-                ]
-                figures_on_page = []
-                if self.use_content_understanding:
+            try:
+                for page in analyze_result.pages:
+                    tables_on_page = [
+                        table
+                        for table in (analyze_result.tables or [])
+                        if table.bounding_regions and table.bounding_regions[0].page_number == page.page_number
+                    ]
+                    # Indexes of the figures on the page, in analyze_result.figures
                     figures_on_page = [
-                        figure
-                        for figure in (analyze_result.figures or [])
+                        figure_index
+                        for figure_index, figure in enumerate(figures)
                         if figure.bounding_regions and figure.bounding_regions[0].page_number == page.page_number
                     ]
 
-                class ObjectType(Enum):
-                    NONE = -1
-                    TABLE = 0
-                    FIGURE = 1
-
-                page_offset = page.spans[0].offset
-                page_length = page.spans[0].length
-                mask_chars: list[tuple[ObjectType, Union[int, None]]] = [(ObjectType.NONE, None)] * page_length
-                # mark all positions of the table spans in the page
-                for table_idx, table in enumerate(tables_on_page):
-                    for span in table.spans:
-                        # replace all table spans with "table_id" in table_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                mask_chars[idx] = (ObjectType.TABLE, table_idx)
-                # mark all positions of the figure spans in the page
-                for figure_idx, figure in enumerate(figures_on_page):
-                    for span in figure.spans:
-                        # replace all figure spans with "figure_id" in figure_chars array
-                        for i in range(span.length):
-                            idx = span.offset - page_offset + i
-                            if idx >= 0 and idx < page_length:
-                                mask_chars[idx] = (ObjectType.FIGURE, figure_idx)
-
-                # build page text by replacing characters in table spans with table html
-                page_text = ""
-                added_objects = set()  # set of object types todo mypy
-                for idx, mask_char in enumerate(mask_chars):
-                    object_type, object_idx = mask_char
-                    if object_type == ObjectType.NONE:
-                        page_text += analyze_result.content[page_offset + idx]
-                    elif object_type == ObjectType.TABLE:
-                        if object_idx is None:
-                            raise ValueError("Expected object_idx to be set")
-                        if mask_char not in added_objects:
-                            page_text += DocumentAnalysisParser.table_to_html(tables_on_page[object_idx])
-                            added_objects.add(mask_char)
-                    elif object_type == ObjectType.FIGURE:
-                        if cu_describer is None:
-                            raise ValueError("cu_describer should not be None, unable to describe figure")
-                        if object_idx is None:
-                            raise ValueError("Expected object_idx to be set")
-                        if mask_char not in added_objects:
-                            figure_html = await DocumentAnalysisParser.figure_to_html(
-                                doc_for_pymupdf, figures_on_page[object_idx], cu_describer
-                            )
-                            page_text += figure_html
-                            added_objects.add(mask_char)
-                # We remove these comments since they are not needed and skew the page numbers
-                page_text = page_text.replace("<!-- PageBreak -->", "")
-                # We remove excess newlines at the beginning and end of the page
-                page_text = page_text.strip()
-                yield Page(page_num=page.page_number - 1, offset=offset, text=page_text)
-                offset += len(page_text)
+                    page_offset = page.spans[0].offset
+                    page_length = page.spans[0].length
+                    # Spans in the order they mask the page, figures over tables
+                    object_spans: list[tuple[tuple[ObjectType, int], int, int]] = [
+                        ((ObjectType.TABLE, table_idx), span.offset, span.length)
+                        for table_idx, table in enumerate(tables_on_page)
+                        for span in table.spans
+                    ] + [
+                        ((ObjectType.FIGURE, figure_idx), span.offset, span.length)
+                        for figure_idx, figure_index in enumerate(figures_on_page)
+                        for span in figures[figure_index].spans
+                    ]
+
+                    # build page text from the runs of plain text, replacing each table and figure with its html
+                    page_parts: list[str] = []
+                    added_objects = set()  # set of object types todo mypy
+                    for run_start, run_end, mask in DocumentAnalysisParser.mask_runs(
+                        page_offset, page_length, object_spans
+                    ):
+                        if mask is None:
+                            page_parts.append(analyze_result.content[page_offset + run_start : page_offset + run_end])
+                            continue
+                        if mask in added_objects:
+                            continue
+                        object_type, object_idx = mask
+                        if object_type == ObjectType.TABLE:
+                            page_parts.append(DocumentAnalysisParser.table_to_html(tables_on_page[object_idx]))
+                        elif object_type == ObjectType.FIGURE:
+                            page_parts.append(await figure_tasks[figures_on_page[object_idx]])
+                        added_objects.add(mask)
+                    page_text = "".join(page_parts)
+                    # We remove these comments since they are not needed and skew the page numbers
+                    page_text = page_text.replace("<!-- PageBreak -->", "")
+                    # We remove excess newlines at the beginning and end of the page
+                    page_text = page_text.strip()
+                    yield Page(page_num=page.page_number - 1, offset=offset, text=page_text)
+                    offset += len(page_text)
+            finally:
+                for task in figure_tasks:
+                    task.cancel()
+                if figure_tasks:
+                    await asyncio.gather(*figure_tasks, return_exceptions=True)
+
+    async def close(self):
+        # The describer's session is shared by every document of the run
+        if self.cu_describer is not None:
+            await self.cu_describer.close()
+
+    @staticmethod
+    def mask_runs(
+        page_offset: int, page_length: int, object_spans: list[tuple[tuple[ObjectType, int], int, int]]
+    ) -> list[tuple[int, int, Optional[tuple[ObjectType, int]]]]:
+        """
+        Splits a page into runs of characters that are either plain text (None) or masked by one object.
+
+        :param object_spans: (object, offset, length) of every object span, in document coordinates. Where
+            spans overlap, the one listed last masks the characters, as if painted in order.
+        :return: (start, end, object or None) of every run, in page coordinates, covering the whole page
+        """
+        intervals = []
+        for priority, (mask, offset, length) in enumerate(object_spans):
+            start = max(offset - page_offset, 0)
+            end = min(offset - page_offset + length, page_length)
+            if start < end:
+                intervals.append((start, end, priority, mask))
+        if not intervals:
+            return [(0, page_length, None)] if page_length > 0 else []
+        intervals.sort(key=lambda interval: interval[0])
+        boundaries = sorted({0, page_length, *(start for start, *_ in intervals), *(end for _, end, *_ in intervals)})
+
+        # Sweep the boundaries, keeping the spans covering the current segment in a heap by priority.
+        # A span that ended stays in the heap until it reaches the top, and is dropped then.
+        runs: list[tuple[int, int, Optional[tuple[ObjectType, int]]]] = []
+        active: list[tuple[int, int, tuple[ObjectType, int]]] = []
+        next_interval = 0
+        for segment_start, segment_end in zip(boundaries, boundaries[1:]):
+            while next_interval < len(intervals) and intervals[next_interval][0] <= segment_start:
+                start, end, priority, mask = intervals[next_interval]
+                heapq.heappush(active, (-priority, end, mask))
+                next_interval += 1
+            while active and active[0][1] <= segment_start:
+                heapq.heappop(active)
+            owner = active[0][2] if active else None
+            if runs and runs[-1][2] == owner:
+                runs[-1] = (runs[-1][0], segment_end, owner)
+            else:
+                runs.append((segment_start, segment_end, owner))
+        return runs
 
     @staticmethod
     async def figure_to_html(
-        doc: pymupdf.Document, figure: DocumentFigure, cu_describer: ContentUnderstandingDescriber
+        doc: pymupdf.Document,
+        figure: DocumentFigure,
+        cu_describer: ContentUnderstandingDescriber,
+        crop_lock: Optional[threading.Lock] = None,
     ) -> str:
         figure_title = (figure.caption and figure.caption.content) or ""
         logger.info("Describing figure %s with title '%s'", figure.id, figure_title)
@@ -198,7 +269,13 @@ class DocumentAnalysisParser(Parser):
             first_region.polygon[5],  # y1 (bottom)
         )
         page_number = first_region["pageNumber"]  # 1-indexed
-        cropped_img = DocumentAnalysisParser.crop_image_from_pdf_page(doc, page_number - 1, bounding_box)
+        # Rendering is CPU bound, so crop in a thread. A pymupdf document can't be used from several threads
+        # at once, so figures cropped concurrently share a lock.
+        def crop() -> bytes:
+            with crop_lock or contextlib.nullcontext():
+                return DocumentAnalysisParser.crop_image_from_pdf_page(doc, page_number - 1, bounding_box)
+
+        cropped_img = await asyncio.to_thread(crop)
         figure_description = await cu_describer.describe_image(cropped_img)
         return f"<figure><figcaption>{figure_title}<br>{figure_description}</figcaption></figure>"
 
@@ -0,0 +1,162 @@
+import asyncio
+import logging
+import time
+from collections.abc import AsyncIterator, Awaitable
+from dataclasses import dataclass
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger("scripts")
+
+_DONE = object()
+
+
+@dataclass(frozen=True)
+class PipelineConcurrency:
+    """Number of concurrent workers per ingestion stage, and the size of the queue feeding each stage"""
+
+    parse: int = 4
+    split: int = 2
+    embed: int = 4
+    index: int = 2
+    queue_size: int = 8
+
+
+class StageMetrics:
+    """Throughput and queue depth of one pipeline stage"""
+
+    def __init__(self, name: str, concurrency: int):
+        self.name = name
+        self.concurrency = concurrency
+        self.items_in = 0
+        self.items_out = 0
+        self.busy_seconds = 0.0
+        self.max_queue_depth = 0
+        self.total_queue_depth = 0
+
+    def record(self, queue_depth: int, seconds: float, forwarded: bool):
+        self.items_in += 1
+        self.items_out += forwarded
+        self.busy_seconds += seconds
+        self.max_queue_depth = max(self.max_queue_depth, queue_depth)
+        self.total_queue_depth += queue_depth
+
+    def summary(self, elapsed: float) -> dict[str, Any]:
+        return {
+            "stage": self.name,
+            "concurrency": self.concurrency,
+            "items_in": self.items_in,
+            "items_out": self.items_out,
+            "items_per_second": self.items_in / elapsed if elapsed else 0.0,
+            # Share of the run the stage's workers spent working; close to 1 means the stage is the bottleneck
+            "utilization": self.busy_seconds / (elapsed * self.concurrency) if elapsed else 0.0,
+            "avg_queue_depth": self.total_queue_depth / self.items_in if self.items_in else 0.0,
+            "max_queue_depth": self.max_queue_depth,
+        }
+
+
+class PipelineStage:
+    """
+    A step of the pipeline. The handler transforms an item for the next stage, or returns None to drop it.
+    When the pipeline is cancelled, discard is called with every item the stage received or had queued but
+    did not finish, so it can release it.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        handler: Callable[[Any], Awaitable[Optional[Any]]],
+        concurrency: int = 1,
+        discard: Optional[Callable[[Any], None]] = None,
+    ):
+        if concurrency < 1:
+            raise ValueError(f"Stage '{name}' needs a concurrency of at least 1")
+        self.name = name
+        self.handler = handler
+        self.concurrency = concurrency
+        self.discard = discard
+
+
+async def run_pipeline(
+    source: AsyncIterator[Any], stages: list[PipelineStage], queue_size: int = 8
+) -> list[dict[str, Any]]:
+    """
+    Push the items of source through the stages, connected by bounded queues so a slow stage
+    applies backpressure instead of buffering the whole corpus. The first failure cancels the
+    pipeline and is raised, after every unfinished item has been discarded. Returns the metrics
+    of every stage.
+    """
+    queues: list[asyncio.Queue] = [asyncio.Queue(maxsize=queue_size) for _ in stages]
+    metrics = [StageMetrics(stage.name, stage.concurrency) for stage in stages]
+    started = time.perf_counter()
+
+    def discard(index: int, item: Any):
+        if item is not _DONE and stages[index].discard is not None:
+            stages[index].discard(item)
+
+    async def put(index: int, item: Any):
+        try:
+            await queues[index].put(item)
+        except asyncio.CancelledError:
+            # Cancelled while waiting for room, the item is in neither stage
+            discard(index, item)
+            raise
+
+    async def feed():
+        async for item in source:
+            await put(0, item)
+        for _ in range(stages[0].concurrency):
+            await put(0, _DONE)
+
+    async def work(index: int):
+        stage, queue = stages[index], queues[index]
+        has_output = index + 1 < len(stages)
+        while True:
+            queue_depth = queue.qsize()
+            item = await queue.get()
+            if item is _DONE:
+                return
+            stage_started = time.perf_counter()
+            try:
+                result = await stage.handler(item)
+            except asyncio.CancelledError:
+                discard(index, item)
+                raise
+            metrics[index].record(queue_depth, time.perf_counter() - stage_started, result is not None)
+            if result is not None and has_output:
+                await put(index + 1, result)
+
+    async def run_stage(index: int):
+        await asyncio.gather(*(work(index) for _ in range(stages[index].concurrency)))
+        if index + 1 < len(stages):
+            for _ in range(stages[index + 1].concurrency):
+                await put(index + 1, _DONE)
+
+    tasks = [asyncio.create_task(feed())] + [asyncio.create_task(run_stage(index)) for index in range(len(stages))]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        # Items still queued never reach the end of the pipeline
+        for index, queue in enumerate(queues):
+            while not queue.empty():
+                discard(index, queue.get_nowait())
+    for task in done:
+        if not task.cancelled() and task.exception() is not None:
+            raise task.exception()
+
+    elapsed = time.perf_counter() - started
+    summaries = [stage_metrics.summary(elapsed) for stage_metrics in metrics]
+    for summary in summaries:
+        logger.info(
+            "Stage '%s': %d in, %d out, %.2f items/s, %.0f%% busy, queue depth avg %.1f max %d",
+            summary["stage"],
+            summary["items_in"],
+            summary["items_out"],
+            summary["items_per_second"],
+            summary["utilization"] * 100,
+            summary["avg_queue_depth"],
+            summary["max_queue_depth"],
+        )
+    return summaries
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import time
+from collections.abc import Mapping
+from typing import Optional
+
+logger = logging.getLogger("scripts")
+
+# Quotas are enforced over short windows, so never let a bucket hold more than this much of a minute's budget
+BURST_SECONDS = 10
+
+
+class TokenBucket:
+    """
+    Bucket refilled continuously at limit_per_minute / 60 per second
+    """
+
+    def __init__(self, limit_per_minute: float):
+        self.set_limit(limit_per_minute)
+        self.level = self.capacity
+        self.updated_at = time.monotonic()
+
+    def set_limit(self, limit_per_minute: float):
+        self.limit_per_minute = limit_per_minute
+        self.rate = limit_per_minute / 60
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+
+    def refill(self, now: float):
+        self.level = min(self.capacity, self.level + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount is available (amounts above the capacity only need a full bucket)"""
+        missing = min(amount, self.capacity) - self.level
+        return max(0.0, missing / self.rate)
+
+
+def retry_after_seconds(headers: Optional[Mapping[str, str]]) -> Optional[float]:
+    """Read the retry delay of a 429 response, preferring the millisecond header Azure OpenAI sends"""
+    if not headers:
+        return None
+    try:
+        if headers.get("retry-after-ms"):
+            return float(headers["retry-after-ms"]) / 1000
+        if headers.get("retry-after"):
+            return float(headers["retry-after"])
+    except ValueError:
+        return None
+    return None
+
+
+class RateLimiter:
+    """
+    Token-bucket scheduler for an API with both a requests-per-minute and a tokens-per-minute quota.
+
+    Callers acquire the request and its token count before sending, so concurrent
+    requests go out as fast as the quota allows without bursting past it. The
+    buckets are corrected from the x-ratelimit-* response headers, which also
+    reveal the quota when none was configured, and a 429 pauses every caller
+    for the Retry-After delay.
+    """
+
+    def __init__(self, requests_per_minute: Optional[int] = None, tokens_per_minute: Optional[int] = None):
+        self.requests = TokenBucket(requests_per_minute) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute) if tokens_per_minute else None
+        self.paused_until = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, token_count: int):
+        # The lock makes callers wait their turn, so a large request is not starved by smaller ones
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                delay = self.paused_until - now
+                for bucket, amount in ((self.requests, 1), (self.tokens, token_count)):
+                    if bucket is not None:
+                        bucket.refill(now)
+                        delay = max(delay, bucket.wait_time(amount))
+                if delay <= 0:
+                    break
+                await asyncio.sleep(delay)
+
+            for bucket, amount in ((self.requests, 1), (self.tokens, token_count)):
+                if bucket is not None:
+                    bucket.level -= min(amount, bucket.capacity)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """Adopt the quota and remaining budget reported by the service"""
+        now = time.monotonic()
+        for name in ("requests", "tokens"):
+            limit = _header_number(headers, f"x-ratelimit-limit-{name}")
+            remaining = _header_number(headers, f"x-ratelimit-remaining-{name}")
+            bucket = getattr(self, name)
+            if bucket is None:
+                if limit is None:
+                    continue
+                bucket = TokenBucket(limit)
+                setattr(self, name, bucket)
+            elif limit is not None and limit != bucket.limit_per_minute:
+                bucket.set_limit(limit)
+            bucket.refill(now)
+            if remaining is not None:
+                # Other clients share the quota, so the service's count wins when it is lower
+                bucket.level = min(bucket.level, remaining)
+
+    def pause(self, seconds: Optional[float]):
+        """Hold every request for seconds after the service rejected one, and drain the buckets"""
+        seconds = seconds if seconds is not None else BURST_SECONDS
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+        for bucket in (self.requests, self.tokens):
+            if bucket is not None:
+                bucket.level = 0.0
+        logger.info("Rate limited, pausing requests for %.1f seconds", seconds)
+
+
+def _header_number(headers: Mapping[str, str], name: str) -> Optional[float]:
+    value = headers.get(name)
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        return None
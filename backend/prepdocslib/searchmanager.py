@@ -1,7 +1,13 @@
 import asyncio
+import hashlib
+import json
 import logging
 import os
-from typing import Optional
+import time
+from typing import Any, Optional
+
+from azure.core.exceptions import HttpResponseError
+from azure.search.documents.aio import SearchClient
 
 from azure.search.documents.indexes.models import (
     AzureOpenAIVectorizer,
@@ -33,18 +39,28 @@ from azure.search.documents.indexes.models import (
 
 from .blobmanager import BlobManager
 from .embeddings import AzureOpenAIEmbeddingService, OpenAIEmbeddings
+from .indexmanifest import IndexManifest
 from .listfilestrategy import File
 from .strategy import SearchInfo
 from .textsplitter import SplitPage
 
 logger = logging.getLogger("scripts")
 
+# An indexing request holds at most 1000 documents and 16 MB, batches stay under the size with room for the envelope
+MAX_BATCH_DOCUMENTS = 1000
+MAX_BATCH_BYTES = 14 * 1024 * 1024
+# Per-document statuses worth retrying: version conflict, index temporarily unavailable, service busy
+RETRIABLE_STATUS_CODES = {409, 422, 429, 503}
+MAX_UPLOAD_ATTEMPTS = 4
+
 
 class Section:
     """
     A section of a page that is stored in a search service. These sections are used as context by Azure OpenAI service
     """
 
+    __slots__ = ("split_page", "content", "category")
+
     def __init__(self, split_page: SplitPage, content: File, category: Optional[str] = None):
         self.split_page = split_page
         self.content = content
@@ -66,6 +82,8 @@ class SearchManager:
         embeddings: Optional[OpenAIEmbeddings] = None,
         field_name_embedding: Optional[str] = None,
         search_images: bool = False,
+        manifest: Optional[IndexManifest] = None,
+        upload_concurrency: int = 4,
     ):
         self.search_info = search_info
         self.search_analyzer_name = search_analyzer_name
@@ -75,6 +93,8 @@ class SearchManager:
         self.embedding_dimensions = self.embeddings.open_ai_dimensions if self.embeddings else None
         self.field_name_embedding = field_name_embedding
         self.search_images = search_images
+        self.manifest = manifest
+        self.upload_concurrency = upload_concurrency
 
     async def create_index(self):
         logger.info("Checking whether search index %s exists...", self.search_info.index_name)
@@ -410,56 +430,281 @@ class SearchManager:
 
             logger.info("Agent %s created successfully", self.search_info.agent_name)
 
+    def create_documents(
+        self,
+        sections: list[Section],
+        image_embeddings: Optional[list[list[float]]] = None,
+        url: Optional[str] = None,
+    ) -> list[dict[str, Any]]:
+        """
+        Search documents of the sections, without their vectors. With a manifest, a section's ID is
+        derived from its text rather than its position, so it survives edits elsewhere in the file.
+        """
+        documents = []
+        occurrences: dict[str, int] = {}
+        for section_index, section in enumerate(sections):
+            file_id = section.content.filename_to_id()
+            if self.manifest is not None:
+                text_hash = hashlib.sha256(section.split_page.text.encode("utf-8")).hexdigest()[:32]
+                # Repeated text (boilerplate, headers) still needs one document per occurrence
+                occurrence = occurrences.get(f"{file_id}-{text_hash}", 0)
+                occurrences[f"{file_id}-{text_hash}"] = occurrence + 1
+                document_id = f"{file_id}-{text_hash}" + (f"-{occurrence}" if occurrence else "")
+            else:
+                document_id = f"{file_id}-page-{section_index}"
+            documents.append(
+                {
+                    "id": document_id,
+                    "content": section.split_page.text,
+                    "category": section.category,
+                    "sourcepage": (
+                        BlobManager.blob_image_name_from_file_page(
+                            filename=section.content.filename(),
+                            page=section.split_page.page_num,
+                        )
+                        if image_embeddings
+                        else BlobManager.sourcepage_from_file_page(
+                            filename=section.content.filename(),
+                            page=section.split_page.page_num,
+                        )
+                    ),
+                    "sourcefile": section.content.filename(),
+                    **section.content.acls,
+                }
+            )
+            if url:
+                documents[-1]["storageUrl"] = url
+        return documents
+
+    def document_hash(self, document: dict[str, Any], has_image_embedding: bool = False) -> str:
+        """Hash of everything that ends up in the indexed document, including how its vectors are computed"""
+        fingerprint = {
+            "document": document,
+            "embedding": (
+                [self.field_name_embedding, self.embeddings.open_ai_model_name, self.embedding_dimensions]
+                if self.embeddings
+                else None
+            ),
+            "image_embedding": has_image_embedding,
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+    def diff_manifest(
+        self, sections: list[Section], documents: list[dict[str, Any]], has_image_embeddings: bool = False
+    ) -> tuple[list[int], list[str], dict[str, tuple[str, dict[str, str]]]]:
+        """
+        Compare the documents with the manifest. Returns the positions of the documents to upload,
+        the IDs of the indexed documents to delete, and the new manifest entries per file ID.
+        """
+        if self.manifest is None:
+            return list(range(len(documents))), [], {}
+        files: dict[str, tuple[str, dict[str, str]]] = {}
+        indexed: dict[str, dict[str, str]] = {}
+        upload: list[int] = []
+        for index, (section, document) in enumerate(zip(sections, documents)):
+            file_id = section.content.filename_to_id()
+            if file_id not in files:
+                files[file_id] = (section.content.filename(), {})
+                indexed[file_id] = self.manifest.get(file_id)
+            content_hash = self.document_hash(document, has_image_embeddings)
+            files[file_id][1][document["id"]] = content_hash
+            if indexed[file_id].get(document["id"]) != content_hash:
+                upload.append(index)
+        removed = [
+            chunk_id
+            for file_id, (_, chunks) in files.items()
+            for chunk_id in indexed[file_id]
+            if chunk_id not in chunks
+        ]
+        return upload, removed, files
+
+    def sections_to_upload(
+        self,
+        sections: list[Section],
+        image_embeddings: Optional[list[list[float]]] = None,
+        url: Optional[str] = None,
+    ) -> list[int]:
+        """Positions of the sections that are new or changed since they were last indexed"""
+        documents = self.create_documents(sections, image_embeddings, url)
+        return self.diff_manifest(sections, documents, bool(image_embeddings))[0]
+
     async def update_content(
-        self, sections: list[Section], image_embeddings: Optional[list[list[float]]] = None, url: Optional[str] = None
+        self,
+        sections: list[Section],
+        image_embeddings: Optional[list[list[float]]] = None,
+        url: Optional[str] = None,
+        section_embeddings: Optional[list[Optional[list[float]]]] = None,
     ):
-        MAX_BATCH_SIZE = 1000
-        section_batches = [sections[i : i + MAX_BATCH_SIZE] for i in range(0, len(sections), MAX_BATCH_SIZE)]
+        documents = self.create_documents(sections, image_embeddings, url)
+        upload, removed, files = self.diff_manifest(sections, documents, bool(image_embeddings))
+        if self.manifest is not None:
+            logger.info(
+                "Uploading %d new or changed sections out of %d, deleting %d removed sections",
+                len(upload),
+                len(documents),
+                len(removed),
+            )
+
+        upload_documents = [documents[index] for index in upload]
+        if upload and self.embeddings:
+            if self.field_name_embedding is None:
+                raise ValueError("Embedding field name must be set")
+            # Use the embeddings computed ahead by the caller, and compute the missing ones
+            missing = [index for index in upload if section_embeddings is None or section_embeddings[index] is None]
+            computed: dict[int, list[float]] = {}
+            if missing:
+                embeddings = await self.embeddings.create_embeddings(
+                    texts=[sections[index].split_page.text for index in missing],
+                    token_counts=[sections[index].split_page.token_count for index in missing],
+                )
+                computed = dict(zip(missing, embeddings))
+            for index, document in zip(upload, upload_documents):
+                document[self.field_name_embedding] = (
+                    computed[index] if index in computed else section_embeddings[index]  # type: ignore[index]
+                )
+        if image_embeddings:
+            for index, document in zip(upload, upload_documents):
+                document["imageEmbedding"] = image_embeddings[sections[index].split_page.page_num]
 
         async with self.search_info.create_search_client() as search_client:
-            for batch_index, batch in enumerate(section_batches):
-                documents = [
-                    {
-                        "id": f"{section.content.filename_to_id()}-page-{section_index + batch_index * MAX_BATCH_SIZE}",
-                        "content": section.split_page.text,
-                        "category": section.category,
-                        "sourcepage": (
-                            BlobManager.blob_image_name_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                            if image_embeddings
-                            else BlobManager.sourcepage_from_file_page(
-                                filename=section.content.filename(),
-                                page=section.split_page.page_num,
-                            )
-                        ),
-                        "sourcefile": section.content.filename(),
-                        **section.content.acls,
-                    }
-                    for section_index, section in enumerate(batch)
-                ]
-                if url:
-                    for document in documents:
-                        document["storageUrl"] = url
-                if self.embeddings:
-                    if self.field_name_embedding is None:
-                        raise ValueError("Embedding field name must be set")
-                    embeddings = await self.embeddings.create_embeddings(
-                        texts=[section.split_page.text for section in batch]
-                    )
-                    for i, document in enumerate(documents):
-                        document[self.field_name_embedding] = embeddings[i]
-                if image_embeddings:
-                    for i, (document, section) in enumerate(zip(documents, batch)):
-                        document["imageEmbedding"] = image_embeddings[section.split_page.page_num]
+            if self.manifest is not None:
+                for file_id, (sourcefile, _) in files.items():
+                    if not self.manifest.get(file_id):
+                        await self._remove_positional_sections(search_client, file_id, sourcefile)
+
+            if upload_documents:
+                started = time.perf_counter()
+                batches = self.batch_documents(upload_documents)
+                semaphore = asyncio.Semaphore(self.upload_concurrency)
+
+                async def upload_batch(batch: list[dict[str, Any]]):
+                    async with semaphore:
+                        await self._upload_batch(search_client, batch)
+
+                tasks = [asyncio.create_task(upload_batch(batch)) for batch in batches]
+                try:
+                    await asyncio.gather(*tasks)
+                finally:
+                    # A batch failing for good fails the file, don't leave the other batches uploading
+                    for task in tasks:
+                        task.cancel()
+                    await asyncio.gather(*tasks, return_exceptions=True)
+                elapsed = time.perf_counter() - started
+                logger.info(
+                    "Indexed %d sections in %d batches in %.1fs (%.1f docs/s)",
+                    len(upload_documents),
+                    len(batches),
+                    elapsed,
+                    len(upload_documents) / elapsed if elapsed else 0.0,
+                )
 
-                await search_client.upload_documents(documents)
+            for batch_start in range(0, len(removed), MAX_BATCH_DOCUMENTS):
+                await search_client.delete_documents(
+                    [{"id": chunk_id} for chunk_id in removed[batch_start : batch_start + MAX_BATCH_DOCUMENTS]]
+                )
+
+        if self.manifest is not None:
+            for file_id, (sourcefile, chunks) in files.items():
+                self.manifest.replace(file_id, sourcefile, chunks)
+
+    @staticmethod
+    def batch_documents(
+        documents: list[dict[str, Any]],
+        max_documents: int = MAX_BATCH_DOCUMENTS,
+        max_bytes: int = MAX_BATCH_BYTES,
+    ) -> list[list[dict[str, Any]]]:
+        """
+        Group the documents into indexing requests of at most max_documents and max_bytes of JSON.
+        Vectors make up most of the size, so a batch of embedded documents is bound by bytes long before count.
+        """
+        batches: list[list[dict[str, Any]]] = []
+        batch: list[dict[str, Any]] = []
+        batch_bytes = 0
+        for document in documents:
+            # The separator between documents is counted with each document
+            document_bytes = len(json.dumps(document, default=str).encode("utf-8")) + 1
+            if batch and (len(batch) >= max_documents or batch_bytes + document_bytes > max_bytes):
+                batches.append(batch)
+                batch, batch_bytes = [], 0
+            batch.append(document)
+            batch_bytes += document_bytes
+        if batch:
+            batches.append(batch)
+        return batches
+
+    async def _upload_batch(self, search_client: SearchClient, batch: list[dict[str, Any]]):
+        """Upload a batch, retrying only the documents the service failed to index with a transient status"""
+        pending = batch
+        for attempt in range(MAX_UPLOAD_ATTEMPTS):
+            try:
+                results = await search_client.upload_documents(pending)
+            except HttpResponseError as e:
+                if e.status_code == 413 and len(pending) > 1:
+                    # Larger than estimated, split it rather than fail the file
+                    middle = len(pending) // 2
+                    logger.info("Indexing request of %d sections was too large, splitting it", len(pending))
+                    await self._upload_batch(search_client, pending[:middle])
+                    await self._upload_batch(search_client, pending[middle:])
+                    return
+                raise
+            failed = {result.key: result for result in results if not result.succeeded}
+            if not failed:
+                return
+            permanent = [result for result in failed.values() if result.status_code not in RETRIABLE_STATUS_CODES]
+            if permanent or attempt == MAX_UPLOAD_ATTEMPTS - 1:
+                errors = permanent or list(failed.values())
+                raise Exception(
+                    f"Failed to index {len(errors)} sections, first error on '{errors[0].key}': "
+                    f"{errors[0].status_code} {errors[0].error_message}"
+                )
+            pending = [document for document in pending if document["id"] in failed]
+            delay = 2**attempt
+            logger.info("Retrying %d sections the index failed to update in %ds", len(pending), delay)
+            await asyncio.sleep(delay)
+
+    async def _remove_positional_sections(self, search_client: SearchClient, file_id: str, sourcefile: str):
+        """
+        Delete the sections a file was indexed with before the manifest existed, whose IDs were their positions
+        """
+        prefix = f"{file_id}-page-"
+        sourcefile_for_filter = sourcefile.replace("'", "''")
+        max_results = 1000
+        while True:
+            # The filter also matches the sections just indexed, page through all of them to find the old ones
+            positional_ids: list[str] = []
+            skip = 0
+            while True:
+                result = await search_client.search(
+                    search_text="",
+                    filter=f"sourcefile eq '{sourcefile_for_filter}'",
+                    select=["id"],
+                    top=max_results,
+                    skip=skip,
+                )
+                ids = [document["id"] async for document in result]
+                positional_ids.extend(id for id in ids if id.startswith(prefix))
+                if len(ids) < max_results:
+                    break
+                skip += len(ids)
+            if not positional_ids:
+                return
+            for start in range(0, len(positional_ids), MAX_BATCH_DOCUMENTS):
+                batch = positional_ids[start : start + MAX_BATCH_DOCUMENTS]
+                await search_client.delete_documents([{"id": id} for id in batch])
+            logger.info("Removed %d sections of '%s' indexed by position", len(positional_ids), sourcefile)
+            # It can take a few seconds for search results to reflect changes, so wait a bit before checking again
+            await asyncio.sleep(2)
 
     async def remove_content(self, path: Optional[str] = None, only_oid: Optional[str] = None):
         logger.info(
             "Removing sections from '{%s or '<all>'}' from search index '%s'", path, self.search_info.index_name
         )
+        if self.manifest is not None:
+            # Forget what was indexed, so the next ingestion of the file uploads all its sections again
+            if path is None:
+                self.manifest.clear()
+            else:
+                self.manifest.remove(os.path.basename(path))
         async with self.search_info.create_search_client() as search_client:
             while True:
                 filter = None
@@ -1,10 +1,12 @@
+import bisect
 import logging
+import re
 from abc import ABC
 from collections.abc import Generator
-
-import tiktoken
+from typing import Optional
 
 from .page import Page, SplitPage
+from .tokens import ENCODING_MODEL, get_encoding
 
 logger = logging.getLogger("scripts")
 
@@ -21,8 +23,6 @@ class TextSplitter(ABC):
             yield  # pragma: no cover - this is necessary for mypy to type check
 
 
-ENCODING_MODEL = "text-embedding-ada-002"
-
 STANDARD_WORD_BREAKS = [",", ";", ":", " ", "(", ")", "[", "]", "{", "}", "\t", "\n"]
 
 # See W3C document https://www.w3.org/TR/jlreq/#cl-01
@@ -75,34 +75,66 @@ STANDARD_SENTENCE_ENDINGS = [".", "!", "?"]
 # https://www.w3.org/TR/jlreq/#cl-04
 CJK_SENTENCE_ENDINGS = ["。", "！", "？", "‼", "⁇", "⁈", "⁉"]
 
-# NB: text-embedding-3-XX is the same BPE as text-embedding-ada-002
-bpe = tiktoken.encoding_for_model(ENCODING_MODEL)
+bpe = get_encoding(ENCODING_MODEL)
 
 DEFAULT_OVERLAP_PERCENT = 10  # See semantic search article for 10% overlap performance
 DEFAULT_SECTION_LENGTH = 1000  # Roughly 400-500 tokens for English
 
 
+def characters_pattern(characters: list[str]) -> str:
+    """Regex matching any one of the characters"""
+    return "[" + re.escape("".join(characters)) + "]"
+
+
 class SentenceTextSplitter(TextSplitter):
     """
     Class that splits pages into smaller chunks. This is required because embedding models may not be able to analyze an entire page at once
     """
 
-    def __init__(self, max_tokens_per_section: int = 500):
+    def __init__(
+        self, max_tokens_per_section: int = 500, keep_tokens: bool = False, split_by_token_offsets: bool = False
+    ):
         self.sentence_endings = STANDARD_SENTENCE_ENDINGS + CJK_SENTENCE_ENDINGS
         self.word_breaks = STANDARD_WORD_BREAKS + CJK_WORD_BREAKS
         self.max_section_length = DEFAULT_SECTION_LENGTH
         self.sentence_search_limit = 100
         self.max_tokens_per_section = max_tokens_per_section
+        self.keep_tokens = keep_tokens
+        self.split_by_token_offsets = split_by_token_offsets
         self.section_overlap = int(self.max_section_length * DEFAULT_OVERLAP_PERCENT / 100)
 
-    def split_page_by_max_tokens(self, page_num: int, text: str) -> Generator[SplitPage, None, None]:
+    def make_split_page(
+        self, page_num: int, text: str, tokens: list[int], buffer: Optional[str], offset: int
+    ) -> SplitPage:
+        """A split page of the text, as a view when the text is at offset in buffer"""
+        if buffer is None:
+            return SplitPage(
+                page_num=page_num, text=text, token_count=len(tokens), tokens=tokens if self.keep_tokens else None
+            )
+        return SplitPage.view(
+            page_num=page_num,
+            buffer=buffer,
+            start=offset,
+            end=offset + len(text),
+            token_count=len(tokens),
+            tokens=tokens if self.keep_tokens else None,
+        )
+
+    def split_page_by_max_tokens(
+        self, page_num: int, text: str, buffer: Optional[str] = None, offset: int = 0
+    ) -> Generator[SplitPage, None, None]:
         """
         Recursively splits page by maximum number of tokens to better handle languages with higher token/word ratios.
+        When text is found at offset in buffer, the split pages are views of buffer rather than copies.
         """
+        if self.split_by_token_offsets:
+            yield from self.split_page_by_token_offsets(page_num, text, buffer, offset)
+            return
+
         tokens = bpe.encode(text)
         if len(tokens) <= self.max_tokens_per_section:
-            # Section is already within max tokens, return
-            yield SplitPage(page_num=page_num, text=text)
+            # Section is already within max tokens, return it with its token count so it is not encoded again
+            yield self.make_split_page(page_num, text, tokens, buffer, offset)
         else:
             # Start from the center and try and find the closest sentence ending by spiralling outward.
             # IF we get to the outer thirds, then just split in half with a 5% overlap
@@ -123,6 +155,7 @@ class SentenceTextSplitter(TextSplitter):
             if split_position > 0:
                 first_half = text[: split_position + 1]
                 second_half = text[split_position + 1 :]
+                second_offset = offset + split_position + 1
             else:
                 # Split page in half and call function again
                 # Overlap first and second halves by DEFAULT_OVERLAP_PERCENT%
@@ -130,16 +163,102 @@ class SentenceTextSplitter(TextSplitter):
                 overlap = int(len(text) * (DEFAULT_OVERLAP_PERCENT / 100))
                 first_half = text[: middle + overlap]
                 second_half = text[middle - overlap :]
-            yield from self.split_page_by_max_tokens(page_num, first_half)
-            yield from self.split_page_by_max_tokens(page_num, second_half)
+                second_offset = offset + middle - overlap
+            yield from self.split_page_by_max_tokens(page_num, first_half, buffer, offset)
+            yield from self.split_page_by_max_tokens(page_num, second_half, buffer, second_offset)
+
+    def split_page_by_token_offsets(
+        self, page_num: int, text: str, buffer: Optional[str] = None, offset: int = 0
+    ) -> Generator[SplitPage, None, None]:
+        """
+        Splits page by maximum number of tokens like split_page_by_max_tokens, but encodes the text only once.
+        Split points are chosen among the token boundaries, preferring the one right after a sentence ending
+        that is closest to an even split, then a word break. The tokens of a piece cut after sentence endings
+        are those of the whole text, any other cut can change how the text around it encodes, so such a piece
+        is encoded again on its own and cut earlier until it fits.
+        """
+        tokens = bpe.encode(text)
+        if len(tokens) <= self.max_tokens_per_section:
+            yield self.make_split_page(page_num, text, tokens, buffer, offset)
+            return
+
+        # Character offset at which each token starts
+        _, offsets = bpe.decode_with_offsets(tokens)
+        sentence_ends = [match.start() for match in re.finditer(characters_pattern(self.sentence_endings), text)]
+        word_break_pattern = re.compile(characters_pattern(self.word_breaks))
+
+        start = 0
+        # Whether the current piece starts at a cut that can change the tokens around it
+        cut_start = False
+        while True:
+            remaining = len(tokens) - start
+            if remaining <= self.max_tokens_per_section:
+                piece_tokens = bpe.encode(text[offsets[start] :]) if cut_start else tokens[start:]
+                if len(piece_tokens) <= self.max_tokens_per_section:
+                    yield self.make_split_page(
+                        page_num, text[offsets[start] :], piece_tokens, buffer, offset + offsets[start]
+                    )
+                    return
+            # The last piece may encode to more tokens on its own, it is then split in two like any other
+            pieces = max(2, -(-remaining // self.max_tokens_per_section))
+            target = start + -(-remaining // pieces)
+            # Like the recursive split, only consider sentence endings in the middle of the piece
+            lowest = max(start + 1, start + (target - start) // 2)
+            highest = min(start + self.max_tokens_per_section, len(tokens) - 1)
+
+            split = -1
+            index = bisect.bisect_left(sentence_ends, offsets[lowest] - 1)
+            while index < len(sentence_ends) and sentence_ends[index] < offsets[highest]:
+                # First token boundary after the sentence ending
+                boundary = bisect.bisect_right(offsets, sentence_ends[index], lo=lowest)
+                if lowest <= boundary <= highest and (split < 0 or abs(boundary - target) < abs(split - target)):
+                    split = boundary
+                index += 1
+
+            if split > 0:
+                cut_end = False
+            else:
+                # No sentence ends nearby, split evenly and overlap the pieces by DEFAULT_OVERLAP_PERCENT%,
+                # at a word break if possible since the tokens of a word change once it is cut
+                word_breaks = [
+                    match.start() for match in word_break_pattern.finditer(text, offsets[lowest], offsets[target])
+                ]
+                split = bisect.bisect_left(offsets, word_breaks[-1], lo=lowest) if word_breaks else target
+                cut_end = True
+            while True:
+                # Tokens can end in the middle of a multi-byte character, pieces start at a whole one
+                while split > start + 1 and offsets[split] == offsets[split - 1]:
+                    split -= 1
+                    cut_end = True
+                if not cut_start and not cut_end:
+                    piece_tokens = tokens[start:split]
+                    break
+                piece_tokens = bpe.encode(text[offsets[start] : offsets[split]])
+                if len(piece_tokens) <= self.max_tokens_per_section or split <= start + 1:
+                    break
+                # Move the cut back by the tokens in excess until the piece fits
+                split -= min(len(piece_tokens) - self.max_tokens_per_section, split - start - 1)
+                cut_end = True
+
+            if cut_end:
+                next_start = max(start + 1, split - (split - start) * DEFAULT_OVERLAP_PERCENT // 100)
+                while next_start > start + 1 and offsets[next_start] == offsets[next_start - 1]:
+                    next_start -= 1
+            else:
+                next_start = split
+            yield self.make_split_page(
+                page_num, text[offsets[start] : offsets[split]], piece_tokens, buffer, offset + offsets[start]
+            )
+            start = next_start
+            cut_start = cut_end
 
     def split_pages(self, pages: list[Page]) -> Generator[SplitPage, None, None]:
+        page_offsets = [page.offset for page in pages]
+
         def find_page(offset):
-            num_pages = len(pages)
-            for i in range(num_pages - 1):
-                if offset >= pages[i].offset and offset < pages[i + 1].offset:
-                    return pages[i].page_num
-            return pages[num_pages - 1].page_num
+            index = bisect.bisect_right(page_offsets, offset) - 1
+            # Offsets before the first page fall back to the last page, like a linear scan did
+            return pages[index].page_num if index >= 0 else pages[-1].page_num
 
         all_text = "".join(page.text for page in pages)
         if len(all_text.strip()) == 0:
@@ -147,49 +266,59 @@ class SentenceTextSplitter(TextSplitter):
 
         length = len(all_text)
         if length <= self.max_section_length:
-            yield from self.split_page_by_max_tokens(page_num=find_page(0), text=all_text)
+            yield from self.split_page_by_max_tokens(page_num=find_page(0), text=all_text, buffer=all_text)
             return
 
+        # Boundaries are found by binary search over the positions of all sentence endings, collected in one
+        # regex pass, instead of walking the text one character at a time. Word breaks are much more common
+        # and only needed when no sentence ends near a boundary, so those are searched within the window.
+        sentence_endings = set(self.sentence_endings)
+        sentence_ends = [match.start() for match in re.finditer(characters_pattern(self.sentence_endings), all_text)]
+        word_break_pattern = re.compile(characters_pattern(self.word_breaks))
+
         start = 0
         end = length
         while start + self.section_overlap < length:
-            last_word = -1
             end = start + self.max_section_length
 
             if end > length:
                 end = length
             else:
                 # Try to find the end of the sentence
-                while (
-                    end < length
-                    and (end - start - self.max_section_length) < self.sentence_search_limit
-                    and all_text[end] not in self.sentence_endings
-                ):
-                    if all_text[end] in self.word_breaks:
-                        last_word = end
-                    end += 1
-                if end < length and all_text[end] not in self.sentence_endings and last_word > 0:
-                    end = last_word  # Fall back to at least keeping a whole word
+                search_end = min(length, start + self.max_section_length + self.sentence_search_limit)
+                index = bisect.bisect_left(sentence_ends, end)
+                if index < len(sentence_ends) and sentence_ends[index] < search_end:
+                    end = sentence_ends[index]
+                else:
+                    last_word = -1
+                    for match in word_break_pattern.finditer(all_text, end, search_end):
+                        last_word = match.start()
+                    end = search_end
+                    if end < length and all_text[end] not in sentence_endings and last_word > 0:
+                        end = last_word  # Fall back to at least keeping a whole word
             if end < length:
                 end += 1
 
             # Try to find the start of the sentence or at least a whole word boundary
-            last_word = -1
-            while (
-                start > 0
-                and start > end - self.max_section_length - 2 * self.sentence_search_limit
-                and all_text[start] not in self.sentence_endings
-            ):
-                if all_text[start] in self.word_breaks:
-                    last_word = start
-                start -= 1
-            if all_text[start] not in self.sentence_endings and last_word > 0:
-                start = last_word
+            search_start = max(0, end - self.max_section_length - 2 * self.sentence_search_limit)
+            if start > search_start:
+                index = bisect.bisect_right(sentence_ends, start) - 1
+                if index >= 0 and sentence_ends[index] > search_start:
+                    start = sentence_ends[index]
+                else:
+                    match = word_break_pattern.search(all_text, search_start + 1, start + 1)
+                    last_word = match.start() if match else -1
+                    start = search_start
+                    if all_text[start] not in sentence_endings and last_word > 0:
+                        start = last_word
             if start > 0:
                 start += 1
 
             section_text = all_text[start:end]
-            yield from self.split_page_by_max_tokens(page_num=find_page(start), text=section_text)
+            # Sections are views of all_text, so only one copy of the document is kept
+            yield from self.split_page_by_max_tokens(
+                page_num=find_page(start), text=section_text, buffer=all_text, offset=start
+            )
 
             last_figure_start = section_text.rfind("<figure")
             if last_figure_start > 2 * self.sentence_search_limit and last_figure_start > section_text.rfind(
@@ -204,7 +333,9 @@ class SentenceTextSplitter(TextSplitter):
                 start = end - self.section_overlap
 
         if start + self.section_overlap < end:
-            yield from self.split_page_by_max_tokens(page_num=find_page(start), text=all_text[start:end])
+            yield from self.split_page_by_max_tokens(
+                page_num=find_page(start), text=all_text[start:end], buffer=all_text, offset=start
+            )
 
 
 class SimpleTextSplitter(TextSplitter):
@@ -228,5 +359,10 @@ class SimpleTextSplitter(TextSplitter):
 
         # its too big, so we need to split it
         for i in range(0, length, self.max_object_length):
-            yield SplitPage(page_num=i // self.max_object_length, text=all_text[i : i + self.max_object_length])
+            yield SplitPage.view(
+                page_num=i // self.max_object_length,
+                buffer=all_text,
+                start=i,
+                end=min(i + self.max_object_length, length),
+            )
         return
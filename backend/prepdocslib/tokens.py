@@ -0,0 +1,25 @@
+from functools import lru_cache
+
+import tiktoken
+
+# NB: text-embedding-3-XX is the same BPE as text-embedding-ada-002
+ENCODING_MODEL = "text-embedding-ada-002"
+
+# Ad-hoc counts are for section-sized texts, so this bounds the cache to a few MB
+TOKEN_COUNT_CACHE_SIZE = 4096
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model_name: str = ENCODING_MODEL) -> tiktoken.Encoding:
+    """
+    Encoder for a model, looked up once per process
+    """
+    return tiktoken.encoding_for_model(model_name)
+
+
+@lru_cache(maxsize=TOKEN_COUNT_CACHE_SIZE)
+def count_tokens(text: str, model_name: str = ENCODING_MODEL) -> int:
+    """
+    Number of tokens in text, for texts whose count was not computed while splitting
+    """
+    return len(get_encoding(model_name).encode(text))
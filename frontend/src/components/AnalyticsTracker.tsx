@@ -4,10 +4,13 @@ import { useLocation } from "react-router-dom";
 interface AnalyticsEvent {
     event: string;
     userId?: string;
-    data?: Record<string, any>;
-    timestamp?: string;
+    properties: Record<string, any>;
+    timestamp: number;
 }
 
+const MAX_BATCH_SIZE = 20;
+const FLUSH_INTERVAL_MS = 5000;
+
 interface AnalyticsTrackerProps {
     children: React.ReactNode;
 }
@@ -17,12 +20,16 @@ class AnalyticsTracker {
     private sessionId: string;
     private userId: string | undefined;
     private apiEndpoint: string;
+    private pending: AnalyticsEvent[] = [];
+    private flushTimer: ReturnType<typeof setTimeout> | undefined;
 
     private constructor() {
         this.sessionId = this.generateSessionId();
         this.userId = this.getUserId();
         // Use a default endpoint for client-side or get from window object
-        this.apiEndpoint = (window as any).APP_CONFIG?.apiEndpoint || "/analytics";
+        this.apiEndpoint = (window as any).APP_CONFIG?.apiEndpoint || "/api/analytics/events";
+        // Send whatever is still queued when the page is hidden or unloaded
+        window.addEventListener("pagehide", () => this.flush());
     }
 
     public static getInstance(): AnalyticsTracker {
@@ -52,33 +59,66 @@ class AnalyticsTracker {
     }
 
     public async track(event: string, data?: Record<string, any>): Promise<void> {
+        const eventData: AnalyticsEvent = {
+            event,
+            userId: this.userId,
+            properties: {
+                ...data,
+                sessionId: this.sessionId,
+                url: window.location.href,
+                userAgent: navigator.userAgent
+            },
+            timestamp: Date.now()
+        };
+
+        // Only send analytics in production or when explicitly enabled
+        const isDevelopment = window.location.hostname === "localhost" || window.location.hostname === "127.0.0.1";
+        if (isDevelopment && !(window as any).ENABLE_DEV_ANALYTICS) {
+            console.log("Analytics (dev mode):", eventData);
+            return;
+        }
+
+        this.pending.push(eventData);
+        if (this.pending.length >= MAX_BATCH_SIZE) {
+            await this.flush();
+        } else {
+            this.scheduleFlush(FLUSH_INTERVAL_MS);
+        }
+    }
+
+    private scheduleFlush(delayMs: number): void {
+        if (this.flushTimer === undefined) {
+            this.flushTimer = setTimeout(() => this.flush(), delayMs);
+        }
+    }
+
+    private async flush(): Promise<void> {
+        clearTimeout(this.flushTimer);
+        this.flushTimer = undefined;
+        if (this.pending.length === 0) {
+            return;
+        }
+        const batch = this.pending.splice(0, this.pending.length);
+
         try {
-            const eventData: AnalyticsEvent = {
-                event,
-                userId: this.userId,
-                data: {
-                    ...data,
-                    sessionId: this.sessionId,
-                    url: window.location.href,
-                    userAgent: navigator.userAgent,
-                    timestamp: new Date().toISOString()
-                }
-            };
-
-            // Only send analytics in production or when explicitly enabled
-            const isDevelopment = window.location.hostname === "localhost" || window.location.hostname === "127.0.0.1";
-            if (isDevelopment && !(window as any).ENABLE_DEV_ANALYTICS) {
-                console.log("Analytics (dev mode):", eventData);
-                return;
+            // The endpoint accepts newline-delimited JSON, gzip-compressed when the browser supports it
+            const ndjson = batch.map(item => JSON.stringify(item)).join("\n") + "\n";
+            const headers: Record<string, string> = { "Content-Type": "application/x-ndjson" };
+            let body: BodyInit = ndjson;
+            if (typeof CompressionStream !== "undefined") {
+                body = await new Response(new Blob([ndjson]).stream().pipeThrough(new CompressionStream("gzip"))).blob();
+                headers["Content-Encoding"] = "gzip";
             }
 
-            await fetch(this.apiEndpoint, {
-                method: "POST",
-                headers: {
-                    "Content-Type": "application/json"
-                },
-                body: JSON.stringify(eventData)
-            });
+            const response = await fetch(this.apiEndpoint, { method: "POST", headers, body, keepalive: true });
+            if (response.status === 429) {
+                // The server is shedding load: keep the events it has not taken yet and retry once it asks us to
+                const result = await response.json().catch(() => ({}));
+                const consumed = Number(result.consumed) || 0;
+                this.pending.unshift(...batch.slice(consumed));
+                const retryAfter = Number(response.headers.get("Retry-After")) || FLUSH_INTERVAL_MS / 1000;
+                this.scheduleFlush(retryAfter * 1000);
+            }
         } catch (error) {
             console.warn("Analytics tracking failed:", error);
         }